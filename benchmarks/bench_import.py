@@ -0,0 +1,100 @@
+"""
+Cold-start benchmark: how long a fresh interpreter takes to import mytpu and get
+through `mytpu --help`, compared to one that does nothing. Exits with status 1 if
+`--help` goes over the budget, or if `--help` or an argument error loads any of the
+heavy modules, so it can run in CI.
+
+    PYTHONPATH=. python benchmarks/bench_import.py [--runs 15] [--budget-ms 25] [--output results.json]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+""" Modules that `mytpu --help` and argument errors must not load """
+HEAVY = ("requests", "urllib3", "cattr", "cattrs", "attr", "mytpu.api", "mytpu.models")
+
+CASES = {
+    "python": "pass",
+    "import mytpu": "import mytpu",
+    "import mytpu.cli": "import mytpu.cli",
+    "mytpu --help": "import sys; sys.argv = ['mytpu', '--help']; from mytpu.cli import main; main()",
+    "import mytpu.api": "import mytpu.api",
+}
+
+
+def wall_time(code: str, runs: int) -> float:
+    """
+    Median seconds for a fresh interpreter to run `code`.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], stdout=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+""" Command lines that should exit before anything heavy is needed """
+LIGHT_ARGS = {
+    "--help": ["--help"],
+    "argument error": ["--username", "u", "--password", "p", "--meters", "bogus", "list-meters"],
+}
+
+
+def loaded_by(argv: list) -> list:
+    code = (
+        f"import sys; sys.argv = {['mytpu'] + argv!r}\n"
+        "from mytpu.cli import main\n"
+        "try:\n    main()\nexcept SystemExit:\n    pass\n"
+        "print(' '.join(sys.modules), file=sys.stderr)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    modules = set(result.stderr.split())
+    return sorted(name for name in HEAVY if name in modules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=15)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=25,
+        help="Allowed time for `mytpu --help` beyond a bare interpreter start (default: 25)",
+    )
+    parser.add_argument("--output", help="Where to write the results as JSON")
+    args = parser.parse_args()
+
+    results = {name: wall_time(code, args.runs) for name, code in CASES.items()}
+    baseline = results["python"]
+    for name, seconds in results.items():
+        print(f"{name:20} {seconds * 1000:7.1f}ms  (+{(seconds - baseline) * 1000:.1f}ms)")
+
+    overhead = (results["mytpu --help"] - baseline) * 1000
+    heavy = {name: loaded_by(argv) for name, argv in LIGHT_ARGS.items()}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(
+                {"seconds": results, "help_overhead_ms": overhead, "help_heavy_modules": heavy},
+                file,
+                indent=2,
+            )
+
+    failed = False
+    if overhead > args.budget_ms:
+        print(f"FAIL: --help takes {overhead:.1f}ms over budget of {args.budget_ms}ms", file=sys.stderr)
+        failed = True
+    for name, modules in heavy.items():
+        if modules:
+            print(f"FAIL: {name} loads {', '.join(modules)}", file=sys.stderr)
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
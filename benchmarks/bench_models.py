@@ -0,0 +1,156 @@
+"""
+Micro-benchmark for structuring/unstructuring hourly `Usage` records, comparing the
+global cattr converter (what Model.from_dict used to call) with mytpu's prebuilt one,
+and for loading a customer response fully (from_dict) versus lazily (Model.lazy) when
+only the account context and meters are read.
+
+    python benchmarks/bench_models.py [--records N] [--services N] [--repeat N]
+"""
+import argparse
+import time
+import tracemalloc
+
+import cattr
+
+from mytpu.models import (
+    SERVICE_TYPES,
+    AccountContext,
+    AccountSummary,
+    Address,
+    Contract,
+    CustomerResponse,
+    Service,
+    Usage,
+    converter,
+    converter_omit_none,
+)
+
+
+def usage_record(hour: int) -> dict:
+    """
+    One hour of usage shaped like the portal's: the typed fields are filled in,
+    everything else is null.
+    """
+    record = {a.name: None for a in Usage.__attrs_attrs__}
+    day, hour = divmod(hour, 24)
+    record.update(
+        additionalInfo="Test - 10.786",
+        avgHigh=0,
+        avgLow=0,
+        avgMedian=0,
+        billedDemandValue=0.0,
+        demandPeakTime=f"2022-07-{day % 28 + 1:02} {hour:02}:00",
+        readDate=f"2022-07-{day % 28 + 1:02}",
+        scaledRead=10.786 + hour,
+        temp=0,
+        tempHigh=0,
+        tempLow=0,
+        uom="KWH",
+        usageCategory="H",
+        usageConsumptionValue=1.892,
+        usageDate=f"2022-07-{day % 28 + 1:02}",
+        usageDemandValue=0.0,
+        usageHighTemp=0.0,
+        usageLowTemp=0.0,
+    )
+    return record
+
+
+def filled(cls, **values) -> dict:
+    """
+    A raw dict with a string in every field of `cls` that takes one, and null elsewhere.
+    """
+    record = {a.name: "x" if a.type in (str, object) else None for a in cls.__attrs_attrs__}
+    record.update(values)
+    return record
+
+
+def customer_response(services: int) -> dict:
+    """
+    A customer response with every AccountSummary field present, like the portal's.
+    """
+    meters = [
+        filled(Service, meterNumber=f"{31000000 + i}", serviceType="P", meterType="N")
+        for i in range(services)
+    ]
+    return {
+        "status": "Ok",
+        "statusCode": "200",
+        "accountContext": filled(AccountContext, mailingAddress=filled(Address)),
+        "accountSummaryType": filled(
+            AccountSummary,
+            address=filled(Address),
+            contracts=[filled(Contract) for _ in range(services)],
+            services=meters,
+            servicesForGraph=meters,
+        ),
+    }
+
+
+def read_customer(customer: CustomerResponse):
+    """
+    What a login needs from the customer response.
+    """
+    customer.accountContext.accountNumber
+    for service in customer.accountSummaryType.get_meters(SERVICE_TYPES, True):
+        service.meterNumber
+
+
+def peak_memory(fn) -> int:
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def rate(fn, items, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(items) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=24 * 365)
+    parser.add_argument("--services", type=int, default=8, help="Meters on the customer response")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    records = [usage_record(hour) for hour in range(args.records)]
+    usages = [converter.structure(record, Usage) for record in records]
+
+    results = [
+        ("structure   cattr.structure", rate(lambda r: cattr.structure(r, Usage), records, args.repeat)),
+        ("structure   Usage.from_dict", rate(Usage.from_dict, records, args.repeat)),
+        ("unstructure cattr.unstructure", rate(cattr.unstructure, usages, args.repeat)),
+        ("unstructure Usage.unstructure", rate(converter.unstructure, usages, args.repeat)),
+        ("unstructure omit_none", rate(converter_omit_none.unstructure, usages, args.repeat)),
+    ]
+    for name, per_second in results:
+        print(f"{name:32} {per_second:12,.0f} records/s")
+
+    customers = [customer_response(args.services) for _ in range(200)]
+    loads = {
+        "customer    from_dict": CustomerResponse.from_dict,
+        "customer    lazy": CustomerResponse.lazy,
+    }
+    for name, load in loads.items():
+        per_second = rate(lambda c: read_customer(load(c)), customers, args.repeat)
+
+        def keep_all():
+            kept = [load(c) for c in customers]
+            for customer in kept:
+                read_customer(customer)
+
+        memory = peak_memory(keep_all) / len(customers)
+        print(f"{name:32} {per_second:12,.0f} loads/s  {memory / 1024:6.1f}KiB each")
+
+if __name__ == "__main__":
+    main()
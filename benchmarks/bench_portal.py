@@ -0,0 +1,205 @@
+"""
+End-to-end benchmarks of MyTPU against the local stub portal (see stub_portal.py), so
+that performance work can be measured without touching the real one.
+
+    PYTHONPATH=. python benchmarks/bench_portal.py [--days 30] [--meters 4] [--latency 0.02]
+    PYTHONPATH=. python benchmarks/bench_portal.py --compare benchmarks/results/before.json
+
+Covers cold start (interpreter start and import, then scrape + login + customer), login,
+customer load, single and bulk usage fetches, parse throughput and peak memory. Results
+are written as JSON (to benchmarks/results/ by default) so runs can be compared.
+"""
+import argparse
+from datetime import date, datetime, timedelta
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict
+
+from stub_portal import stub_process, usage_records
+
+from mytpu.api import MyTPU
+from mytpu.models import SERVICE_TYPES, UsageResponse
+from mytpu.stream import iter_history
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def timings(fn: Callable, repeat: int) -> Dict[str, float]:
+    """
+    Runs `fn` `repeat` times; returns the median, best and worst wall time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "max_s": max(times),
+        "runs": repeat,
+    }
+
+
+def peak_memory(fn: Callable) -> int:
+    """
+    Peak bytes allocated by Python while running `fn`.
+    """
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def window(days: int) -> tuple:
+    start = date(2022, 9, 1)
+    return (f"{start} 12:00", f"{start + timedelta(days=days - 1)} 11:59")
+
+
+def run(args) -> Dict[str, dict]:
+    results = {}
+    with stub_process(
+        meters=args.meters, latency=args.latency, error_rate=args.error_rate, seed=1
+    ) as base_url:
+
+        def client() -> MyTPU:
+            return MyTPU("bench", "bench", base_url=base_url, pool_size=args.concurrency)
+
+        def cold_start():
+            tpu = client()
+            tpu.customer()
+            tpu.close()
+
+        # Import time is measured in a fresh interpreter, since this one has mytpu loaded
+        results["import"] = timings(
+            lambda: subprocess.run([sys.executable, "-c", "import mytpu.api"], check=True),
+            args.repeat,
+        )
+        results["cold_start"] = timings(cold_start, args.repeat)
+
+        tpu = client()
+        results["login"] = timings(tpu._login, args.repeat)
+        results["customer"] = timings(lambda: tpu._load_customer(None), args.repeat)
+
+        meters = tpu.meters(SERVICE_TYPES)
+        from_date, to_date = window(args.days)
+        results["usage_single"] = timings(
+            lambda: tpu.usage(None, meters[0], from_date, to_date, hourly=True), args.repeat
+        )
+        results["usage_single"]["records"] = args.days * 24
+
+        def bulk():
+            windows = [(meter, from_date, to_date) for meter in meters]
+            for _ in tpu.usage_many(None, windows, hourly=True, concurrency=args.concurrency):
+                pass
+
+        results["usage_bulk"] = timings(bulk, args.repeat)
+        results["usage_bulk"]["records"] = args.days * 24 * len(meters)
+
+        def stream():
+            for _ in tpu.usage_stream(None, meters[0], from_date, to_date, hourly=True):
+                pass
+
+        results["usage_stream"] = timings(stream, args.repeat)
+
+        results["peak_memory"] = {
+            "usage_bytes": peak_memory(
+                lambda: tpu.usage(None, meters[0], from_date, to_date, hourly=True)
+            ),
+            "usage_stream_bytes": peak_memory(stream),
+            "usage_bulk_bytes": peak_memory(bulk),
+        }
+        results["requests"] = tpu.metrics.snapshot()
+        tpu.close()
+
+    # Parsing alone, without the network
+    payload = json.dumps(
+        {"status": "Ok", "statusCode": "200", "history": usage_records(*window(args.days), True)}
+    ).encode()
+    records = args.days * 24
+    for name, parse in {
+        "parse_json": lambda: json.loads(payload),
+        "parse_models": lambda: UsageResponse.from_dict(json.loads(payload)),
+        "parse_stream": lambda: sum(
+            1 for _ in iter_history(payload[i : i + 65536] for i in range(0, len(payload), 65536))
+        ),
+    }.items():
+        result = results[name] = timings(parse, args.repeat)
+        result["records_per_s"] = records / result["median_s"]
+    return results
+
+
+def compare(old: dict, new: dict):
+    """
+    Prints the change in median time for each benchmark present in both runs.
+    """
+    print(f"{'benchmark':20} {'before':>10} {'after':>10} {'change':>8}")
+    for name, result in new["results"].items():
+        before = old["results"].get(name, {}).get("median_s")
+        after = result.get("median_s")
+        if before is None or after is None:
+            continue
+        print(f"{name:20} {before * 1000:9.1f}ms {after * 1000:9.1f}ms {(after / before - 1) * 100:+7.1f}%")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--days", type=int, default=30, help="Days of hourly usage per request")
+    parser.add_argument("--meters", type=int, default=4, help="Meters on the stub account")
+    parser.add_argument("--latency", type=float, default=0.0, help="Stub response delay (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 503s")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "config": {
+            key: getattr(args, key)
+            for key in ("days", "meters", "latency", "error_rate", "concurrency", "repeat")
+        },
+        "results": run(args),
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{report['timestamp'].replace(':', '')}-{report['commit'] or 'local'}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+
+    for name, result in report["results"].items():
+        if "median_s" in result:
+            extra = f"  {result['records_per_s']:,.0f} records/s" if "records_per_s" in result else ""
+            print(f"{name:20} {result['median_s'] * 1000:9.1f}ms{extra}")
+    for name, value in report["results"]["peak_memory"].items():
+        print(f"{name:20} {value / 1024:9.0f}KiB")
+    print(f"results written to {output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+Local stand-in for the parts of myaccount.mytpu.org that MyTPU uses, so that client
+performance can be measured (and the client exercised) without the real portal.
+
+    python benchmarks/stub_portal.py --port 8081 --meters 4 --latency 0.05
+    mytpu --base-url http://127.0.0.1:8081 --username u --password p list-meters
+
+Serves /eportal/, the main.*.js holding the Basic token, /rest/oauth/token (password
+and refresh grants), account/checkmultipleaccts/, account/customer/ and
+usage/month[/day]. Usage responses have one record per hour (or day) of the requested
+window, for any meter. Latency and the rate of 503 errors are configurable.
+"""
+import argparse
+from contextlib import contextmanager
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+import random
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs
+
+BASIC_TOKEN = "c3R1Yi1jbGllbnQ6c3R1Yi1zZWNyZXQ="
+MAIN_JS = "main.5tub.js"
+CUSTOMER_ID = "1000001"
+ACCOUNT_NUMBER = "2000001"
+
+
+def service(index: int) -> dict:
+    """
+    A meter on the stub account: even indexes are power, odd ones water.
+    """
+    power = index % 2 == 0
+    return {
+        "meterNumber": f"{31000000 + index}",
+        "meterType": "N" if power else None,
+        "serviceType": "P" if power else "W",
+        "serviceNumber": f"S{index:05}",
+        "serviceId": f"{40000000 + index}",
+        "serviceContract": f"{50000000 + index}",
+        "latitude": "47.25",
+        "longitude": "-122.44",
+        "uom": "KWH" if power else "CCF",
+        "startDate": "2020-01-01",
+        "endDate": "9999-12-31",
+        "subMeters": None,
+    }
+
+
+def usage_records(from_date: str, to_date: str, hourly: bool) -> list:
+    """
+    One record per hour (or day) from from_date through to_date, shaped like the portal's.
+    """
+    first = date.fromisoformat(from_date[:10])
+    last = max(date.fromisoformat(to_date[:10]), first)
+    records = []
+    day = first
+    read = 1000.0
+    while day <= last:
+        for hour in range(24) if hourly else [None]:
+            read += 1.25
+            record = {
+                "additionalInfo": f"Test - {read:.3f}",
+                "avgHigh": 0,
+                "avgLow": 0,
+                "avgMedian": 0,
+                "billedDemandValue": 0.0,
+                "demandPeakTime": f"{day} {hour or 0:02}:00",
+                "readDate": f"{day}",
+                "readDateTime": f"{day} {hour:02}:00" if hourly else None,
+                "scaledRead": read,
+                "temp": 0,
+                "tempHigh": 0,
+                "tempLow": 0,
+                "uom": "KWH",
+                "usageCategory": "H" if hourly else "D",
+                "usageConsumptionValue": 1.25,
+                "usageDate": f"{day}",
+                "usageDemandValue": 0.0,
+                "usageHighTemp": 0.0,
+                "usageLowTemp": 0.0,
+            }
+            records.append(record)
+        day += timedelta(days=1)
+    return records
+
+
+class StubPortal(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        meters: int = 2,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        token_lifetime: int = 3599,
+        seed: int = None,
+    ):
+        super().__init__((host, port), StubHandler)
+        """ Number of meters on the account """
+        self.meters: int = meters
+        """ Seconds each response is delayed by """
+        self.latency: float = latency
+        """ Fraction of /rest/ requests (other than oauth) answered with a 503 """
+        self.error_rate: float = error_rate
+        self.token_lifetime: int = token_lifetime
+        self.random = random.Random(seed)
+        self.tokens = set()
+        self.refresh_tokens = set()
+        """ Requests served for each path """
+        self.hits = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubPortal":
+        self._thread = threading.Thread(target=self.serve_forever, name="stub-portal", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def hit(self, path: str):
+        with self._lock:
+            self.hits[path] = self.hits.get(path, 0) + 1
+
+    def grant(self) -> dict:
+        access, refresh = uuid.uuid4().hex, uuid.uuid4().hex
+        with self._lock:
+            self.tokens.add(access)
+            self.refresh_tokens.add(refresh)
+        return {
+            "access_token": access,
+            "token_type": "bearer",
+            "refresh_token": refresh,
+            "expires_in": self.token_lifetime,
+            "scope": "read write",
+            "jti": str(uuid.uuid4()),
+        }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server: StubPortal
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this, delayed ACKs add ~40ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.hit(self.path)
+        time.sleep(self.server.latency)
+        if self.path == "/eportal/":
+            self.send(
+                200,
+                f'<html><script type="text/javascript" src="{MAIN_JS}"></script></html>'.encode(),
+                "text/html",
+            )
+        elif self.path == f"/eportal/{MAIN_JS}":
+            body = (
+                'var a={"Content-Type":"application/x-www-form-urlencoded",'
+                f'Authorization:"Basic {BASIC_TOKEN}"}};'
+            )
+            self.send(200, body.encode(), "application/javascript")
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        self.server.hit(path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(self.server.latency)
+        if path == "/rest/oauth/token":
+            return self.oauth(body.decode())
+        if self.headers.get("Authorization", "").removeprefix("Bearer ") not in self.server.tokens:
+            return self.send_json(401, {"error": "invalid_token"})
+        if self.server.error_rate and self.server.random.random() < self.server.error_rate:
+            return self.send_json(503, {"error": "unavailable"})
+        request = json.loads(body or b"{}")
+        match path.rstrip("/"):
+            case "/rest/account/checkmultipleaccts":
+                self.send_json(200, self.accounts())
+            case "/rest/account/customer":
+                self.send_json(200, self.customer())
+            case "/rest/usage/month/day" | "/rest/usage/month" as usage_path:
+                history = usage_records(
+                    request["fromDate"], request["toDate"], usage_path.endswith("day")
+                )
+                self.send_json(200, {"status": "Ok", "statusCode": "200", "history": history})
+            case "/rest/user":
+                self.send_json(200, {"status": "Ok", "statusCode": "200", "user": self.user()})
+            case _:
+                self.send_json(404, {"error": "not found"})
+
+    def oauth(self, body: str):
+        if self.headers.get("Authorization") != f"Basic {BASIC_TOKEN}":
+            return self.send_json(401, {"error": "unauthorized"})
+        form = {key: values[-1] for key, values in parse_qs(body).items()}
+        if form.get("grant_type") == "password":
+            return self.send_json(200, dict(self.server.grant(), user=self.user()))
+        if form.get("grant_type") == "refresh_token":
+            with self.server._lock:
+                known = form.get("refresh_token") in self.server.refresh_tokens
+                self.server.refresh_tokens.discard(form.get("refresh_token"))
+            if known:
+                return self.send_json(200, self.server.grant())
+        self.send_json(400, {"error": "invalid_grant"})
+
+    def user(self) -> dict:
+        return {"customerId": CUSTOMER_ID, "userName": "STUB", "firstName": "STUB"}
+
+    def accounts(self) -> dict:
+        return {
+            "status": "Ok",
+            "statusCode": "200",
+            "account": [{"accountNumber": ACCOUNT_NUMBER, "customerId": CUSTOMER_ID}],
+            "accSummaryTypes": [],
+        }
+
+    def customer(self) -> dict:
+        services = [service(index) for index in range(self.server.meters)]
+        return {
+            "status": "Ok",
+            "statusCode": "200",
+            "accountContext": {"accountNumber": ACCOUNT_NUMBER, "userID": "STUB"},
+            "accountSummaryType": {
+                "accountNumber": ACCOUNT_NUMBER,
+                "billCycleCode": "14",
+                "billDate": "2022-09-14",
+                "services": services,
+                "servicesForGraph": services,
+            },
+        }
+
+    def send_json(self, status: int, content: dict):
+        self.send(status, json.dumps(content).encode(), "application/json")
+
+    def send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _serve(conn, kwargs):
+    portal = StubPortal(**kwargs)
+    conn.send(portal.base_url)
+    portal.serve_forever()
+
+
+@contextmanager
+def stub_process(**kwargs):
+    """
+    Runs a StubPortal in a child process and yields its base url, so that its own CPU
+    and memory use don't count towards the client's.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve, args=(child, kwargs), daemon=True)
+    process.start()
+    try:
+        yield parent.recv()
+    finally:
+        process.terminate()
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--meters", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    portal = StubPortal(args.host, args.port, args.meters, args.latency, args.error_rate)
+    print(f"stub portal on {portal.base_url}", flush=True)
+    try:
+        portal.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
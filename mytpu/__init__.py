@@ -6,4 +6,11 @@ Command line interface
 
 __version__ = "0.1.0"
 
-from mytpu.api import MyTPU
+
+def __getattr__(name: str):
+    # Imported on first use, so that e.g. `mytpu --help` doesn't load requests and cattrs
+    if name == "MyTPU":
+        from mytpu.api import MyTPU
+
+        return MyTPU
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,531 @@
+"""
+asyncio version of MyTPU, on aiohttp (pip install mytpu[async]).
+
+AsyncMyTPU has the same methods as MyTPU, as coroutines, and shares its request
+bodies, response handling, models, caches and metrics. Its requests share one aiohttp
+connection pool, so many meters can be fetched at once from a single thread:
+
+    async with AsyncMyTPU(username, password) as tpu:
+        meters = await tpu.meters()
+        results = await tpu.usage_many(None, [(meter, from_date, to_date) for meter in meters])
+
+Cancelling a call cancels its requests. Calls that fan out (customers, meters,
+usage_many) cancel the rest of their requests if one fails or they are cancelled.
+
+Unlike MyTPU, there is no background token renewal (auto_refresh) or usage_stream();
+an expired token is renewed when the next request needs it.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple, TypeVar, Union
+from urllib.parse import urlsplit
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from mytpu.api import BaseClient, find_basic_token, find_main_js
+from mytpu.cache import ResponseCache, TokenCache
+from mytpu.models import (
+    SERVICE_TYPES,
+    Account,
+    AccountContext,
+    AccountNumber,
+    AccountSummary,
+    CustomerResponse,
+    Service,
+    User,
+)
+from mytpu.registry import MeterRegistry
+from mytpu.trace import Tracer
+from mytpu.transport import ACCEPT_ENCODING, POOL_SIZE, TransportPolicy, retry_after
+
+T = TypeVar("T")
+
+
+class _AsyncCall:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task: asyncio.Task = task
+        self.waiters: int = 0
+
+
+class AsyncSingleFlight:
+    """
+    mytpu.singleflight.SingleFlight for coroutines. Not thread-safe; use it from one
+    event loop.
+
+    The shared call runs in its own task, so cancelling one waiter doesn't cancel it for
+    the others. It is only cancelled once every waiter has been.
+    """
+
+    def __init__(self, on_shared: Callable[[], None] = None):
+        self._calls: Dict[Hashable, _AsyncCall] = {}
+        """ Called each time a call waits on another one instead of running """
+        self.on_shared: Optional[Callable[[], None]] = on_shared
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Returns await fn(), or the result of the fn() already running under `key`.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _AsyncCall(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        elif self.on_shared:
+            self.on_shared()
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                call.task.cancel()
+
+    def _forget(self, key: Hashable, call: _AsyncCall):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+async def gather_limited(calls: Iterable[Callable[[], Awaitable[T]]], concurrency: int) -> List[T]:
+    """
+    Awaits each of `calls`, with at most `concurrency` running at once, and returns their
+    results in order. If one fails, or this is cancelled, the others are cancelled.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(call: Callable[[], Awaitable[T]]) -> T:
+        async with semaphore:
+            return await call()
+
+    tasks = [asyncio.ensure_future(run(call)) for call in calls]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Wait for them to stop, and collect their errors so asyncio doesn't log them
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class AsyncMyTPU(BaseClient):
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        token_cache: TokenCache = None,
+        policy: TransportPolicy = None,
+        pool_size: int = POOL_SIZE,
+        connector: "aiohttp.BaseConnector" = None,
+        base_url: str = None,
+        response_cache: ResponseCache = None,
+        tracer: Tracer = None,
+        lazy_models: bool = False,
+        registry: MeterRegistry = None,
+    ):
+        assert aiohttp is not None, "AsyncMyTPU needs aiohttp (pip install mytpu[async])"
+        super().__init__(
+            username,
+            password,
+            token_cache=token_cache,
+            policy=policy,
+            base_url=base_url,
+            response_cache=response_cache,
+            tracer=tracer,
+            lazy_models=lazy_models,
+            registry=registry,
+        )
+        """ Lets concurrent identical logins, customer loads and usage requests share one request """
+        self.flights: AsyncSingleFlight = AsyncSingleFlight(lambda: self.metrics.add("coalesced"))
+        """ Most connections open at once, unless `connector` is given """
+        self.pool_size: int = pool_size
+        """ Connection pool shared with other clients; its owner closes it, not close() """
+        self.connector: Optional["aiohttp.BaseConnector"] = connector
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._token_lock = asyncio.Lock()
+        """ Whether the token cache has been read; it's read on first use, off the event loop """
+        self._tokens_loaded: bool = not self.token_cache
+
+    @property
+    def session(self) -> "aiohttp.ClientSession":
+        # Created on first use, since it has to be created inside the event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=self.connector or aiohttp.TCPConnector(limit=self.pool_size),
+                connector_owner=self.connector is None,
+                headers={"Accept-Encoding": ACCEPT_ENCODING},
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.policy.connect_timeout,
+                    sock_read=self.policy.read_timeout,
+                ),
+            )
+        return self._session
+
+    async def close(self):
+        """
+        Closes the http session, and its connection pool unless it was passed in.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self) -> "AsyncMyTPU":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @property
+    def oauth_token(self) -> Awaitable[str]:
+        """
+        The "basic auth" credential for the customer-oauth endpoint (see MyTPU.oauth_token).
+        """
+        return self._get_oauth_token()
+
+    async def _load_token_cache(self):
+        if not self._tokens_loaded:
+            await self.flights.do("token cache", self._read_token_cache)
+
+    async def _read_token_cache(self):
+        if not self._tokens_loaded:
+            # The cache file is locked and read from disk, so don't block the event loop on it
+            self._use_cached_tokens(await asyncio.to_thread(self.token_cache.load, self.username))
+            self._tokens_loaded = True
+
+    async def _save_tokens(self, **values):
+        if self.token_cache:
+            await asyncio.to_thread(self.token_cache.save, self.username, **values)
+
+    async def _get_oauth_token(self) -> str:
+        await self._load_token_cache()
+        if not self._oauth_token:
+            await self.flights.do("scrape", self._scrape)
+        return self._oauth_token
+
+    async def _scrape(self):
+        if self._oauth_token:
+            return
+        with self.tracer.span("scrape"):
+            status, content = await self._request("GET", f"{self.base_url}/eportal/")
+            assert status == 200, content
+            main_js = find_main_js(content.decode())
+            status, content = await self._request("GET", f"{self.base_url}/eportal/{main_js}")
+            assert status == 200, content
+            self._oauth_token = find_basic_token(content.decode(), main_js)
+        await self._save_tokens(oauth_token=self._oauth_token)
+
+    @property
+    def access_token(self) -> Awaitable[str]:
+        return self._get_access_token()
+
+    async def _get_access_token(self) -> str:
+        await self._load_token_cache()
+        if self._needs_token():
+            await self.flights.do("login", self._ensure_token)
+        return self._access_token
+
+    async def _ensure_token(self):
+        async with self._token_lock:
+            if self._needs_token():
+                if not await self._refresh():
+                    await self._login()
+
+    @property
+    def user(self) -> Awaitable[User]:
+        return self._get_user()
+
+    async def _get_user(self) -> User:
+        await self._load_token_cache()
+        if not self._user:
+            # User info is obtained as part of the login process
+            await self.access_token
+        return self._user
+
+    async def _oauth_post(self, data: dict) -> Tuple[int, bytes]:
+        # Not retried, since a refresh token may only be good for one use
+        return await self._request(
+            "POST",
+            f"{self.base_url}/rest/oauth/token",
+            idempotent=False,
+            headers=self._oauth_headers(await self.oauth_token),
+            data=data,
+        )
+
+    async def _login(self, rescrape: bool = True):
+        """
+        Password grant against the oauth endpoint, which also returns the user info.
+        """
+        with self.tracer.span("login"):
+            status, content = await self._oauth_post(self._login_form())
+            if status == 401 and rescrape and self.token_cache:
+                # The cached Basic token goes stale whenever TPU redeploys their javascript
+                self._oauth_token = None
+                return await self._login(rescrape=False)
+            assert status == 200, content
+            self.metrics.add("logins")
+            await self._save_tokens(**self._use_tokens(self._parse(content, "/rest/oauth/token")))
+
+    async def refresh(self) -> bool:
+        """
+        Exchanges the refresh token for a new access token (see MyTPU.refresh).
+        """
+        await self._load_token_cache()
+        async with self._token_lock:
+            return await self._refresh()
+
+    async def _refresh(self) -> bool:
+        # The refresh grant doesn't return the user info, so it can't replace a login
+        if not self._refresh_token or not self._user:
+            return False
+        with self.tracer.span("refresh"):
+            status, content = await self._oauth_post(self._refresh_form())
+            if status != 200:
+                self._refresh_token = None
+                return False
+            self.metrics.add("refreshes")
+            await self._save_tokens(**self._use_tokens(self._parse(content, "/rest/oauth/token")))
+            return True
+
+    async def renew_token(self, stale_token: str = None):
+        """
+        Replaces the access token, unless `stale_token` is given and has already been
+        replaced.
+        """
+        await self._load_token_cache()
+        async with self._token_lock:
+            if stale_token and stale_token != self._access_token:
+                return
+            if not await self._refresh():
+                await self._login()
+
+    async def post(self, path: str, data=None, json=None) -> bytes:
+        """
+        POSTs to /rest/`path` with the access token and returns the response body. JSON
+        requests are answered from self.response_cache when it has a usable saved response.
+        """
+        if self.response_cache is None or json is None:
+            return await self._send(path, data=data, json=json)
+        # The cache is on disk, so don't block the event loop on it
+        content = await asyncio.to_thread(self._cached_content, path, json)
+        if content is None:
+            content = await self._send(path, json=json)
+            await asyncio.to_thread(self.response_cache.put, path, json, content)
+        return content
+
+    async def _send(self, path: str, data=None, json=None) -> bytes:
+        token = await self.access_token
+        status, content = await self._post(path, token, data=data, json=json)
+        if status == 401:
+            # The token was revoked or expired early; renew it and try exactly once more
+            await self.renew_token(stale_token=token)
+            status, content = await self._post(path, await self.access_token, data=data, json=json)
+        assert status == 200, content
+        return content
+
+    async def _post(self, path: str, token: str, **kwargs) -> Tuple[int, bytes]:
+        # Everything under /rest/ that we use only reads data, so it's safe to retry
+        return await self._request(
+            "POST", f"{self.base_url}/rest/{path}", headers=self._bearer_headers(token), **kwargs
+        )
+
+    async def _request(self, method: str, url: str, idempotent: bool = True, **kwargs) -> Tuple[int, bytes]:
+        """
+        Sends a request according to self.policy (see MyTPU._request) and returns its
+        status and body.
+        """
+        self._check_replay(method, url)
+        path = urlsplit(url).path
+        attempt = 0
+        while True:
+            if self.limiter:
+                await self._wait_for_limiter()
+            self.metrics.add("requests")
+            wait = None
+            with self.tracer.span("http", path) as span:
+                try:
+                    async with self.session.request(method, url, **kwargs) as resp:
+                        status, content = resp.status, await resp.read()
+                        wait = retry_after(resp.headers.get("Retry-After"))
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    span.error = type(e).__name__
+                    self.metrics.add("errors")
+                    if not idempotent or attempt >= self.policy.max_retries:
+                        raise
+                    status = None
+                else:
+                    span.status = status
+                    span.bytes = len(content)
+            if status is None:
+                delay = self.policy.delay(attempt)
+            else:
+                self.metrics.observe(path, span.duration)
+                if status == 429:
+                    self.metrics.add("throttled")
+                if (
+                    status not in self.policy.retry_statuses
+                    or not idempotent
+                    or attempt >= self.policy.max_retries
+                ):
+                    return status, content
+                delay = self.policy.delay(attempt, wait)
+            self.metrics.add("retries")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _wait_for_limiter(self):
+        waited = 0.0
+        while True:
+            delay = self.limiter.try_acquire()
+            if not delay:
+                break
+            await asyncio.sleep(delay)
+            waited += delay
+        if waited:
+            self.metrics.waited(waited)
+
+    async def _post_json(self, path: str, body: dict) -> dict:
+        return self._parse(await self.post(path, json=body), f"/rest/{path}")
+
+    async def get_all_accounts(self) -> List[AccountSummary]:
+        return await self.flights.do("accounts", self._load_accounts)
+
+    async def _load_accounts(self) -> List[AccountSummary]:
+        await self.user
+        return self._set_accounts(await self._post_json(*self._accounts_request()))
+
+    async def customer(self, account_number: AccountNumber = None) -> CustomerResponse:
+        """
+        Customer info for `account_number`, or the login's default account (see
+        MyTPU.customer).
+        """
+        if account_number is None:
+            if not self._customer:
+                await self.flights.do(("customer", None), self._load_default_customer)
+            return self._customer
+        if account_number not in self._customers:
+            await self.flights.do(
+                ("customer", account_number), lambda: self._load_account_customer(account_number)
+            )
+        return self._customers[account_number]
+
+    async def _load_default_customer(self):
+        if not self._customer:
+            with self.tracer.span("customer"):
+                await self._load_customer(None)
+
+    async def _load_account_customer(self, account_number: AccountNumber):
+        if account_number not in self._customers:
+            with self.tracer.span("customer", account_number):
+                await self._load_customer(await self._account(account_number))
+
+    async def _load_customer(self, account: Optional[Account]) -> CustomerResponse:
+        await self.user
+        return self._set_customer(account, await self._post_json(*self._customer_request(account)))
+
+    async def _account(self, account_number: AccountNumber) -> Account:
+        if self.accounts is None:
+            await self.get_all_accounts()
+        return self._find_account(account_number)
+
+    async def customers(self, concurrency: int = 4) -> Dict[AccountNumber, CustomerResponse]:
+        """
+        Loads the customer info for every account this login can see, several at a time.
+        """
+        if self.accounts is None:
+            await self.get_all_accounts()
+        numbers = [account.accountNumber for account in self.accounts]
+        loaded = await gather_limited(
+            [lambda number=number: self.customer(number) for number in numbers], concurrency
+        )
+        self.registry.complete = True
+        return dict(zip(numbers, loaded))
+
+    async def meters(
+        self,
+        types: Set[str] = SERVICE_TYPES,
+        accounts: Union[None, str, List[AccountNumber]] = None,
+        concurrency: int = 4,
+    ) -> List[Service]:
+        """
+        Meters whose serviceType or meterNumber is in `types` on `accounts` (see
+        MyTPU.meters).
+        """
+        registry = self.registry
+        if accounts is None:
+            if registry.default_account is None:
+                await self.customer()
+            accounts = [registry.default_account]
+        elif accounts == "all":
+            if not registry.complete:
+                await self.customers(concurrency)
+            accounts = None
+        else:
+            missing = [number for number in accounts if number not in registry.contexts]
+            await gather_limited(
+                [lambda number=number: self.customer(number) for number in missing], concurrency
+            )
+        return registry.select(types, accounts)
+
+    async def context_for(self, service: Service) -> AccountContext:
+        """
+        The account context to use for requests about `service`.
+        """
+        if service.meterNumber not in self.registry and not self._customer:
+            await self.customer()
+        assert service.meterNumber in self.registry, f"meter {service.meterNumber} isn't on any loaded account"
+        return self.registry.context(service.meterNumber)
+
+    async def get_user(self) -> User:
+        return await self.flights.do("user", self._load_user)
+
+    async def _load_user(self) -> User:
+        await self.user
+        return self._user_response(await self._post_json(*self._user_request()))
+
+    async def usage(
+        self,
+        context: Optional[AccountContext],
+        service: Service,
+        from_date: str,
+        to_date: str,
+        hourly=False,
+    ) -> Dict[str, Any]:
+        """
+        Usage for `service` between the two dates (see MyTPU.usage). Concurrent calls for
+        the same request share one http request and the same decoded dict.
+        """
+        context = context or await self.context_for(service)
+        await self.user
+        path, body = self._usage_body(context, service, from_date, to_date, hourly)
+        return await self.flights.do(
+            ("usage", ResponseCache.key(path, body)), lambda: self._post_json(path, body)
+        )
+
+    async def usage_many(
+        self,
+        context: Optional[AccountContext],
+        windows: Iterable[Tuple[Service, str, str]],
+        hourly=False,
+        concurrency: int = 4,
+    ) -> List[Tuple[str, Tuple[str, str], Dict[str, Any]]]:
+        """
+        Runs usage() for each (service, from_date, to_date) in `windows`, with up to
+        `concurrency` requests in flight, and returns (meterNumber, (from_date, to_date),
+        content) for each one, in the order of `windows`.
+        """
+        windows = list(windows)
+        # Log in first so the requests don't all wait on it separately
+        await self.user
+        contents = await gather_limited(
+            [
+                lambda window=window: self.usage(context, window[0], window[1], window[2], hourly)
+                for window in windows
+            ],
+            concurrency,
+        )
+        return [
+            (service.meterNumber, (from_date, to_date), content)
+            for (service, from_date, to_date), content in zip(windows, contents)
+        ]
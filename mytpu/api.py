@@ -1,18 +1,41 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import itertools
 import json
 import re
 import sys
-from typing import List
+import threading
+import time
+from typing import Any, Dict, Generator, Iterable, List, Optional, Set, Tuple, Type, Union
+from urllib.parse import urlsplit
 import requests
-import cattr
 
+from mytpu.cache import ReplayMiss, ResponseCache, TokenCache
+from mytpu.ratelimit import TokenBucket
+from mytpu.registry import MeterRegistry
+from mytpu.singleflight import SingleFlight
+from mytpu.stream import iter_history
+from mytpu.trace import Tracer
+from mytpu.transport import (
+    ACCEPT_ENCODING,
+    POOL_SIZE,
+    PoolAdapter,
+    TransportMetrics,
+    TransportPolicy,
+    retry_after,
+    shared_adapter,
+)
 from mytpu.models import (
+    SERVICE_TYPES,
     Account,
+    AccountNumber,
     AccountContext,
     CustomerResponse,
     Service,
     User,
     CheckMultipleAcctsResponse,
     AccountSummary,
+    Model,
+    Usage,
     UserDetailsResponse,
     UserDetailsResponse,
 )
@@ -20,19 +43,81 @@ from mytpu.models import (
 # from hyper.contrib import HTTP20Adapter
 
 
-class MyTPU:
-    def __init__(self, username: str, password: str):
+def find_main_js(html: str) -> str:
+    """
+    Name of the main javascript file referenced by the eportal login page.
+    """
+    match = re.search(r'<script type="text/javascript" src="(main\.\w+\.js)"></script>', html)
+    assert match is not None, "Could not find main.????.js on eportal login page"
+    groups = match.groups()
+    assert len(groups) == 1, "Could not find main.????.js on eportal login page"
+    return groups[0]
+
+
+def find_basic_token(js: str, main_js: str) -> str:
+    """
+    The "basic auth" credential for the oauth endpoint, from TPU's minified javascript.
+    """
+    match = re.search(
+        r'{"Content-Type":"application/x-www-form-urlencoded",Authorization:"Basic (.+?)"}',
+        js,
+    )
+    assert match is not None, f"Could not find oauth token in {main_js}"
+    groups = match.groups()
+    assert len(groups) == 1, f"Could not find oauth token in {main_js}"
+    return groups[0]
+
+
+class BaseClient:
+    """
+    Everything MyTPU and AsyncMyTPU share: configuration, login state, the accounts
+    and meters loaded so far, and how requests are built and responses turned into
+    models. The subclasses only differ in how they do I/O.
+    """
+
+    """ Where the portal lives; overridable per instance, e.g. to point at a local stub """
+    BASE_URL = "https://myaccount.mytpu.org"
+    """ Seconds before expiry at which the access token is no longer used """
+    EXPIRY_MARGIN = 60
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        token_cache: TokenCache = None,
+        policy: TransportPolicy = None,
+        base_url: str = None,
+        response_cache: ResponseCache = None,
+        tracer: Tracer = None,
+        lazy_models: bool = False,
+        registry: MeterRegistry = None,
+    ):
         self.username: str = username
         self.password: str = password
-
-        self.session: requests.Session = requests.Session()
-        # Couldn't seem to get this to work, and it doesn't seem necessary
-        # self.session.mount('https://myaccount.mytpu.org', HTTP20Adapter())
+        self.token_cache: TokenCache = token_cache
+        self.base_url: str = (base_url or self.BASE_URL).rstrip("/")
+        """ Saved responses to reuse for repeated requests (see ResponseCache) """
+        self.response_cache: ResponseCache = response_cache
+        self.policy: TransportPolicy = policy or TransportPolicy()
+        self.metrics: TransportMetrics = TransportMetrics()
+        """ Hooks called around each phase of the client's work (see mytpu.trace) """
+        self.tracer: Tracer = tracer or Tracer()
+        """ Structure account and customer responses field by field as they are read """
+        self.lazy_models: bool = lazy_models
+        """ Shared by everything using this client """
+        self.limiter: TokenBucket = (
+            TokenBucket(self.policy.rate, self.policy.burst) if self.policy.rate else None
+        )
 
         """ Token used to access the customer-oauth endpoint """
         self._oauth_token: str = None
         """ Customer access token """
         self._access_token: str = None
+        """ time.time() at which the access token expires """
+        self._token_expires_at: float = None
+        """ time.time() at which the access token was issued """
+        self._token_issued_at: float = None
+        self._refresh_token: str = None
 
         self._user: User = None
         self.accounts: List[Account] = None
@@ -40,6 +125,269 @@ class MyTPU:
         self.account_context: AccountContext = None
 
         self._customer: CustomerResponse = None
+        """ Customer info for each account number, including the default account's """
+        self._customers: Dict[AccountNumber, CustomerResponse] = {}
+        """ Meters on the loaded accounts; may be seeded from an earlier run (see RegistryCache) """
+        self.registry: MeterRegistry = registry or MeterRegistry()
+
+    def _load_cached_tokens(self):
+        self._use_cached_tokens(self.token_cache.load(self.username))
+
+    def _use_cached_tokens(self, entry: dict):
+        self._oauth_token = entry.get("oauth_token")
+        if entry.get("user"):
+            # The user info doesn't expire with the token, and is all a replay needs
+            self._user = User.from_dict(entry["user"])
+        # Outlives the access token, so an expired entry can still be renewed without
+        # the password
+        self._refresh_token = entry.get("refresh_token")
+        if self.token_cache.is_fresh(entry) and entry.get("user"):
+            self._access_token = entry["access_token"]
+            self._token_expires_at = entry["expires_at"]
+            if entry.get("expires_in"):
+                self._token_issued_at = entry["expires_at"] - entry["expires_in"]
+            self._schedule_refresh()
+
+    def _token_expired(self) -> bool:
+        if not self._token_expires_at:
+            return False
+        return self._token_expires_at - self.EXPIRY_MARGIN <= time.time()
+
+    def _needs_token(self) -> bool:
+        return not self._access_token or self._token_expired()
+
+    def _login_form(self) -> dict:
+        return {
+            "grant_type": "password",
+            "username": self.username,
+            "password": self.password,
+        }
+
+    def _refresh_form(self) -> dict:
+        return {
+            "grant_type": "refresh_token",
+            "refresh_token": self._refresh_token,
+        }
+
+    def _oauth_headers(self, oauth_token: str) -> dict:
+        return {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Authorization": f"Basic {oauth_token}",
+            # These are http/2 headers that I don't quite know how to send (hyper.contrib.HTTP20Adapter causes build failures)
+            # ':authority:': 'myaccount.mytpu.org',
+            # ':method:': 'POST',
+            # ':path:': '/rest/oauth/token',
+            # ':scheme:': 'https',
+        }
+
+    @staticmethod
+    def _bearer_headers(token: str) -> dict:
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}",
+        }
+
+    def _set_tokens(self, content: dict):
+        """
+        Stores the result of a password or refresh grant.
+        """
+        values = self._use_tokens(content)
+        if self.token_cache:
+            self.token_cache.save(self.username, **values)
+        self._schedule_refresh()
+
+    def _use_tokens(self, content: dict) -> dict:
+        """
+        Takes the tokens from a password or refresh grant into use, and returns the
+        values to save in the token cache.
+        """
+        assert content["token_type"] == "bearer"
+        assert content["scope"] == "read write"
+
+        self._access_token = content["access_token"]
+        self._token_issued_at = time.time()
+        self._token_expires_at = self._token_issued_at + content["expires_in"]  # e.g. 3599
+        # Keep the old refresh token if the portal doesn't rotate it
+        self._refresh_token = content.get("refresh_token") or self._refresh_token
+        # self.jti = content["jti"]  # e.g. lower case uuid
+
+        # The refresh grant may not include the user info, so keep what we had from login
+        if content.get("user") or not self._user:
+            self._user = User.from_dict(content["user"])
+            assert self._user.customerId, "no customerId value found in login response"
+
+        values = dict(
+            oauth_token=self._oauth_token,
+            access_token=self._access_token,
+            expires_in=content["expires_in"],
+            expires_at=self._token_expires_at,
+            refresh_token=self._refresh_token,
+        )
+        if content.get("user"):
+            values["user"] = content["user"]
+        return values
+
+    def _schedule_refresh(self, delay: float = None):
+        """
+        Called whenever a new access token is stored; clients that renew it in the
+        background start their timer here.
+        """
+
+    @property
+    def token_age(self) -> Optional[float]:
+        """
+        Seconds since the current access token was issued, if there is one.
+        """
+        return time.time() - self._token_issued_at if self._token_issued_at else None
+
+    def _cached_content(self, path: str, body: Any) -> Optional[bytes]:
+        if self.response_cache is None or body is None:
+            return None
+        return self.response_cache.get(path, body)
+
+    def _check_replay(self, method: str, url: str):
+        if self.response_cache and self.response_cache.replay:
+            raise ReplayMiss(f"replay mode doesn't send requests ({method} {url})")
+
+    def _parse(self, content: bytes, url: str) -> dict:
+        with self.tracer.span("decode", urlsplit(url or "").path) as span:
+            span.bytes = len(content)
+            return json.loads(content)
+
+    def _structure(self, cls: Type[Model], content: dict) -> Model:
+        with self.tracer.span("structure", cls.__name__):
+            return cls.lazy(content) if self.lazy_models else cls.from_dict(content)
+
+    def _accounts_request(self) -> Tuple[str, dict]:
+        return "account/checkmultipleaccts/", {
+            "customerId": self._user.customerId,
+            "csrViewOnly": "N",
+            "firstTimeLogin": "N",
+        }
+
+    def _set_accounts(self, content: dict) -> List[AccountSummary]:
+        response = self._structure(CheckMultipleAcctsResponse, content)
+        assert response.statusCode == "200"
+        self.accounts = response.account or []
+        self.account_summaries = response.accSummaryTypes or []
+        return self.account_summaries
+
+    def _find_account(self, account_number: AccountNumber) -> Account:
+        for account in self.accounts:
+            if account.accountNumber == account_number:
+                return account
+        raise KeyError(f"account {account_number} is not available to {self.username}")
+
+    def _customer_request(self, account: Optional[Account]) -> Tuple[str, dict]:
+        context = AccountContext.from_account(account, self.username) if account else None
+        return "account/customer/", {
+            "customerId": self._user.customerId,
+            "accountContext": context.unstructure() if context else None,
+            "csrViewOnly": "N",
+        }
+
+    def _set_customer(self, account: Optional[Account], content: dict) -> CustomerResponse:
+        assert content['statusCode'] == "200"
+        customer = self._structure(CustomerResponse, content)
+        account_number = (
+            account.accountNumber if account else customer.accountContext.accountNumber
+        )
+        self._customers[account_number] = customer
+        if account is None:
+            self._customer = customer
+        self.registry.add_account(account_number, customer, default=account is None)
+        return customer
+
+    def _user_request(self) -> Tuple[str, dict]:
+        assert self._user.customerId, "call login() first"
+        return "user", {"customerId": self._user.customerId}
+
+    def _user_response(self, content: dict) -> User:
+        response = self._structure(UserDetailsResponse, content)
+        assert response.statusCode == "200"
+        # The other values in this request seem to be blank, so let's just return the user info
+        return response.user
+
+    def _usage_body(
+        self,
+        context: AccountContext,
+        service: Service,
+        from_date: str,
+        to_date: str,
+        hourly=False,
+    ) -> Tuple[str, dict]:
+        path = "usage/month/day" if hourly else "usage/month"
+        return path, {
+            "customerId": self._user.customerId,
+            "fromDate": from_date,  # "2022-05-17 12:00",
+            "toDate": to_date,  # "2022-08-17 11:59",
+            "meterNumber": service.meterNumber,
+            "serviceNumber": service.serviceNumber,
+            "serviceId": service.serviceId,
+            "serviceType": service.serviceType,
+            "accountContext": context.unstructure(),
+            "latitude": service.latitude,
+            "longitude": service.longitude,
+            "contractNum": service.serviceContract,
+            "netContractNum": service.netContractNum,
+        }
+
+
+class MyTPU(BaseClient):
+    """ Seconds before expiry at which auto_refresh renews the access token """
+    REFRESH_MARGIN = 300
+    """ Seconds to wait before retrying a failed background renewal """
+    REFRESH_RETRY = 60
+    """ Bytes to read at a time from streamed responses """
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        token_cache: TokenCache = None,
+        auto_refresh: bool = False,
+        policy: TransportPolicy = None,
+        pool_size: int = POOL_SIZE,
+        shared_pool: bool = False,
+        base_url: str = None,
+        response_cache: ResponseCache = None,
+        tracer: Tracer = None,
+        lazy_models: bool = False,
+        registry: MeterRegistry = None,
+    ):
+        super().__init__(
+            username,
+            password,
+            token_cache=token_cache,
+            policy=policy,
+            base_url=base_url,
+            response_cache=response_cache,
+            tracer=tracer,
+            lazy_models=lazy_models,
+            registry=registry,
+        )
+        """ Renew the access token in a background thread before it expires """
+        self.auto_refresh: bool = auto_refresh
+        """ Lets concurrent identical logins, customer loads and usage requests share one request """
+        self.flights: SingleFlight = SingleFlight(lambda: self.metrics.add("coalesced"))
+
+        self.session: requests.Session = requests.Session()
+        # Couldn't seem to get this to work, and it doesn't seem necessary
+        # self.session.mount('https://myaccount.mytpu.org', HTTP20Adapter())
+        # pool_size should be at least the number of threads making requests at once.
+        # Instances with shared_pool share connections (but not cookies or tokens).
+        self.shared_pool: bool = shared_pool
+        self.adapter: PoolAdapter = shared_adapter(pool_size) if shared_pool else PoolAdapter(pool_size)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+
+        self._token_lock = threading.RLock()
+        self._refresh_timer: threading.Timer = None
+
+        if self.token_cache:
+            self._load_cached_tokens()
 
     @property
     def oauth_token(self) -> str:
@@ -48,66 +396,115 @@ class MyTPU:
         embedded in TPU's minified javascript. This is how we get it.
         """
         if not self._oauth_token:
-            # First, we scan the login page for the main javascript content
-            resp = self.session.get("https://myaccount.mytpu.org/eportal/")
-            assert resp.status_code == 200, resp.content
-            match = re.search(
-                r'<script type="text/javascript" src="(main\.\w+\.js)"></script>',
-                resp.content.decode(),
-            )
-            assert (
-                match is not None
-            ), "Could not find main.????.js on eportal login page"
-            groups = match.groups()
-            assert len(groups) == 1, "Could not find main.????.js on eportal login page"
-            main_js = groups[0]
-            # Then we scan the minified js code for the auth header used to access the oauth2 login API
-            resp = self.session.get(f"https://myaccount.mytpu.org/eportal/{main_js}")
-            assert resp.status_code == 200, resp.content
-            match = re.search(
-                r'{"Content-Type":"application/x-www-form-urlencoded",Authorization:"Basic (.+?)"}',
-                resp.content.decode(),
-            )
-            assert match is not None, f"Could not find oauth token in {main_js}"
-            groups = match.groups()
-            assert len(groups) == 1, f"Could not find oauth token in {main_js}"
-            self._oauth_token = groups[0]
+            with self.tracer.span("scrape"):
+                # First, we scan the login page for the main javascript content
+                resp = self._request("GET", f"{self.base_url}/eportal/")
+                assert resp.status_code == 200, resp.content
+                main_js = find_main_js(resp.content.decode())
+                # Then we scan the minified js code for the auth header used to access the oauth2 login API
+                resp = self._request("GET", f"{self.base_url}/eportal/{main_js}")
+                assert resp.status_code == 200, resp.content
+                self._oauth_token = find_basic_token(resp.content.decode(), main_js)
+            if self.token_cache:
+                self.token_cache.save(self.username, oauth_token=self._oauth_token)
         return self._oauth_token
 
     @property
     def access_token(self):
-        if not self._access_token:
-            resp = self.session.post(
-                "https://myaccount.mytpu.org/rest/oauth/token",
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    "Authorization": f"Basic {self.oauth_token}",
-                    # These are http/2 headers that I don't quite know how to send (hyper.contrib.HTTP20Adapter causes build failures)
-                    # ':authority:': 'myaccount.mytpu.org',
-                    # ':method:': 'POST',
-                    # ':path:': '/rest/oauth/token',
-                    # ':scheme:': 'https',
-                },
-                data={
-                    "grant_type": "password",
-                    "username": self.username,
-                    "password": self.password,
-                },
-            )
+        # Only take the lock if we actually need to log in, so that requests made while
+        # a background renewal is running can keep using the current token.
+        if self._needs_token():
+            self.flights.do("login", self._ensure_token)
+        return self._access_token
+
+    def _ensure_token(self):
+        with self._token_lock:
+            if self._needs_token():
+                if not self.refresh():
+                    self._login()
+
+    def _oauth_post(self, data: dict) -> requests.Response:
+        # Not retried, since a refresh token may only be good for one use
+        return self._request(
+            "POST",
+            f"{self.base_url}/rest/oauth/token",
+            idempotent=False,
+            headers=self._oauth_headers(self.oauth_token),
+            data=data,
+        )
+
+    def _login(self, rescrape: bool = True):
+        """
+        Password grant against the oauth endpoint, which also returns the user info.
+        """
+        with self.tracer.span("login"):
+            resp = self._oauth_post(self._login_form())
+            if resp.status_code == 401 and rescrape and self.token_cache:
+                # The cached Basic token goes stale whenever TPU redeploys their javascript
+                self._oauth_token = None
+                return self._login(rescrape=False)
             assert resp.status_code == 200, resp.content
-            content = json.loads(resp.content)
+            self.metrics.add("logins")
+            self._set_tokens(json.loads(resp.content))
 
-            assert content["token_type"] == "bearer"
-            assert content["scope"] == "read write"
+    def refresh(self) -> bool:
+        """
+        Exchanges the refresh token for a new access token, without sending the password.
+        Returns False if there is no refresh token or the portal refused it, in which
+        case a full login is needed.
+        """
+        with self._token_lock:
+            # The refresh grant doesn't return the user info, so it can't replace a login
+            if not self._refresh_token or not self._user:
+                return False
+            with self.tracer.span("refresh"):
+                resp = self._oauth_post(self._refresh_form())
+                if resp.status_code != 200:
+                    self._refresh_token = None
+                    return False
+                self.metrics.add("refreshes")
+                self._set_tokens(self._decode(resp))
+                return True
 
-            self._access_token = content["access_token"]
-            # self.expires_in = content["expires_in"]  # e.g. 3599
-            # self.refresh_token = content["refresh_token"]
-            # self.jti = content["jti"]  # e.g. lower case uuid
+    def renew_token(self, stale_token: str = None):
+        """
+        Replaces the access token, preferring the refresh grant over a new login. If
+        `stale_token` is given and another thread has already replaced it, this is a no-op.
+        """
+        with self._token_lock:
+            if stale_token and stale_token != self._access_token:
+                return
+            if not self.refresh():
+                self._login()
 
-            self._user = User.from_dict(content["user"])
-            assert self._user.customerId, "no customerId value found in login response"
-        return self._access_token
+    def _schedule_refresh(self, delay: float = None):
+        if not self.auto_refresh:
+            return
+        if delay is None:
+            delay = self._token_expires_at - self.REFRESH_MARGIN - time.time()
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+        self._refresh_timer = threading.Timer(max(delay, 0), self._background_refresh)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _background_refresh(self):
+        try:
+            self.renew_token()
+        except Exception as e:
+            print(f"background token renewal failed: {e}", file=sys.stderr)
+            self._schedule_refresh(self.REFRESH_RETRY)
+
+    def close(self):
+        """
+        Stops background token renewal and closes the http session (unless its
+        connection pool is shared with other instances).
+        """
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        if not self.shared_pool:
+            self.session.close()
 
     @property
     def user(self) -> User:
@@ -118,104 +515,302 @@ class MyTPU:
         return self._user
 
     def post(self, path: str, data=None, json=None, **kwargs) -> requests.Response:
-        print(f"post to /rest/{path}", file=sys.stderr)
-        kwargs.setdefault(
-            "headers",
-            {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.access_token}",
-            },
-        )
-        resp = self.session.post(
-            f"https://myaccount.mytpu.org/rest/{path}",
-            data=data,
-            json=json,
-            **kwargs,
-        )
+        """
+        POSTs to /rest/`path` with the access token. JSON requests are answered from
+        self.response_cache when it has a usable saved response.
+        """
+        if self.response_cache is None or json is None:
+            return self._send(path, data=data, json=json, **kwargs)
+        content = self._cached_content(path, json)
+        if content is None:
+            # The whole body is needed to save it, so the response isn't streamed
+            kwargs.pop("stream", None)
+            resp = self._send(path, json=json, **kwargs)
+            self.response_cache.put(path, json, resp.content)
+            return resp
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = f"{self.base_url}/rest/{path}"
+        resp._content = content
+        resp._content_consumed = True
+        return resp
+
+    def _send(self, path: str, data=None, json=None, **kwargs) -> requests.Response:
+        authorize = "headers" not in kwargs
+        token = self.access_token if authorize else None
+        resp = self._post(path, token, data=data, json=json, **kwargs)
+        if resp.status_code == 401 and authorize:
+            # The token was revoked or expired early; renew it and try exactly once more
+            resp.close()
+            self.renew_token(stale_token=token)
+            resp = self._post(path, self.access_token, data=data, json=json, **kwargs)
         assert resp.status_code == 200, resp.content
         return resp
 
+    def _post(self, path: str, token: str, **kwargs) -> requests.Response:
+        if token:
+            kwargs["headers"] = self._bearer_headers(token)
+        # Everything under /rest/ that we use only reads data, so it's safe to retry
+        return self._request("POST", f"{self.base_url}/rest/{path}", **kwargs)
+
+    def _request(self, method: str, url: str, idempotent: bool = True, **kwargs) -> requests.Response:
+        """
+        Sends a request according to self.policy: with timeouts, through the client's
+        rate limit, and with retries and backoff for idempotent requests.
+        """
+        self._check_replay(method, url)
+        kwargs.setdefault("timeout", self.policy.timeout)
+        path = urlsplit(url).path
+        attempt = 0
+        while True:
+            if self.limiter:
+                waited = self.limiter.acquire()
+                if waited:
+                    self.metrics.waited(waited)
+            self.metrics.add("requests")
+            with self.tracer.span("http", path) as span:
+                try:
+                    resp = self.session.request(method, url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    span.error = type(e).__name__
+                    self.metrics.add("errors")
+                    if not idempotent or attempt >= self.policy.max_retries:
+                        raise
+                    resp = None
+                else:
+                    span.status = resp.status_code
+                    # Streamed bodies haven't been read yet; go by the header
+                    span.bytes = (
+                        int(resp.headers.get("Content-Length") or 0)
+                        if kwargs.get("stream")
+                        else len(resp.content)
+                    )
+            if resp is None:
+                delay = self.policy.delay(attempt)
+            else:
+                self.metrics.observe(path, span.duration)
+                if resp.status_code == 429:
+                    self.metrics.add("throttled")
+                if (
+                    resp.status_code not in self.policy.retry_statuses
+                    or not idempotent
+                    or attempt >= self.policy.max_retries
+                ):
+                    return resp
+                delay = self.policy.delay(attempt, retry_after(resp.headers.get("Retry-After")))
+                resp.close()
+            self.metrics.add("retries")
+            time.sleep(delay)
+            attempt += 1
+
+    def _decode(self, resp: requests.Response) -> dict:
+        return self._parse(resp.content, resp.url)
+
     def get_all_accounts(self) -> List[AccountSummary]:
-        resp = self.post(
-            "account/checkmultipleaccts/",
-            json={
-                "customerId": self.user.customerId,
-                "csrViewOnly": "N",
-                "firstTimeLogin": "N",
-            },
-        )
-        content = json.loads(resp.content)
-        response = CheckMultipleAcctsResponse.from_dict(content)
-        assert response.statusCode == "200"
-        assert (
-            len(response.accSummaryTypes) == 1
-        ), "I don't have access to multiple accounts. Will need user examples to add support for it."
-        self.accounts = response.account
-        self.account_summaries = response.accSummaryTypes
-        return self.account_summaries
+        return self.flights.do("accounts", self._load_accounts)
+
+    def _load_accounts(self) -> List[AccountSummary]:
+        _ = self.user
+        path, body = self._accounts_request()
+        return self._set_accounts(self._decode(self.post(path, json=body)))
 
-    def customer(self) -> CustomerResponse:
+    def customer(self, account_number: AccountNumber = None) -> CustomerResponse:
         """
-        This call returns account info with lat/lon needed for the usage query
+        This call returns account info with lat/lon needed for the usage query.
+
+        Without `account_number`, this loads the login's default account. Each account's
+        response is cached separately.
         """
+        if account_number is None:
+            if not self._customer:
+                self.flights.do(("customer", None), self._load_default_customer)
+            return self._customer
+        if account_number not in self._customers:
+            self.flights.do(("customer", account_number), lambda: self._load_account_customer(account_number))
+        return self._customers[account_number]
+
+    def _load_default_customer(self):
+        # Another flight may have finished between the caller's check and this one starting
         if not self._customer:
-            resp = self.post(
-                "account/customer/",
-                json={
-                    "customerId": self.user.customerId,
-                    "accountContext": None,
-                    "csrViewOnly": "N",
-                },
-            )
-            assert resp.status_code == 200, resp.content
-            content = json.loads(resp.content)
-            assert content['statusCode'] == "200"
-            self._customer = CustomerResponse.from_dict(content)
-        return self._customer
+            with self.tracer.span("customer"):
+                self._load_customer(None)
 
-    def get_user(self) -> User:
-        assert self.user.customerId, "call login() first"
-        resp = self.session.post(
-            "https://myaccount.mytpu.org/rest/user",
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.access_token}",
-            },
-            json={"customerId": self.user.customerId},
-        )
+    def _load_account_customer(self, account_number: AccountNumber):
+        if account_number not in self._customers:
+            with self.tracer.span("customer", account_number):
+                self._load_customer(self._account(account_number))
+
+    def customers(self, concurrency: int = 4) -> Dict[AccountNumber, CustomerResponse]:
+        """
+        Loads the customer info for every account this login can see, several at a time.
+        """
+        if self.accounts is None:
+            self.get_all_accounts()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            numbers = [account.accountNumber for account in self.accounts]
+            customers = dict(zip(numbers, pool.map(self.customer, numbers)))
+        self.registry.complete = True
+        return customers
+
+    def meters(
+        self,
+        types: Set[str] = SERVICE_TYPES,
+        accounts: Union[None, str, List[AccountNumber]] = None,
+        concurrency: int = 4,
+    ) -> List[Service]:
+        """
+        Meters whose serviceType or meterNumber is in `types` on `accounts`: None for the
+        login's default account, "all", or a list of account numbers. Customer info is
+        only loaded for accounts that aren't in the registry yet.
+        """
+        registry = self.registry
+        if accounts is None:
+            if registry.default_account is None:
+                self.customer()
+            accounts = [registry.default_account]
+        elif accounts == "all":
+            if not registry.complete:
+                self.customers(concurrency)
+            accounts = None
+        else:
+            for account_number in accounts:
+                if account_number not in registry.contexts:
+                    self.customer(account_number)
+        return registry.select(types, accounts)
+
+    def _account(self, account_number: AccountNumber) -> Account:
+        if self.accounts is None:
+            self.get_all_accounts()
+        return self._find_account(account_number)
+
+    def _load_customer(self, account: Optional[Account]) -> CustomerResponse:
+        _ = self.user
+        path, body = self._customer_request(account)
+        resp = self.post(path, json=body)
         assert resp.status_code == 200, resp.content
-        content = json.loads(resp.content)
-        response = UserDetailsResponse.from_dict(content)
-        assert response.statusCode == "200"
-        # The other values in this request seem to be blank, so let's just return the user info
-        return response.user
+        return self._set_customer(account, self._decode(resp))
 
-    def usage(
+    def context_for(self, service: Service) -> AccountContext:
+        """
+        The account context to use for requests about `service`, from whichever loaded
+        account it belongs to.
+        """
+        if service.meterNumber not in self.registry and not self._customer:
+            self.customer()
+        assert service.meterNumber in self.registry, f"meter {service.meterNumber} isn't on any loaded account"
+        return self.registry.context(service.meterNumber)
+
+    def get_user(self) -> User:
+        return self.flights.do("user", self._load_user)
+
+    def _load_user(self) -> User:
+        _ = self.user
+        path, body = self._user_request()
+        return self._user_response(self._decode(self.post(path, json=body)))
+
+    def _usage_request(
         self,
         context: AccountContext,
         service: Service,
         from_date: str,
         to_date: str,
         hourly=False,
+    ) -> Tuple[str, dict]:
+        context = context or self.context_for(service)
+        _ = self.user
+        return self._usage_body(context, service, from_date, to_date, hourly)
+
+    def usage(
+        self,
+        context: Optional[AccountContext],
+        service: Service,
+        from_date: str,
+        to_date: str,
+        hourly=False,
     ):
-        path = "usage/month/day" if hourly else "usage/month"
-        resp = self.post(
-            path,
-            json={
-                "customerId": self.user.customerId,
-                "fromDate": from_date,  # "2022-05-17 12:00",
-                "toDate": to_date,  # "2022-08-17 11:59",
-                "meterNumber": service.meterNumber,
-                "serviceNumber": service.serviceNumber,
-                "serviceId": service.serviceId,
-                "serviceType": service.serviceType,
-                "accountContext": context.unstructure(),
-                "latitude": service.latitude,
-                "longitude": service.longitude,
-                "contractNum": service.serviceContract,
-                "netContractNum": service.netContractNum,
-            },
+        """
+        Usage for `service` between the two dates. If `context` is None, the context of
+        the account that `service` belongs to is used.
+
+        Concurrent calls for the same request share one http request and get the same
+        decoded dict, so don't modify it in place.
+        """
+        path, body = self._usage_request(context, service, from_date, to_date, hourly)
+        return self.flights.do(
+            ("usage", ResponseCache.key(path, body)),
+            lambda: self._decode(self.post(path, json=body)),
         )
-        content = json.loads(resp.content)
-        return content
 
+    def usage_stream(
+        self,
+        context: AccountContext,
+        service: Service,
+        from_date: str,
+        to_date: str,
+        hourly=False,
+        as_model=False,
+    ) -> Generator[Union[dict, Usage], None, None]:
+        """
+        Like usage(), but reads the response incrementally and yields the records in its
+        `history` one at a time (as raw dicts, or `Usage` objects if `as_model` is set),
+        so memory use doesn't grow with the size of the date range.
+        """
+        path, body = self._usage_request(context, service, from_date, to_date, hourly)
+        resp = self.post(path, json=body, stream=True)
+        try:
+            for record in iter_history(resp.iter_content(chunk_size=self.STREAM_CHUNK_SIZE)):
+                yield Usage.from_dict(record) if as_model else record
+        finally:
+            resp.close()
+
+    def usage_many(
+        self,
+        context: AccountContext,
+        windows: Iterable[Tuple[Service, str, str]],
+        hourly=False,
+        concurrency: int = 4,
+        limiter: TokenBucket = None,
+    ) -> Generator[Tuple[str, Tuple[str, str], dict], None, None]:
+        """
+        Runs usage() for each (service, from_date, to_date) in `windows`, with up to
+        `concurrency` requests in flight on this client's session. If `limiter` is
+        given, each request waits for a token from it first.
+
+        Yields (meterNumber, (from_date, to_date), content) as each request finishes,
+        so results arrive in completion order rather than request order. `windows` is
+        read as requests are started, and at most `concurrency * 2` are pending at a
+        time, so memory use doesn't grow with the number of windows.
+        """
+        # Log in first so the worker threads don't all race to do it
+        _ = self.user
+
+        def fetch(service, from_date, to_date):
+            if limiter:
+                limiter.acquire()
+            return self.usage(context, service, from_date, to_date, hourly)
+
+        windows = iter(windows)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures: Dict[Future, Tuple[str, Tuple[str, str]]] = {}
+
+            def submit():
+                for service, from_date, to_date in itertools.islice(windows, concurrency * 2 - len(futures)):
+                    futures[pool.submit(fetch, service, from_date, to_date)] = (
+                        service.meterNumber,
+                        (from_date, to_date),
+                    )
+
+            try:
+                submit()
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        # Forget it before yielding, so the response can be freed once the
+                        # caller is done with it
+                        meter_number, window = futures.pop(future)
+                        yield meter_number, window, future.result()
+                    submit()
+            finally:
+                # Don't start anything new if the caller stopped early or a request failed
+                for future in futures:
+                    future.cancel()
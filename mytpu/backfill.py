@@ -0,0 +1,198 @@
+"""
+Long-range usage history downloads.
+
+The usage endpoints only accept fairly short date ranges, so a backfill is planned as a
+series of windows that are fetched in parallel, checkpointed to disk as they complete
+(so an interrupted run picks up where it left off), and then stitched back together.
+
+Only settled windows are checkpointed. A window that ends today (or within the settle
+margin) is still filling in, so it is fetched again on every run.
+"""
+from datetime import date, timedelta
+import json
+import os
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from mytpu.api import MyTPU
+from mytpu.cache import default_cache_dir, is_settled, locked
+from mytpu.models import AccountContext, Service, usage_timestamp
+from mytpu.ratelimit import TokenBucket
+
+Window = Tuple[str, str]
+
+""" Default number of days per request, for hourly and daily data """
+WINDOW_DAYS = {True: 1, False: 90}
+
+
+def plan_windows(
+    start: date, end: date, hourly: bool = True, window_days: int = None
+) -> List[Window]:
+    """
+    Splits the inclusive range start..end into (from_date, to_date) windows the server
+    accepts. Dates are always 12:00 to 11:59, e.g. a single day is
+    ("2022-09-01 12:00", "2022-09-01 11:59").
+    """
+    window_days = window_days or WINDOW_DAYS[hourly]
+    assert window_days > 0, "window_days must be positive"
+    windows = []
+    while start <= end:
+        last = min(start + timedelta(days=window_days - 1), end)
+        windows.append((f"{start:%Y-%m-%d} 12:00", f"{last:%Y-%m-%d} 11:59"))
+        start = last + timedelta(days=1)
+    return windows
+
+
+def stitch(histories: Iterable[List[dict]], hourly: bool = None) -> List[dict]:
+    """
+    Merges the `history` lists from several usage responses into one chronological
+    list, dropping records that appear in more than one window.
+    """
+    records = {}
+    for history in histories:
+        for record in history:
+            # Records without a timestamp are kept as they are, not merged by date
+            key = usage_timestamp(record, hourly) or json.dumps(record, sort_keys=True)
+            records[key] = record
+    return [records[key] for key in sorted(records)]
+
+
+class Checkpoint:
+    """
+    Append-only log of the windows completed for one meter, stored as JSON lines.
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+
+    def entries(self) -> Iterator[dict]:
+        with locked(self.path, shared=True):
+            if not os.path.exists(self.path):
+                return
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partial line left by an interrupted run
+                        continue
+
+    def windows(self) -> Set[Window]:
+        """
+        The windows completed so far, without keeping their history.
+        """
+        return {(entry["from_date"], entry["to_date"]) for entry in self.entries()}
+
+    def load(self) -> Dict[Window, List[dict]]:
+        return {(entry["from_date"], entry["to_date"]): entry["history"] for entry in self.entries()}
+
+    def add(self, window: Window, history: List[dict]):
+        entry = {"from_date": window[0], "to_date": window[1], "history": history}
+        with locked(self.path):
+            with open(self.path, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+
+class Backfill:
+    def __init__(
+        self,
+        tpu: MyTPU,
+        context: Optional[AccountContext],
+        hourly: bool = True,
+        window_days: int = None,
+        concurrency: int = 4,
+        rate: float = 2.0,
+        checkpoint_dir: str = None,
+        settle_days: int = 1,
+    ):
+        self.tpu: MyTPU = tpu
+        """ None to use the context of each meter's own account """
+        self.context: Optional[AccountContext] = context
+        self.hourly: bool = hourly
+        self.window_days: int = window_days
+        self.concurrency: int = concurrency
+        """ Maximum requests per second """
+        self.limiter: TokenBucket = TokenBucket(rate, burst=concurrency)
+        self.checkpoint_dir: str = checkpoint_dir or os.path.join(
+            default_cache_dir(), "backfill"
+        )
+        """ Days after a window ends before it is checkpointed (meters report late) """
+        self.settle_days: int = settle_days
+
+    def checkpoint(self, service: Service) -> Checkpoint:
+        resolution = "hourly" if self.hourly else "daily"
+        return Checkpoint(
+            os.path.join(self.checkpoint_dir, f"{service.meterNumber}-{resolution}.jsonl")
+        )
+
+    def run(self, services: Iterable[Service], start: date, end: date) -> Dict[str, List[dict]]:
+        """
+        Downloads start..end for each service, skipping windows already checkpointed.
+        Returns the stitched history for each meterNumber.
+
+        Windows that haven't settled yet are fetched but not checkpointed.
+        """
+        return dict(self.iter_run(services, start, end))
+
+    def iter_run(self, services: Iterable[Service], start: date, end: date) -> Iterator[Tuple[str, List[dict]]]:
+        """
+        Like run(), but yields (meterNumber, history) for each meter as soon as all of its
+        windows are in, so only the meters still being fetched are held in memory.
+
+        A meter's checkpointed history is loaded when its first window is scheduled,
+        and dropped once its history has been yielded.
+        """
+        windows = plan_windows(start, end, self.hourly, self.window_days)
+        checkpoints = {}
+        completed = {}
+        remaining: Dict[str, int] = {}
+        todo = []
+        for service in services:
+            checkpoint = checkpoints[service.meterNumber] = self.checkpoint(service)
+            done = checkpoint.windows()
+            # Checkpoints written before only settled windows were kept may hold a
+            # partial day; fetch those again too
+            fetch = [
+                window
+                for window in windows
+                if window not in done or not is_settled(window[1], self.settle_days)
+            ]
+            remaining[service.meterNumber] = len(fetch)
+            todo.append((service, fetch))
+
+        def schedule() -> Iterator[Tuple[Service, str, str]]:
+            for service, fetch in todo:
+                if fetch:
+                    completed[service.meterNumber] = checkpoints[service.meterNumber].load()
+                    for window in fetch:
+                        yield (service, *window)
+
+        def finish(meter_number: str) -> Tuple[str, List[dict]]:
+            done = completed.pop(meter_number, None)
+            if done is None:
+                done = checkpoints[meter_number].load()
+            return meter_number, stitch((done[window] for window in windows if window in done), self.hourly)
+
+        for meter_number, count in list(remaining.items()):
+            if not count:
+                yield finish(meter_number)
+
+        results = self.tpu.usage_many(
+            self.context,
+            schedule(),
+            hourly=self.hourly,
+            concurrency=self.concurrency,
+            limiter=self.limiter,
+        )
+        for meter_number, window, content in results:
+            if content.get("statusCode") != "200" or "history" not in content:
+                print(f"unexpected result for {meter_number} {window}; will retry next run", file=sys.stderr)
+            else:
+                if is_settled(window[1], self.settle_days):
+                    checkpoints[meter_number].add(window, content["history"])
+                completed[meter_number][window] = content["history"]
+            remaining[meter_number] -= 1
+            if not remaining[meter_number]:
+                yield finish(meter_number)
@@ -0,0 +1,209 @@
+"""
+On-disk state shared between mytpu runs (and between processes running at the same time).
+"""
+import contextlib
+from datetime import date, timedelta
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Any, Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows has no flock(); fall back to unlocked access
+    fcntl = None
+
+
+def default_cache_dir() -> str:
+    """
+    Directory for mytpu state: $MYTPU_CACHE_DIR, or mytpu/ under the XDG cache dir.
+    """
+    path = os.getenv("MYTPU_CACHE_DIR")
+    if not path:
+        base = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        path = os.path.join(base, "mytpu")
+    return path
+
+
+@contextlib.contextmanager
+def locked(path: str, shared: bool = False):
+    """
+    Holds an advisory lock on `<path>.lock` for the duration of the block, so that
+    several processes (e.g. overlapping cron runs) don't clobber each other's writes.
+    """
+    os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+    with open(f"{path}.lock", "a") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_json(path: str, default: Any = None) -> Any:
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def write_json(path: str, data: Any):
+    """
+    Atomically replaces `path` with `data`. The file is only readable by the current
+    user, since several of the things we cache are credentials.
+    """
+    write_bytes(path, json.dumps(data).encode())
+
+
+def write_bytes(path: str, data: bytes):
+    """
+    Like write_json, for data that is already encoded.
+    """
+    dirname = os.path.dirname(path) or "."
+    os.makedirs(dirname, mode=0o700, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+class TokenCache:
+    """
+    Persists the login state for each username: the Basic token scraped from the
+    eportal javascript, the bearer token and its expiry, the refresh token and the
+    user payload returned by the login call. This lets repeat runs skip the
+    eportal scrape and password login until the bearer token is about to expire.
+    """
+
+    def __init__(self, path: str = None, margin: float = 300):
+        self.path: str = path or os.path.join(default_cache_dir(), "tokens.json")
+        """ Seconds before expiry at which a cached bearer token is no longer reused """
+        self.margin: float = margin
+
+    @staticmethod
+    def _key(username: str) -> str:
+        # TPU user names are not case sensitive
+        return username.upper()
+
+    def load(self, username: str) -> Dict[str, Any]:
+        with locked(self.path, shared=True):
+            return read_json(self.path, {}).get(self._key(username), {})
+
+    def save(self, username: str, **values):
+        """
+        Merges `values` into the cached entry for `username`.
+        """
+        with locked(self.path):
+            data = read_json(self.path, {})
+            data.setdefault(self._key(username), {}).update(values)
+            write_json(self.path, data)
+
+    def clear(self, username: str):
+        with locked(self.path):
+            data = read_json(self.path, {})
+            if data.pop(self._key(username), None) is not None:
+                write_json(self.path, data)
+
+    def is_fresh(self, entry: Dict[str, Any], now: Optional[float] = None) -> bool:
+        """
+        True if the cached bearer token in `entry` can still be used.
+        """
+        expires_at = entry.get("expires_at")
+        if not entry.get("access_token") or not expires_at:
+            return False
+        return expires_at - self.margin > (now or time.time())
+
+
+def is_settled(to_date: str, settle_days: int, when: float = None) -> bool:
+    """
+    True if a window ending on `to_date` ("YYYY-MM-DD ...") was at least `settle_days`
+    in the past at `when` (default now), so its readings will no longer change.
+    """
+    try:
+        end = date.fromisoformat(to_date[:10])
+    except (TypeError, ValueError):
+        return False
+    return end + timedelta(days=settle_days) < date.fromtimestamp(when or time.time())
+
+
+class ReplayMiss(LookupError):
+    """
+    Raised in replay mode for a request that has no saved response.
+    """
+
+
+class ResponseCache:
+    """
+    Saved portal responses, keyed by REST path and a hash of the canonical JSON request
+    body (customerId, meterNumber, fromDate, toDate, ...).
+
+    Usage for a window that had already ended when it was fetched never changes, so
+    those responses are kept forever. Anything else (windows that include today, and
+    requests without a window, like customer info) is reused for `ttl` seconds.
+
+    In `replay` mode every request must be answered from the cache, whatever its age,
+    and nothing is sent to the portal.
+    """
+
+    def __init__(self, path: str = None, ttl: float = 900, replay: bool = False, settle_days: int = 1):
+        self.path: str = path or os.path.join(default_cache_dir(), "responses")
+        self.ttl: float = ttl
+        self.replay: bool = replay
+        """ Days after a window ends before its readings are final (meters report late) """
+        self.settle_days: int = settle_days
+
+    @staticmethod
+    def key(path: str, body: Any) -> str:
+        canonical = json.dumps(body, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(f"{path.strip('/')}\n{canonical}".encode()).hexdigest()
+
+    def _file(self, path: str, body: Any) -> str:
+        return os.path.join(self.path, path.strip("/").replace("/", "_"), f"{self.key(path, body)}.json")
+
+    def is_final(self, body: Any, stored_at: float) -> bool:
+        """
+        True if `body` asks for a window that had settled by the time `stored_at`.
+        """
+        to_date = body.get("toDate") if isinstance(body, dict) else None
+        return is_settled(to_date, self.settle_days, stored_at)
+
+    def get(self, path: str, body: Any, now: float = None) -> Optional[bytes]:
+        """
+        The saved response for this request, if there is one that can still be used.
+        """
+        file = self._file(path, body)
+        try:
+            with open(file, "rb") as f:
+                # The file's mtime is when the response was fetched
+                stored_at = os.fstat(f.fileno()).st_mtime
+                content = f.read()
+        except FileNotFoundError:
+            if self.replay:
+                raise ReplayMiss(f"no saved response for {path} {self.key(path, body)}")
+            return None
+        if self.replay or self.is_final(body, stored_at):
+            return content
+        return content if stored_at + self.ttl > (now or time.time()) else None
+
+    def put(self, path: str, body: Any, content: bytes):
+        """
+        Saves a response, unless the portal reported an error in it.
+        """
+        try:
+            if json.loads(content).get("statusCode") != "200":
+                return
+        except (ValueError, AttributeError):
+            return
+        write_bytes(self._file(path, body), content)
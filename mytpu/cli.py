@@ -1,15 +1,19 @@
 from os import getenv
 import argparse
-import re
-from typing import List
-import cattr
+import datetime
+import os
+from typing import TYPE_CHECKING, List
 import pathlib
 import sys
-
-from mytpu.api import MyTPU
 import json
 
-from mytpu.models import Service
+# Everything else is imported where it's used, so that `mytpu --help` and argument
+# errors don't wait for requests, cattrs and the model classes to load
+if TYPE_CHECKING:
+    from mytpu.api import MyTPU
+    from mytpu.models import CustomerResponse, Service
+    from mytpu.store import UsageStore
+    from mytpu.trace import Tracer
 
 
 def get_args():
@@ -26,12 +30,86 @@ def get_args():
         help="MyTPU password (default: MYTPU_PASSWORD environment variable)",
         default=getenv("MYTPU_PASSWORD"),
     )
-    # TODO: hook this up
-    # parser.add_argument(
-    #     "--config",
-    #     type=pathlib.Path,
-    #     help="Path to config file with user/password",
-    # )
+    parser.add_argument(
+        "--base-url",
+        type=str,
+        help="Portal to talk to (default: MYTPU_BASE_URL environment variable or https://myaccount.mytpu.org)",
+        default=getenv("MYTPU_BASE_URL"),
+    )
+    parser.add_argument(
+        "--token-cache",
+        type=pathlib.Path,
+        help="Where to cache login tokens between runs (default: tokens.json in MYTPU_CACHE_DIR or ~/.cache/mytpu)",
+    )
+    parser.add_argument(
+        "--no-token-cache",
+        action="store_true",
+        help="Always log in fresh instead of reusing cached tokens",
+    )
+    parser.add_argument(
+        "--response-cache",
+        action="store_true",
+        help="Save portal responses and reuse them for identical requests: forever for past date ranges, for --response-ttl otherwise",
+    )
+    parser.add_argument(
+        "--response-ttl",
+        type=float,
+        help="Seconds to reuse saved responses that include today's usage (default: 900)",
+        default=900,
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Answer every request from saved responses and never contact the portal",
+    )
+    parser.add_argument(
+        "--refresh-meters",
+        action="store_true",
+        help="Load the meter list from the portal instead of reusing the one saved by an earlier run (for up to a day)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Seconds to wait for the portal to respond (default: 60)",
+        default=60,
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        help="Times to retry a request after a timeout or server error (default: 3)",
+        default=3,
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        help="Maximum requests per second to the portal (default: no limit)",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Print each request to the portal as it finishes",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print a breakdown of where the time went (login, http, decoding, ...) when done",
+    )
+    parser.add_argument(
+        "--cprofile",
+        type=pathlib.Path,
+        help="Write a cProfile dump of the run to this file (see python -m pstats)",
+    )
+    parser.add_argument(
+        "--config",
+        type=pathlib.Path,
+        help="Path to config file with login profiles (default: mytpu/config.ini in $XDG_CONFIG_HOME or ~/.config, if it exists)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        help="Config profile to use when no username/password is given (default: the only profile)",
+    )
 
     parser.add_argument(
         "--meters",
@@ -40,6 +118,12 @@ def get_args():
         default='all',
     )
 
+    parser.add_argument(
+        "--account",
+        type=str,
+        help="comma separated list of account numbers, or all (default: the login's default account)",
+    )
+
     subparsers = parser.add_subparsers(dest="command", help="command help")
 
     # create parsers for subcommands
@@ -51,60 +135,529 @@ def get_args():
 
     sub["account-summary"] = subparsers.add_parser("account-summary", help="Get customer account summary")
     sub["usage"] = subparsers.add_parser("usage", help="Get usage")
+    sub["usage"].add_argument(
+        "--concurrency",
+        type=int,
+        help="Number of meters to fetch at the same time (default: 4; not with --format, --stream or --incremental)",
+    )
+    sub["usage"].add_argument(
+        "--from",
+        dest="from_date",
+        type=datetime.date.fromisoformat,
+        help="First day of usage to get (YYYY-MM-DD, default: 2022-09-01)",
+        default=datetime.date(2022, 9, 1),
+    )
+    sub["usage"].add_argument(
+        "--to",
+        dest="to_date",
+        type=datetime.date.fromisoformat,
+        help="Last day of usage to get (YYYY-MM-DD, default: same as --from)",
+    )
+    sub["usage"].add_argument(
+        "--format",
+        choices=["ndjson", "csv", "json"],
+        help="Write one row per usage record as it is downloaded, instead of one JSON document per meter",
+    )
+    sub["usage"].add_argument(
+        "--columns",
+        type=str,
+        help="Comma separated record fields to write with --format (default: all for json/ndjson; meterNumber,meterType,readDateTime,usageDate,usageConsumptionValue,usageDemandValue,scaledRead,uom for csv)",
+    )
+    sub["usage"].add_argument(
+        "--stream",
+        action="store_true",
+        help="Same as --format ndjson",
+    )
+    sub["usage"].add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only output readings newer than the last --incremental run, starting from the watermark each meter reached then (implies --format ndjson unless given; --from is used for meters seen for the first time, and --to defaults to today)",
+    )
+    sub["usage"].add_argument(
+        "--watermarks",
+        type=pathlib.Path,
+        help="Where --incremental keeps each meter's watermark (default: watermarks.json in the cache dir)",
+    )
+    sub["usage"].add_argument(
+        "--overlap-days",
+        type=int,
+        help="Days before the watermark to request again, to pick up late readings (default: 1)",
+        default=1,
+    )
+
+    sub["backfill"] = subparsers.add_parser(
+        "backfill", help="Download a long range of usage history"
+    )
+    sub["backfill"].add_argument(
+        "--from",
+        dest="from_date",
+        type=datetime.date.fromisoformat,
+        help="First day to download (YYYY-MM-DD)",
+        required=True,
+    )
+    sub["backfill"].add_argument(
+        "--to",
+        dest="to_date",
+        type=datetime.date.fromisoformat,
+        help="Last day to download (YYYY-MM-DD, default: today)",
+        default=datetime.date.today(),
+    )
+    sub["backfill"].add_argument(
+        "--daily",
+        action="store_true",
+        help="Download daily instead of hourly usage",
+    )
+    sub["backfill"].add_argument(
+        "--window-days",
+        type=int,
+        help="Days per request (default: 1 for hourly, 90 for daily)",
+    )
+    sub["backfill"].add_argument(
+        "--concurrency",
+        type=int,
+        help="Number of requests to run at the same time (default: 4)",
+        default=4,
+    )
+    sub["backfill"].add_argument(
+        "--rate",
+        type=float,
+        help="Maximum requests per second (default: 2)",
+        default=2.0,
+    )
+    sub["backfill"].add_argument(
+        "--checkpoint-dir",
+        type=pathlib.Path,
+        help="Where to record completed windows so interrupted runs can resume (default: backfill/ in the cache dir)",
+    )
+    sub["backfill"].add_argument(
+        "--format",
+        choices=["ndjson", "csv", "json"],
+        help="Write one row per usage record as it is downloaded, instead of one JSON document per meter",
+    )
+    sub["backfill"].add_argument(
+        "--columns",
+        type=str,
+        help="Comma separated record fields to write with --format (default: all for json/ndjson; meterNumber,meterType,readDateTime,usageDate,usageConsumptionValue,usageDemandValue,scaledRead,uom for csv)",
+    )
+
+    sub["sync"] = subparsers.add_parser(
+        "sync", help="Download new usage into the local store"
+    )
+    sub["sync"].add_argument(
+        "--since",
+        type=datetime.date.fromisoformat,
+        help="Where to start for meters with nothing stored yet (YYYY-MM-DD, default: 30 days ago)",
+        default=datetime.date.today() - datetime.timedelta(days=30),
+    )
+    sub["sync"].add_argument(
+        "--daily",
+        action="store_true",
+        help="Sync daily instead of hourly usage",
+    )
+    sub["sync"].add_argument(
+        "--store",
+        type=pathlib.Path,
+        help="SQLite file to store usage in (default: usage.sqlite3 in the cache dir)",
+    )
+    sub["sync"].add_argument(
+        "--concurrency",
+        type=int,
+        help="Number of requests to run at the same time (default: 4)",
+        default=4,
+    )
+    sub["sync"].add_argument(
+        "--rate",
+        type=float,
+        help="Maximum requests per second (default: 2)",
+        default=2.0,
+    )
+
+    sub["fleet"] = subparsers.add_parser(
+        "fleet", help="Sync every profile in the config file that is due"
+    )
+    sub["fleet"].add_argument(
+        "--force",
+        action="store_true",
+        help="Run every profile, even if its `every` interval hasn't passed",
+    )
+    sub["fleet"].add_argument(
+        "--concurrency",
+        type=int,
+        help="Number of profiles to run at the same time (default: 8)",
+        default=8,
+    )
+    sub["fleet"].add_argument(
+        "--store",
+        type=pathlib.Path,
+        help="SQLite file to store usage in (default: usage.sqlite3 in the cache dir)",
+    )
+
+    sub["rollup"] = subparsers.add_parser(
+        "rollup",
+        help="Print daily, weekly, monthly or billing cycle totals from the local store (no login needed)",
+    )
+    sub["rollup"].add_argument(
+        "--period",
+        choices=["day", "week", "month", "cycle"],
+        help="Period to print totals for (default: day)",
+        default="day",
+    )
+    sub["rollup"].add_argument(
+        "--from",
+        dest="from_date",
+        type=datetime.date.fromisoformat,
+        help="First period to print, by its start date (YYYY-MM-DD, default: all)",
+    )
+    sub["rollup"].add_argument(
+        "--to",
+        dest="to_date",
+        type=datetime.date.fromisoformat,
+        help="Only print periods starting before this date (YYYY-MM-DD, default: all)",
+    )
+    sub["rollup"].add_argument(
+        "--format",
+        choices=["ndjson", "csv", "json"],
+        help="Output format (default: json)",
+        default="json",
+    )
+    sub["rollup"].add_argument(
+        "--store",
+        type=pathlib.Path,
+        help="SQLite file usage is stored in (default: usage.sqlite3 in the cache dir)",
+    )
+
+    sub["serve"] = subparsers.add_parser(
+        "serve", help="Poll usage in the background and serve it over http"
+    )
+    sub["serve"].add_argument(
+        "--host",
+        type=str,
+        help="Address to listen on (default: 127.0.0.1)",
+        default="127.0.0.1",
+    )
+    sub["serve"].add_argument(
+        "--port",
+        type=int,
+        help="Port to listen on (default: 8080)",
+        default=8080,
+    )
+    sub["serve"].add_argument(
+        "--metrics-interval",
+        type=float,
+        help="Seconds between updates of the /metrics text (default: 15)",
+        default=15,
+    )
+    sub["serve"].add_argument(
+        "--every",
+        type=float,
+        help="Minutes between polls of the portal (default: 60)",
+        default=60,
+    )
+    sub["serve"].add_argument(
+        "--since",
+        type=datetime.date.fromisoformat,
+        help="Where to start for meters with nothing stored yet (YYYY-MM-DD, default: 30 days ago)",
+        default=datetime.date.today() - datetime.timedelta(days=30),
+    )
+    sub["serve"].add_argument(
+        "--daily",
+        action="store_true",
+        help="Poll daily instead of hourly usage",
+    )
+    sub["serve"].add_argument(
+        "--store",
+        type=pathlib.Path,
+        help="SQLite file to store usage in (default: usage.sqlite3 in the cache dir)",
+    )
+    sub["serve"].add_argument(
+        "--concurrency",
+        type=int,
+        help="Number of requests to run at the same time while polling (default: 4)",
+        default=4,
+    )
+    sub["serve"].add_argument(
+        "--rate",
+        type=float,
+        help="Maximum requests per second while polling (default: 2)",
+        default=2.0,
+    )
 
     # Parse the args
     args = parser.parse_args()
 
-    if not args.username or not args.password:
+    if not args.command:
         parser.print_help()
         sys.exit(1)
 
-    if not args.command:
+    # Only read the config when it's needed, so a broken profile can't get in the way
+    # of commands given a username and password
+    args.profiles = None
+    use_profile = args.command not in ("fleet", "rollup") and not args.username and not args.password
+    if args.command == "fleet" or use_profile:
+        from mytpu import config
+
+        if args.config or os.path.exists(config.DEFAULT_PATH):
+            try:
+                args.profiles = config.load_profiles(args.config)
+                if use_profile:
+                    profile = config.get_profile(args.profiles, args.profile)
+                    args.username, args.password = profile.username, profile.password
+            except ValueError as e:
+                parser.error(str(e))
+        elif args.command == "fleet":
+            print("fleet needs a config file", file=sys.stderr)
+            sys.exit(1)
+
+    if args.command not in ("fleet", "rollup") and (not args.username or not args.password):
         parser.print_help()
         sys.exit(1)
 
-    meters = set()
-    for meter in args.meters.lower().split(','):
-        if meter == 'all':
-            meters = {'P', 'W'}
-            break
-        elif meter == 'power':
-            meters.add('P')
-        elif meter == 'water':
-            meters.add('W')
-        elif re.match(r'^\d+$', meter):
-            meters.add(meter)
-        else:
-            print(f"Invalid meter: {args.meters}", file=sys.stderr)
-            sys.exit(1)
-    args.meters = meters
+    from mytpu.parse import parse_accounts, parse_meters
+
+    try:
+        args.meters = parse_meters(args.meters)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    args.account = parse_accounts(args.account)
+
+    if args.command == "usage" and (args.stream or args.incremental):
+        args.format = args.format or "ndjson"
+    if args.command == "usage":
+        if args.format and args.concurrency is not None:
+            parser.error("--concurrency can't be used with --format; streamed meters are fetched one at a time")
+        args.concurrency = args.concurrency or 4
+    if args.command == "usage" and args.incremental:
+        args.to_date = args.to_date or datetime.date.today()
+
+    if args.command == "usage":
+        # dates are always 12:00 to 11:59
+        args.window = (
+            f"{args.from_date:%Y-%m-%d} 12:00",
+            f"{args.to_date or args.from_date:%Y-%m-%d} 11:59",
+        )
 
     return args
 
 
-def list_meters(tpu: MyTPU, args: argparse.Namespace):
+def get_customers(tpu: "MyTPU", args: argparse.Namespace) -> List["CustomerResponse"]:
+    """
+    Customer info for the accounts selected with --account.
+    """
+    if not args.account:
+        return [tpu.customer()]
+    if args.account == 'all':
+        return list(tpu.customers().values())
+    return [tpu.customer(account_number) for account_number in args.account]
+
+
+def get_meters(tpu: "MyTPU", args: argparse.Namespace) -> List["Service"]:
+    """
+    All requested meters (services) on the selected accounts. The meter registry is
+    saved for the next run if any accounts had to be loaded for it.
+    """
+    registry = tpu.registry
+    before = (len(registry.contexts), registry.complete)
+    meters = tpu.meters(args.meters, args.account)
+    if (len(registry.contexts), registry.complete) != before and not args.replay:
+        from mytpu.registry import RegistryCache
+
+        RegistryCache().save(tpu.username, registry)
+    return meters
+
+
+def list_meters(tpu: "MyTPU", args: argparse.Namespace):
     """
     List all requested meters (services) on the account.
     """
-    services = tpu.customer().accountSummaryType.get_meters(args.meters, True)
+    services = get_meters(tpu, args)
     for service in services:
         print(f"{service.friendly_meter_type}: {service.meterNumber}")
 
 
-def main():
+def stream_usage(tpu: "MyTPU", args: argparse.Namespace):
+    """
+    Writes usage in args.format, one record at a time as each response is decoded, so
+    memory use stays flat no matter how long the date range is. Meters are fetched one
+    at a time.
 
+    With --incremental, each meter starts from its watermark, only new records are
+    written, and the watermarks are advanced once all the output has been written.
+    """
+    from mytpu.export import make_writer, parse_columns
+
+    export = None
+    if args.incremental:
+        from mytpu.watermark import IncrementalExport, Watermarks
+
+        export = IncrementalExport(Watermarks(args.watermarks), args.overlap_days)
+
+    with make_writer(args.format, sys.stdout, parse_columns(args.columns)) as writer:
+        for meter in get_meters(tpu, args):
+            from_date, to_date = args.window
+            if export:
+                from_date = f"{export.start(meter.meterNumber, args.from_date):%Y-%m-%d} 12:00"
+            records = tpu.usage_stream(
+                context=None,
+                service=meter,
+                from_date=from_date,
+                to_date=to_date,
+                hourly=True,
+            )
+            if export:
+                records = export.new_records(meter.meterNumber, records)
+            for record in records:
+                record["meterNumber"] = meter.meterNumber
+                record["meterType"] = meter.friendly_meter_type
+                writer.write(record)
+    if export:
+        export.commit()
+
+
+def store_billing(store: "UsageStore", tpu: "MyTPU", meters: List["Service"]):
+    """
+    Records the billing cycle of each meter's account, for the cycle rollups.
+    """
+    for meter in meters:
+        store.set_billing(meter.meterNumber, *tpu.registry.bill_cycle(meter.meterNumber))
+
+
+def print_rollups(args: argparse.Namespace):
+    """
+    Writes the stored rollups of the selected meters in args.format, one row per period.
+    """
+    from mytpu.export import make_writer
+    from mytpu.rollup import COLUMNS
+    from mytpu.store import UsageStore
+
+    with UsageStore(args.store) as store, make_writer(args.format, sys.stdout, list(COLUMNS)) as writer:
+        for meter in store.meters():
+            if meter["serviceType"] not in args.meters and meter["meterNumber"] not in args.meters:
+                continue
+            for row in store.rollups(
+                meter["meterNumber"],
+                args.period,
+                args.from_date and f"{args.from_date}",
+                args.to_date and f"{args.to_date}",
+            ):
+                writer.write(row)
+
+
+def run_fleet(args: argparse.Namespace, tracer: "Tracer" = None):
+    """
+    Sync all due profiles from the config file, then print how each one went.
+    """
+    from mytpu.cache import TokenCache
+    from mytpu.fleet import Fleet, print_summary
+    from mytpu.store import UsageStore
+    from mytpu.transport import TransportPolicy
+
+    with UsageStore(args.store) as store:
+        fleet = Fleet(
+            args.profiles,
+            store,
+            concurrency=args.concurrency,
+            token_cache=None if args.no_token_cache else TokenCache(args.token_cache),
+            policy=TransportPolicy(
+                read_timeout=args.timeout, max_retries=args.max_retries, rate=args.rate_limit
+            ),
+            tracer=tracer,
+        )
+        results = fleet.run(force=args.force)
+    print_summary(results)
+    if any(result.error for result in results):
+        sys.exit(1)
+
+
+def main():
     args = get_args()
-    # Connect to the service and load the customer info (which is needed for other commands)
-    tpu = MyTPU(args.username, args.password)
-    customer = tpu.customer()
+    from mytpu.trace import Collector, LogHook, Tracer
+
+    tracer = Tracer()
+    if args.verbose:
+        tracer.add(LogHook())
+    collector = None
+    if args.timings:
+        collector = Collector()
+        tracer.add(collector)
+    profiler = None
+    if args.cprofile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run(args, tracer)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+            print(f"profile written to {args.cprofile}", file=sys.stderr)
+        if collector:
+            collector.report()
+
+
+def run(args: argparse.Namespace, tracer: "Tracer"):
+    if args.command == "fleet":
+        run_fleet(args, tracer)
+        return
+    if args.command == "rollup":
+        print_rollups(args)
+        return
+
+    from mytpu.api import MyTPU
+    from mytpu.backfill import Backfill
+    from mytpu.cache import ResponseCache, TokenCache
+    from mytpu.store import UsageStore
+    from mytpu.sync import sync
+    from mytpu.transport import POOL_SIZE, TransportPolicy
+    from mytpu.web import Poller, serve
+
+    # Connect to the service. Customer info is loaded when a command needs it, unless the
+    # meters saved by an earlier run cover the selected accounts.
+    token_cache = None if args.no_token_cache else TokenCache(args.token_cache)
+    policy = TransportPolicy(
+        read_timeout=args.timeout, max_retries=args.max_retries, rate=args.rate_limit
+    )
+    tpu = MyTPU(
+        args.username,
+        args.password,
+        token_cache=token_cache,
+        policy=policy,
+        # One connection per worker thread, so none of them wait on the pool
+        pool_size=max(getattr(args, "concurrency", 1), POOL_SIZE),
+        # The server runs for days, so keep its token fresh instead of logging in again
+        auto_refresh=args.command == "serve",
+        base_url=args.base_url,
+        tracer=tracer,
+        response_cache=(
+            ResponseCache(ttl=args.response_ttl, replay=args.replay)
+            if args.response_cache or args.replay
+            else None
+        ),
+    )
+    if not args.refresh_meters:
+        from mytpu.registry import RegistryCache
+
+        # Saved contexts are structured the same way as the client's own responses
+        tpu.registry = RegistryCache().load(args.username, lazy=tpu.lazy_models) or tpu.registry
 
     match args.command:
+        case "account-summary" if args.account:
+            summaries = {
+                customer.accountContext.accountNumber: customer.unstructure()
+                for customer in get_customers(tpu, args)
+            }
+            print(json.dumps(summaries, sort_keys=True, indent=True))
         case "account-summary":
             print(json.dumps(tpu.customer().unstructure(), sort_keys=True, indent=True))
         case "list-meters":
             list_meters(tpu, args)
+        case "usage" if args.format:
+            stream_usage(tpu, args)
         case "usage":
-            meters = tpu.customer().accountSummaryType.get_meters(args.meters, True)
+            meters = get_meters(tpu, args)
             meter_usage = {}
             # usage = tpu.usage(
             #     context=customer.accountContext,
@@ -117,24 +670,96 @@ def main():
             #     hourly=False, 
             # )
             # print(json.dumps(usage, sort_keys=True, indent=2))
-            for meter in meters:
-                usage = tpu.usage(
-                    context=customer.accountContext,
-                    service=meter,
-                    # No actual difference in results with the different hours
-                    # from_date="2022-09-01 10:59",  # 15-min interval?
-                    from_date="2022-09-01 12:00",  # hourly
-                    to_date="2022-09-01 11:59",
-                    hourly=True, 
-                )
+            meters = {meter.meterNumber: meter for meter in meters}
+            results = tpu.usage_many(
+                context=None,
+                # No actual difference in results with the different hours
+                # from "2022-09-01 10:59" (15-min interval?) vs "2022-09-01 12:00" (hourly)
+                windows=[(meter, *args.window) for meter in meters.values()],
+                hourly=True,
+                concurrency=args.concurrency,
+            )
+            for meter_number, _, usage in results:
                 # print(json.dumps(usage, sort_keys=True, indent=2))
                 if 'history' not in usage:
                     usage = {'unexpectedResult': usage}
-                usage['meterNumber'] = meter.meterNumber
-                usage['meterType'] = meter.friendly_meter_type
-                meter_usage[meter.meterNumber] = usage
+                usage['meterNumber'] = meter_number
+                usage['meterType'] = meters[meter_number].friendly_meter_type
+                meter_usage[meter_number] = usage
             print(json.dumps(meter_usage, sort_keys=True, indent=2))
 
+        case "backfill":
+            meters = {meter.meterNumber: meter for meter in get_meters(tpu, args)}
+            backfill = Backfill(
+                tpu,
+                None,
+                hourly=not args.daily,
+                window_days=args.window_days,
+                concurrency=args.concurrency,
+                rate=args.rate,
+                checkpoint_dir=args.checkpoint_dir,
+            )
+            if args.format:
+                from mytpu.export import make_writer, parse_columns
+
+                # Each meter is written as soon as all of its windows are in
+                with make_writer(args.format, sys.stdout, parse_columns(args.columns)) as writer:
+                    for meter_number, records in backfill.iter_run(
+                        meters.values(), args.from_date, args.to_date
+                    ):
+                        for record in records:
+                            record["meterNumber"] = meter_number
+                            record["meterType"] = meters[meter_number].friendly_meter_type
+                            writer.write(record)
+                return
+            history = backfill.run(meters.values(), args.from_date, args.to_date)
+            print(
+                json.dumps(
+                    {
+                        meter_number: {
+                            "meterNumber": meter_number,
+                            "meterType": meters[meter_number].friendly_meter_type,
+                            "history": records,
+                        }
+                        for meter_number, records in history.items()
+                    },
+                    sort_keys=True,
+                    indent=2,
+                )
+            )
+        case "sync":
+            meters = get_meters(tpu, args)
+            with UsageStore(args.store) as store:
+                store_billing(store, tpu, meters)
+                added = sync(
+                    tpu,
+                    None,
+                    meters,
+                    store,
+                    since=args.since,
+                    hourly=not args.daily,
+                    concurrency=args.concurrency,
+                    rate=args.rate,
+                )
+            for meter_number, count in added.items():
+                print(f"{meter_number}: {count} records", file=sys.stderr)
+        case "serve":
+            meters = get_meters(tpu, args)
+            with UsageStore(args.store) as store:
+                store_billing(store, tpu, meters)
+                poller = Poller(
+                    tpu,
+                    meters,
+                    store,
+                    every=args.every,
+                    since=args.since,
+                    hourly=not args.daily,
+                    concurrency=args.concurrency,
+                    rate=args.rate,
+                )
+                serve(poller, args.host, args.port, args.metrics_interval)
+            tpu.close()
+
     # account = tpu.get_all_accounts()[0]
     # print(json.dumps(customer.unstructure(), sort_keys=True, indent=4))
 
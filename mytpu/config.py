@@ -0,0 +1,129 @@
+"""
+Config file with one or more login profiles, e.g.
+
+    [DEFAULT]
+    meters = all
+    every = 60
+
+    [home]
+    username = me@example.com
+    password_env = HOME_TPU_PASSWORD
+
+    [rental]
+    username = landlord@example.com
+    password = hunter2
+    account = all
+    meters = water
+    every = 15
+
+Each section is a profile; values in [DEFAULT] apply to all of them. `every` is the
+number of minutes between runs of that profile by `mytpu fleet`.
+
+A profile that can't be used (no password, a bad value) is still loaded, with its
+`error` set, so that one broken profile doesn't stop the others from running.
+"""
+import configparser
+from datetime import date, timedelta
+import os
+from typing import List, Optional, Set, Union
+
+from attr import define, field
+
+from mytpu.parse import parse_accounts, parse_meters
+
+DEFAULT_PATH = os.path.join(
+    os.getenv("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config"),
+    "mytpu",
+    "config.ini",
+)
+
+
+@define(auto_attribs=True, slots=True, kw_only=True)
+class Profile:
+    name: str
+    username: str
+    password: str
+    meters: Set[str] = field(factory=lambda: {'P', 'W'})
+    accounts: Union[None, str, List[str]] = field(default=None)
+    """ Minutes between runs in `mytpu fleet` """
+    every: float = field(default=60)
+    hourly: bool = field(default=True)
+    """ Days of history to fetch for meters with nothing stored yet """
+    since_days: int = field(default=30)
+    """ Why the profile can't be used, if it can't """
+    error: Optional[str] = field(default=None)
+
+    @property
+    def since(self) -> date:
+        return date.today() - timedelta(days=self.since_days)
+
+
+def load_profiles(path: str = None) -> List[Profile]:
+    """
+    Every profile in the config file. Raises ValueError if the file can't be read at
+    all; problems with a single profile are left in its `error`.
+    """
+    path = path or DEFAULT_PATH
+    # No interpolation, so passwords can contain %
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        with open(path) as file:
+            parser.read_file(file)
+    except (OSError, configparser.Error) as e:
+        raise ValueError(f"can't read config {path}: {e}") from e
+    profiles = []
+    for name in parser.sections():
+        try:
+            profiles.append(_load_profile(name, parser[name]))
+        except ValueError as e:
+            profiles.append(
+                Profile(
+                    name=name,
+                    username=parser[name].get("username", ""),
+                    password="",
+                    error=f"profile {name}: {e}",
+                )
+            )
+    return profiles
+
+
+def _load_profile(name: str, section: configparser.SectionProxy) -> Profile:
+    password = section.get("password")
+    if not password and section.get("password_env"):
+        password = os.getenv(section["password_env"])
+        if not password:
+            raise ValueError(f"${section['password_env']} is not set")
+    if not section.get("username") or not password:
+        raise ValueError("needs a username and password")
+    return Profile(
+        name=name,
+        username=section["username"],
+        password=password,
+        meters=parse_meters(section.get("meters", "all")),
+        accounts=parse_accounts(section.get("account")),
+        every=section.getfloat("every", 60),
+        hourly=section.getboolean("hourly", True),
+        since_days=section.getint("since_days", 30),
+    )
+
+
+def get_profile(profiles: List[Profile], name: str = None) -> Profile:
+    """
+    The profile called `name`, or the only profile if there is just one. Raises
+    ValueError if there's no such profile or it can't be used.
+    """
+    if name is None:
+        if len(profiles) != 1:
+            raise ValueError(
+                "the config has several profiles; pick one with --profile"
+                if profiles
+                else "the config has no profiles"
+            )
+        profile = profiles[0]
+    else:
+        profile = next((profile for profile in profiles if profile.name == name), None)
+        if profile is None:
+            raise ValueError(f"no profile named {name}")
+    if profile.error:
+        raise ValueError(profile.error)
+    return profile
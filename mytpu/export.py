@@ -0,0 +1,114 @@
+"""
+Writers that emit usage records one row at a time, so output can be piped into other
+tools without building the whole result in memory first.
+
+    with make_writer("csv", sys.stdout, columns=["meterNumber", "readDateTime", "scaledRead"]) as writer:
+        for record in tpu.usage_stream(None, meter, from_date, to_date, hourly=True):
+            writer.write(dict(record, meterNumber=meter.meterNumber))
+"""
+import csv
+import json
+from typing import Any, Dict, List, Optional, TextIO
+
+""" Columns written by the CSV writer when none are selected """
+DEFAULT_COLUMNS = [
+    "meterNumber",
+    "meterType",
+    "readDateTime",
+    "usageDate",
+    "usageConsumptionValue",
+    "usageDemandValue",
+    "scaledRead",
+    "uom",
+]
+
+
+def parse_columns(value: Optional[str]) -> Optional[List[str]]:
+    """
+    Splits a comma separated list of column names (None or "" for the default).
+    """
+    if not value:
+        return None
+    return [column.strip() for column in value.split(",") if column.strip()]
+
+
+class Writer:
+    """
+    Writes one row per usage record (a raw `Usage` dict, usually with meterNumber and
+    meterType added). With `columns`, only those keys are written, in that order.
+    """
+
+    def __init__(self, file: TextIO, columns: List[str] = None):
+        self.file: TextIO = file
+        self.columns: Optional[List[str]] = columns
+        """ Rows written so far """
+        self.count: int = 0
+
+    def row(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        if self.columns is None:
+            return record
+        return {column: record.get(column) for column in self.columns}
+
+    def write(self, record: Dict[str, Any]):
+        raise NotImplementedError
+
+    def close(self):
+        self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class NdjsonWriter(Writer):
+    """
+    One JSON object per line.
+    """
+
+    def write(self, record: Dict[str, Any]):
+        self.file.write(json.dumps(self.row(record), sort_keys=self.columns is None) + "\n")
+        self.count += 1
+
+
+class JsonWriter(Writer):
+    """
+    A single JSON array of rows, written incrementally.
+    """
+
+    def write(self, record: Dict[str, Any]):
+        self.file.write("[\n" if not self.count else ",\n")
+        self.file.write(json.dumps(self.row(record), sort_keys=self.columns is None))
+        self.count += 1
+
+    def close(self):
+        self.file.write("\n]\n" if self.count else "[]\n")
+        super().close()
+
+
+class CsvWriter(Writer):
+    """
+    CSV with a header row. Writes DEFAULT_COLUMNS unless columns are selected.
+    """
+
+    def __init__(self, file: TextIO, columns: List[str] = None):
+        super().__init__(file, columns or DEFAULT_COLUMNS)
+        self._csv = csv.writer(file)
+        self._csv.writerow(self.columns)
+
+    def write(self, record: Dict[str, Any]):
+        self._csv.writerow([record.get(column) for column in self.columns])
+        self.count += 1
+
+
+FORMATS = {
+    "ndjson": NdjsonWriter,
+    "csv": CsvWriter,
+    "json": JsonWriter,
+}
+
+
+def make_writer(format: str, file: TextIO, columns: List[str] = None) -> Writer:
+    assert format in FORMATS, f"unknown format {format}; expected one of {', '.join(FORMATS)}"
+    return FORMATS[format](file, columns)
@@ -0,0 +1,127 @@
+"""
+OpenMetrics (Prometheus) exposition of meter readings and client health.
+
+The text is re-rendered in a background thread from what the Poller and the client
+already have in memory, so a scrape never causes a portal request and never waits on
+one; it is served as `/metrics` by `mytpu serve`.
+"""
+import sys
+import threading
+from typing import Dict, Iterator, List, Optional
+
+from mytpu.transport import TransportMetrics
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+""" Metric name and help text for each `Usage` field exported per meter """
+READING_FIELDS = {
+    "scaledRead": ("mytpu_meter_scaled_read", "Latest cumulative meter read"),
+    "usageConsumptionValue": ("mytpu_meter_consumption", "Consumption in the latest interval"),
+    "usageDemandValue": ("mytpu_meter_demand", "Demand in the latest interval"),
+}
+
+
+def _labels(**labels: str) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in labels.values()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def _family(name: str, kind: str, help: str) -> List[str]:
+    return [f"# TYPE {name} {kind}", f"# HELP {name} {help}"]
+
+
+def render(poller) -> str:
+    """
+    OpenMetrics text for a `mytpu.web.Poller` and its client.
+    """
+    return "\n".join(_lines(poller)) + "\n"
+
+
+def _lines(poller) -> Iterator[str]:
+    services = {service.meterNumber: service for service in poller.services}
+    latest: Dict[str, dict] = poller.latest
+    for field, (name, help) in READING_FIELDS.items():
+        yield from _family(name, "gauge", help)
+        for meter_number, record in sorted(latest.items()):
+            if record.get(field) is None:
+                continue
+            service = services[meter_number]
+            labels = _labels(
+                meter=meter_number, meter_type=service.friendly_meter_type, uom=service.uom or ""
+            )
+            yield f"{name}{labels} {record[field]}"
+
+    tpu = poller.tpu
+    metrics: TransportMetrics = tpu.metrics
+    counts = metrics.snapshot()
+    for name, help in (
+        ("logins", "Password logins to the portal"),
+        ("refreshes", "Access tokens renewed with the refresh token"),
+        ("requests", "Http requests sent, including retries"),
+        ("retries", "Requests retried after a timeout, connection error or server error"),
+        ("errors", "Connection errors and timeouts"),
+        ("throttled", "429 responses from the portal"),
+        ("rate_limited", "Requests delayed by the client's own rate limit"),
+        ("coalesced", "Calls answered by an identical call that was already in flight"),
+    ):
+        yield from _family(f"mytpu_{name}", "counter", help)
+        yield f"mytpu_{name}_total {counts[name]}"
+
+    token_age: Optional[float] = tpu.token_age
+    if token_age is not None:
+        yield from _family("mytpu_token_age_seconds", "gauge", "Age of the current access token")
+        yield f"mytpu_token_age_seconds {token_age:.3f}"
+
+    yield from _family(
+        "mytpu_request_duration_seconds", "histogram", "Time to a response, by portal path"
+    )
+    for path, (buckets, total) in sorted(metrics.latency().items()):
+        cumulative = 0
+        for bound, count in zip(metrics.LATENCY_BUCKETS + ("+Inf",), buckets):
+            cumulative += count
+            yield f"mytpu_request_duration_seconds_bucket{_labels(path=path, le=bound)} {cumulative}"
+        yield f"mytpu_request_duration_seconds_count{_labels(path=path)} {cumulative}"
+        yield f"mytpu_request_duration_seconds_sum{_labels(path=path)} {total:.6f}"
+
+    if poller.last_poll:
+        yield from _family("mytpu_last_poll_timestamp_seconds", "gauge", "When the last poll finished")
+        yield f"mytpu_last_poll_timestamp_seconds {poller.last_poll:.3f}"
+        yield from _family("mytpu_last_poll_success", "gauge", "1 if the last poll succeeded")
+        yield f"mytpu_last_poll_success {0 if poller.last_error else 1}"
+    yield "# EOF"
+
+
+class Exporter:
+    """
+    Keeps the rendered metrics text up to date every `interval` seconds.
+    """
+
+    def __init__(self, poller, interval: float = 15):
+        self.poller = poller
+        self.interval: float = interval
+        """ The latest rendering, which scrapes are served from """
+        self.text: str = render(poller)
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="mytpu-exporter", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.text = render(self.poller)
+            except Exception as e:
+                # Keep serving the previous rendering
+                print(f"rendering metrics failed: {e}", file=sys.stderr)
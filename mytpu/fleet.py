@@ -0,0 +1,150 @@
+"""
+Runs `sync` for many login profiles in one process.
+
+Each profile gets its own MyTPU client (and so its own session cookies and cached
+tokens), but they all share one connection pool, one usage store, and a global limit on
+how many profiles run at once. A profile that fails is reported without affecting the
+others.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import time
+import traceback
+from typing import Dict, List, Optional
+
+from attr import define, field
+
+from mytpu.api import MyTPU
+from mytpu.cache import TokenCache, default_cache_dir, locked, read_json, write_json
+from mytpu.config import Profile
+from mytpu.store import UsageStore
+from mytpu.sync import sync
+from mytpu.trace import Tracer
+from mytpu.transport import TransportPolicy
+
+
+@define(auto_attribs=True, slots=True, kw_only=True)
+class ProfileResult:
+    name: str
+    ok: bool = field(default=False)
+    skipped: bool = field(default=False)
+    error: Optional[str] = field(default=None)
+    meters: int = field(default=0)
+    records: int = field(default=0)
+    requests: int = field(default=0)
+    seconds: float = field(default=0.0)
+
+
+class Fleet:
+    def __init__(
+        self,
+        profiles: List[Profile],
+        store: UsageStore,
+        concurrency: int = 8,
+        token_cache: TokenCache = None,
+        policy: TransportPolicy = None,
+        state_path: str = None,
+        tracer: Tracer = None,
+    ):
+        self.profiles: List[Profile] = profiles
+        self.store: UsageStore = store
+        """ Maximum number of profiles (and so portal requests) in flight at once """
+        self.concurrency: int = concurrency
+        self.token_cache: TokenCache = token_cache
+        self.policy: TransportPolicy = policy
+        """ Shared by every profile's client """
+        self.tracer: Tracer = tracer
+        """ Last successful run time for each profile """
+        self.state_path: str = state_path or os.path.join(default_cache_dir(), "fleet.json")
+
+    def due(self, now: float = None) -> List[Profile]:
+        """
+        Profiles whose `every` minutes have passed since their last successful run.
+        """
+        now = now or time.time()
+        with locked(self.state_path, shared=True):
+            last_runs = read_json(self.state_path, {})
+        return [
+            profile
+            for profile in self.profiles
+            if last_runs.get(profile.name, 0) + profile.every * 60 <= now
+        ]
+
+    def run(self, force: bool = False) -> List[ProfileResult]:
+        """
+        Syncs every due profile (or every profile, with `force`).
+        """
+        due = self.profiles if force else self.due()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results: Dict[str, ProfileResult] = {
+                result.name: result for result in pool.map(self.run_profile, due)
+            }
+        finished = [result.name for result in results.values() if result.ok]
+        if finished:
+            with locked(self.state_path):
+                last_runs = read_json(self.state_path, {})
+                last_runs.update(dict.fromkeys(finished, time.time()))
+                write_json(self.state_path, last_runs)
+        return [
+            results.get(profile.name) or ProfileResult(name=profile.name, skipped=True)
+            for profile in self.profiles
+        ]
+
+    def run_profile(self, profile: Profile) -> ProfileResult:
+        if profile.error:
+            return ProfileResult(name=profile.name, error=profile.error)
+        result = ProfileResult(name=profile.name)
+        start = time.perf_counter()
+        tpu = MyTPU(
+            profile.username,
+            profile.password,
+            token_cache=self.token_cache,
+            policy=self.policy,
+            pool_size=self.concurrency,
+            shared_pool=True,
+            tracer=self.tracer,
+        )
+        try:
+            meters = tpu.meters(profile.meters, profile.accounts, concurrency=1)
+            result.meters = len(meters)
+            for meter in meters:
+                self.store.set_billing(meter.meterNumber, *tpu.registry.bill_cycle(meter.meterNumber))
+            # One request at a time per profile; the fleet's concurrency is the global limit
+            added = sync(
+                tpu,
+                None,
+                meters,
+                self.store,
+                since=profile.since,
+                hourly=profile.hourly,
+                concurrency=1,
+                rate=None,
+            )
+            result.records = sum(added.values())
+            result.ok = True
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            result.requests = tpu.metrics["requests"]
+            result.seconds = time.perf_counter() - start
+            tpu.close()
+        return result
+
+
+def print_summary(results: List[ProfileResult], file=sys.stderr):
+    """
+    Prints a table of how each profile's run went.
+    """
+    width = max([len(result.name) for result in results] + [7])
+    print(f"{'profile':{width}}  status   meters  records  requests  seconds", file=file)
+    for result in results:
+        status = "skipped" if result.skipped else "ok" if result.ok else "FAILED"
+        print(
+            f"{result.name:{width}}  {status:7}  {result.meters:6}  {result.records:7}"
+            f"  {result.requests:8}  {result.seconds:7.2f}",
+            file=file,
+        )
+        if result.error:
+            print(f"{'':{width}}  {result.error}", file=file)
@@ -2,18 +2,24 @@
 Classes built based on the data that I've scraped.
 Untyped values mean I haven't yet seen them contain data other than null or []
 """
-from tkinter import N
-from typing import Any, ForwardRef, Generator, List, Optional, Set, Type, TypeVar, Dict, Union
+import copy
+import inspect
+import threading
+from typing import TYPE_CHECKING, Any, Callable, ForwardRef, Generator, List, Optional, Set, Type, TypeVar, Dict, Union, get_args, get_origin
 import json
+import attr
 from attr import define, field
-# from cattr import GenConverter
-import cattr
+
+if TYPE_CHECKING:
+    from cattr import GenConverter
 
 CustomerID = str  # string value of the numeric(?) customer id
 AccountNumber = str  # string value of the numeric(?) account number
 PersonID = str  # string value of the numeric(?) person id
 UserID = str  # username in all caps (I guess their user names are not case sensitive)
 
+SERVICE_TYPES = {"P", "W"}  # Service.serviceType values: power and water
+
 # Not in love with this name (maybe ModelClass instead?) but it works for now.
 ModelType = TypeVar("ModelType", bound="Model")
 
@@ -34,13 +40,25 @@ class Model:
         Returns:
             T: Instance of the model (sub)class
         """
-        return cattr.structure(data, cls)
+        return get_converter().structure(data, cls)
 
-    def as_json(self) -> str:
-        return json.dumps(self.unstructure)
+    @classmethod
+    def lazy(cls: Type[ModelType], data: Dict[str, Any]) -> ModelType:
+        """
+        Like from_dict(), but each field is only structured when it is first read (see
+        LazyModel), so big responses cost only what is used.
+        """
+        return LazyModel(cls, data)
 
-    def unstructure(self) -> Any:
-        return cattr.unstructure(self)
+    def as_json(self, omit_none: bool = False) -> str:
+        return json.dumps(self.unstructure(omit_none))
+
+    def unstructure(self, omit_none: bool = False) -> Any:
+        """
+        Converts the model back into plain dicts/lists, optionally leaving out
+        fields that are None (which is most of them).
+        """
+        return get_converter(omit_none).unstructure(self)
 
 
 @define(auto_attribs=True, slots=True, kw_only=True)
@@ -383,6 +401,11 @@ class AccountSummary(Model):
     webServiceDD: Any = field(default=None)
 
     def get_meters(self, types: Set[str], submeters: bool = True, _submeters: List[Service] = None) -> Generator[Service,None,None]:
+        """
+        Walks servicesForGraph (and optionally their subMeters) for services whose
+        serviceType or meterNumber is in `types`. See mytpu.registry.MeterRegistry for
+        indexed lookups.
+        """
         services = self.servicesForGraph
         if submeters and _submeters:
             services = _submeters
@@ -444,6 +467,29 @@ class AccountContext(Model):
     userID: UserID = field(default=None)
     validated: Any = field(default=None)
 
+    @classmethod
+    def from_account(cls, account: Account, username: str = None) -> "AccountContext":
+        """
+        Builds the context used to ask for a specific account's info, from what
+        checkmultipleaccts tells us about it.
+        """
+        return cls(
+            access=account.access,
+            accountAlreadyRegistrd=account.accountAlreadyRegistrd,
+            accountNickName=account.accountNickName,
+            accountNumber=account.accountNumber,
+            acctStatus=account.accountStatus,
+            firstName=account.firstName,
+            lastName=account.lastName,
+            linkedAccounts=account.linkedAccounts,
+            personId=account.personId,
+            serviceAddress=account.serviceAddress,
+            serviceAddressLine1=account.serviceAddressLine1,
+            sharedAccessType=account.sharedAccessType,
+            userID=username.upper() if username else None,
+            validated=account.validated,
+        )
+
 
 @define(auto_attribs=True, slots=True, kw_only=True)
 class CustomerResponse(Response):
@@ -515,8 +561,285 @@ class Usage(Model):
     usageLowTemp: float = field(default=None)  # 0.0
 
 
+def usage_timestamp(data: Dict[str, Any], hourly: bool = None) -> Optional[str]:
+    """
+    Timestamp of a raw `Usage` record: readDateTime for hourly data, otherwise the
+    usage (or read) date. These sort chronologically as strings.
+
+    With `hourly` set, only readDateTime counts: every hour of a day has the same
+    usageDate, so falling back to it would give all of them the same key.
+    """
+    if hourly:
+        return data.get("readDateTime")
+    return data.get("readDateTime") or data.get("usageDate") or data.get("readDate")
+
+
 @define(auto_attribs=True, slots=True, kw_only=True)
 class UsageResponse(Response):
     billedHistory: Union[List, None] = field(default=None)
     commercial: str = field(default=None)  # "N" or "Y" (solar net meter seems to get Y)
     history: List[Usage] = field(factory=list)
+
+
+def _model_classes(cls: Type[Model] = Model) -> Generator[Type[Model], None, None]:
+    for subclass in cls.__subclasses__():
+        # slots=True replaces each class, but the original may still be listed here
+        if attr.has(subclass):
+            yield subclass
+        yield from _model_classes(subclass)
+
+
+_PRIMITIVES = (str, int, float, bool)
+
+
+def _compile(name: str, lines: List[str], globs: Dict[str, Any]):
+    exec(compile("\n".join(lines), f"<mytpu {name}>", "exec"), globs)
+    return globs[name.split()[0]]
+
+
+def make_structure_fn(cls: Type[Model], converter: "GenConverter"):
+    """
+    Generates a function that builds `cls` from a dict with one straight-line
+    expression per field. TPU sends null for nearly every field and most values
+    already have the right type, so both of those cases skip the conversion call.
+    Unknown keys are ignored, and missing keys get the field's default.
+    """
+    globs = {"_cls": cls}
+    lines = ["def structure(o, _=None):", "    g = o.get", "    kw = {}"]
+    args = []
+    for a in attr.fields(cls):
+        name = a.name
+        globs[f"_t_{name}"] = a.type
+        if a.type is Any:
+            expr = f"g({name!r})"
+        elif a.type in _PRIMITIVES:
+            expr = f"(v if (v := g({name!r})) is None or v.__class__ is _t_{name} else _t_{name}(v))"
+        else:
+            globs[f"_h_{name}"] = converter.get_structure_hook(a.type)
+            expr = f"(None if (v := g({name!r})) is None else _h_{name}(v, _t_{name}))"
+        if a.default is None:
+            args.append(f"        {name}={expr},")
+        else:
+            # Fields with a factory default only get passed in when present
+            lines.append(f"    if {name!r} in o: kw[{name!r}] = {expr}")
+    lines += ["    return _cls(", *args, "        **kw,", "    )"]
+    return _compile(f"structure {cls.__name__}", lines, globs)
+
+
+def make_unstructure_fn(cls: Type[Model], converter: "GenConverter", omit_none: bool = False):
+    """
+    Generates a function that converts an instance of `cls` back into a dict,
+    optionally leaving out fields that are None.
+    """
+    globs = {}
+    lines = ["def unstructure(i):", "    res = {}"]
+    for a in attr.fields(cls):
+        name = a.name
+        if a.type is Any or a.type in _PRIMITIVES:
+            expr = "v"
+        else:
+            globs[f"_h_{name}"] = converter.get_unstructure_hook(a.type)
+            expr = f"_h_{name}(v)"
+        lines.append(f"    v = i.{name}")
+        if omit_none:
+            lines.append(f"    if v is not None: res[{name!r}] = {expr}")
+        elif expr == "v":
+            lines.append(f"    res[{name!r}] = v")
+        else:
+            lines.append(f"    res[{name!r}] = None if v is None else {expr}")
+    lines.append("    return res")
+    return _compile(f"unstructure {cls.__name__}", lines, globs)
+
+
+def make_converter(omit_none: bool = False) -> "GenConverter":
+    """
+    Builds a converter with structure/unstructure functions generated up front for
+    every model class, rather than going through cattr's generic dispatch.
+
+    Args:
+        omit_none (bool): leave fields that are None out of unstructured output
+
+    Returns:
+        GenConverter: the converter
+    """
+    from cattr import GenConverter
+
+    converter = GenConverter()
+
+    # Nested models (and Service.subMeters, which refers to itself) look up their hooks
+    # when the parent's function is generated, so register stubs that dispatch to the
+    # generated functions first.
+    structure_fns = {}
+    unstructure_fns = {}
+    classes = set(_model_classes())
+    for cls in classes:
+        attr.resolve_types(cls)
+        converter.register_structure_hook(cls, lambda data, cls: structure_fns[cls](data))
+        converter.register_unstructure_hook(cls, lambda obj: unstructure_fns[obj.__class__](obj))
+    for cls in classes:
+        structure_fns[cls] = make_structure_fn(cls, converter)
+        unstructure_fns[cls] = make_unstructure_fn(cls, converter, omit_none)
+    return converter
+
+
+_converters: Dict[bool, "GenConverter"] = {}
+_converters_lock = threading.Lock()
+
+
+def get_converter(omit_none: bool = False) -> "GenConverter":
+    """
+    The converter for all model classes, built on first use: importing cattrs and
+    generating the functions for every class is most of the cost of importing this
+    module otherwise.
+    """
+    converter = _converters.get(omit_none)
+    if converter is None:
+        with _converters_lock:
+            converter = _converters.get(omit_none)
+            if converter is None:
+                converter = _converters[omit_none] = make_converter(omit_none)
+    return converter
+
+
+_lazy_fields: Dict[Type[Model], Dict[str, Callable[[Dict[str, Any]], Any]]] = {}
+
+
+def _lazy_converter(type_: Any) -> Callable[[Any], Any]:
+    """
+    Converts a non-null raw value to `type_`, wrapping nested models (and lists of
+    them) in LazyModel instead of structuring them.
+    """
+    if type_ is Any:
+        return lambda value: value
+    if type_ in _PRIMITIVES:
+        return lambda value: value if value.__class__ is type_ else type_(value)
+    if isinstance(type_, type) and issubclass(type_, Model):
+        return lambda value: LazyModel(type_, value)
+    args = [arg for arg in get_args(type_) if arg is not type(None)]
+    if get_origin(type_) is Union and len(args) == 1:
+        return _lazy_converter(args[0])
+    if get_origin(type_) is list:
+        item = args[0] if args else Any
+        if item is Any:
+            return list
+        if isinstance(item, type) and issubclass(item, Model):
+            return lambda value: [LazyModel(item, i) for i in value]
+    return lambda value: get_converter().structure(value, type_)
+
+
+def _lazy_field(a: attr.Attribute) -> Callable[[Dict[str, Any]], Any]:
+    name = a.name
+    convert = _lazy_converter(a.type)
+    if a.default is attr.NOTHING:
+        def default():
+            # from_dict() refuses these too
+            raise TypeError(f"missing required field {name}")
+    elif isinstance(a.default, attr.Factory):
+        default = a.default.factory
+    else:
+        default = lambda: a.default
+
+    def structure(data: Dict[str, Any]) -> Any:
+        if name not in data:
+            return default()
+        value = data[name]
+        return None if value is None else convert(value)
+
+    return structure
+
+
+def lazy_fields(cls: Type[Model]) -> Dict[str, Callable[[Dict[str, Any]], Any]]:
+    """
+    A function per field of `cls` that structures it from the raw dict, built on first use.
+    """
+    fields = _lazy_fields.get(cls)
+    if fields is None:
+        attr.resolve_types(cls)
+        fields = _lazy_fields.setdefault(cls, {a.name: _lazy_field(a) for a in attr.fields(cls)})
+    return fields
+
+
+class LazyModel:
+    """
+    Stands in for an instance of a model class built from a raw dict. Each field is
+    structured the first time it is read and then kept, and nested models come back as
+    LazyModels too, so reading `customer.accountContext` never builds the AccountSummary
+    next to it.
+
+    It passes isinstance() checks for the model class and has its methods and properties,
+    and unstructure() gives the same result as for a fully structured instance. Copying
+    or pickling it gives a fully structured instance.
+    """
+
+    __slots__ = ("_cls", "_data", "_values")
+
+    def __init__(self, cls: Type[Model], data: Dict[str, Any]):
+        object.__setattr__(self, "_cls", cls)
+        object.__setattr__(self, "_data", data)
+        object.__setattr__(self, "_values", {})
+
+    @property
+    def __class__(self):
+        return self._cls
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            # Also keeps copy/pickle, which probe an empty instance, from recursing
+            raise AttributeError(name)
+        values = self._values
+        if name in values:
+            return values[name]
+        structure = lazy_fields(self._cls).get(name)
+        if structure is None:
+            # Methods and properties of the model, bound to this proxy
+            attribute = inspect.getattr_static(self._cls, name)
+            if hasattr(attribute, "__get__"):
+                return attribute.__get__(self, self._cls)
+            return attribute
+        value = values[name] = structure(self._data)
+        return value
+
+    def __setattr__(self, name: str, value: Any):
+        assert name in lazy_fields(self._cls), f"{self._cls.__name__} has no field {name}"
+        self._values[name] = value
+
+    def __eq__(self, other: Any) -> bool:
+        return self._cls.__eq__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"<lazy {self._cls.__name__}: {len(self._values)} of {len(lazy_fields(self._cls))} fields structured>"
+
+    def __reduce_ex__(self, protocol: int):
+        return _eager(self).__reduce_ex__(protocol)
+
+    def __reduce__(self):
+        return _eager(self).__reduce__()
+
+    def __copy__(self) -> Model:
+        return _eager(self)
+
+    def __deepcopy__(self, memo: dict) -> Model:
+        return copy.deepcopy(_eager(self), memo)
+
+
+def _eager(value: Any) -> Any:
+    """
+    Builds the fully structured model (or list of them) for a LazyModel.
+    """
+    if type(value) is LazyModel:
+        cls = value._cls
+        return cls(**{name: _eager(getattr(value, name)) for name in lazy_fields(cls)})
+    if type(value) is list:
+        return [_eager(item) for item in value]
+    return value
+
+
+def __getattr__(name: str):
+    # `converter` and `converter_omit_none` used to be built at import time
+    if name == "converter":
+        return get_converter()
+    if name == "converter_omit_none":
+        return get_converter(omit_none=True)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
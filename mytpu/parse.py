@@ -0,0 +1,39 @@
+"""
+Parsing of the meter and account selections given on the command line or in a config
+profile. Standard library only, so the CLI can check its arguments without loading
+attrs or the client.
+"""
+import re
+from typing import List, Optional, Set, Union
+
+
+def parse_meters(value: str) -> Set[str]:
+    """
+    Converts a comma separated list of meter types or ids (e.g. all,power,water,11110123)
+    into the set of service types and meter numbers used by MyTPU.meters.
+    """
+    meters = set()
+    for meter in value.lower().split(','):
+        meter = meter.strip()
+        if meter == 'all':
+            return {'P', 'W'}
+        elif meter == 'power':
+            meters.add('P')
+        elif meter == 'water':
+            meters.add('W')
+        elif re.match(r'^\d+$', meter):
+            meters.add(meter)
+        else:
+            raise ValueError(f"Invalid meter: {value}")
+    return meters
+
+
+def parse_accounts(value: Optional[str]) -> Union[None, str, List[str]]:
+    """
+    None for the login's default account, "all", or a list of account numbers.
+    """
+    if not value:
+        return None
+    if value.lower() == 'all':
+        return 'all'
+    return [account.strip() for account in value.split(',')]
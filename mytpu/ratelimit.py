@@ -0,0 +1,48 @@
+"""
+Client-side rate limiting, so that parallel fetches don't get us throttled by the portal.
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that allows `rate` acquisitions per second on average,
+    with bursts of up to `burst` at once.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        assert rate > 0, "rate must be positive"
+        self.rate: float = rate
+        self.burst: int = max(burst, 1)
+        self._tokens: float = self.burst
+        self._updated: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Blocks until a token is available. Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def try_acquire(self) -> float:
+        """
+        Takes a token if one is available and returns 0; otherwise returns how long to
+        wait before trying again. For callers that can't block, like the asyncio client.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
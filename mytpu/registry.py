@@ -0,0 +1,276 @@
+"""
+Index of the meters on a login's accounts.
+
+`AccountSummary.get_meters` walks `servicesForGraph` and every `subMeters` tree each time
+it is called. A MeterRegistry walks each account once, when it is added, and keeps
+indexes by meterNumber, serviceType, meterType, account and parent/child submeter, so
+every lookup is a dict access.
+
+`services` and `servicesForGraph` describe the same meters with different details;
+a `servicesForGraph` entry's serviceContract is the serviceId of its `services`
+entry. The registry keeps each `servicesForGraph` entry as is (it is what usage
+requests are built from, so the request bodies match what the portal has always been
+sent, and the serviceType and meterType it is indexed by match what get_meters
+filters on), and alongside it a merged copy, with the fields it leaves null filled in
+from `services`, which is only returned by `details()`.
+
+The registry (with each account's context and billing cycle) can be saved with a
+RegistryCache, so later runs can make usage requests without loading the customer
+info again.
+"""
+import itertools
+import os
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import attr
+
+from mytpu.cache import default_cache_dir, locked, read_json, write_json
+from mytpu.models import AccountContext, AccountNumber, AccountSummary, CustomerResponse, Service
+
+
+def _merge(graph: Service, service: Optional[Service]) -> Service:
+    """
+    `graph` with its null fields filled in from the matching `services` entry.
+    """
+    values = {a.name: getattr(graph, a.name) for a in attr.fields(Service)}
+    if service is not None:
+        for name, value in values.items():
+            if value is None and name != "subMeters":
+                values[name] = getattr(service, name)
+    values["subMeters"] = None
+    return Service(**values)
+
+
+class MeterRegistry:
+    """ Format of to_dict(); saved registries in another format are ignored """
+    FORMAT = 2
+
+    def __init__(self):
+        """ servicesForGraph Service for each meterNumber, in the order get_meters() yields them """
+        self.meters: Dict[str, Service] = {}
+        """ Merged copy of each meter, for details() """
+        self._details: Dict[str, Service] = {}
+        """ Context of each added account """
+        self.contexts: Dict[AccountNumber, AccountContext] = {}
+        """ (billCycleCode, billDate) of each added account """
+        self.billing: Dict[AccountNumber, Tuple[Any, Any]] = {}
+        """ The login's default account, once it has been added """
+        self.default_account: Optional[AccountNumber] = None
+        """ Whether every account the login can see has been added """
+        self.complete: bool = False
+        """ time.time() when the registry was built """
+        self.built_at: float = time.time()
+
+        self._position: Dict[str, int] = {}
+        self._positions = itertools.count()
+        self._account: Dict[str, AccountNumber] = {}
+        self._parent: Dict[str, str] = {}
+        self._children: Dict[str, List[str]] = {}
+        self._by_service_type: Dict[str, List[str]] = {}
+        self._by_meter_type: Dict[str, List[str]] = {}
+        self._by_account: Dict[AccountNumber, List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.meters)
+
+    def __contains__(self, meter_number: str) -> bool:
+        return meter_number in self.meters
+
+    def __iter__(self) -> Iterator[Service]:
+        return iter(self.meters.values())
+
+    def add_account(self, account_number: AccountNumber, customer: CustomerResponse, default: bool = False):
+        """
+        Indexes the meters of one account's customer info, replacing any it had before.
+        """
+        summary: AccountSummary = customer.accountSummaryType
+        self.contexts[account_number] = customer.accountContext
+        self.billing[account_number] = (summary.billCycleCode, summary.billDate)
+        if default:
+            self.default_account = account_number
+        for meter_number in self._by_account.pop(account_number, []):
+            self._remove(meter_number)
+
+        # services entries (and their submeters) by serviceId
+        by_id: Dict[str, Service] = {}
+        stack = list(summary.services or [])
+        while stack:
+            service = stack.pop()
+            if service.serviceId:
+                by_id[service.serviceId] = service
+            stack += service.subMeters or []
+
+        # Pre-order walk, like get_meters
+        stack = [(service, None) for service in reversed(summary.servicesForGraph or [])]
+        while stack:
+            graph, parent = stack.pop()
+            self._add(account_number, graph, _merge(graph, by_id.get(graph.serviceContract)), parent)
+            stack += [(child, graph.meterNumber) for child in reversed(graph.subMeters or [])]
+
+    def _add(self, account_number: AccountNumber, meter: Service, details: Service, parent: Optional[str]):
+        meter_number = meter.meterNumber
+        if meter_number in self.meters:
+            self._remove(meter_number)
+        self.meters[meter_number] = meter
+        self._details[meter_number] = details
+        self._position[meter_number] = next(self._positions)
+        self._account[meter_number] = account_number
+        self._by_account.setdefault(account_number, []).append(meter_number)
+        self._by_service_type.setdefault(meter.serviceType, []).append(meter_number)
+        self._by_meter_type.setdefault(meter.meterType, []).append(meter_number)
+        if parent:
+            self._parent[meter_number] = parent
+            self._children.setdefault(parent, []).append(meter_number)
+
+    def _remove(self, meter_number: str):
+        meter = self.meters.pop(meter_number)
+        del self._details[meter_number]
+        del self._position[meter_number]
+        account_number = self._account.pop(meter_number)
+        for index, key in (
+            (self._by_account, account_number),
+            (self._by_service_type, meter.serviceType),
+            (self._by_meter_type, meter.meterType),
+        ):
+            if meter_number in index.get(key, []):
+                index[key].remove(meter_number)
+        parent = self._parent.pop(meter_number, None)
+        if meter_number in self._children.get(parent, []):
+            self._children[parent].remove(meter_number)
+        self._children.pop(meter_number, None)
+
+    def get(self, meter_number: str) -> Service:
+        return self.meters[meter_number]
+
+    def details(self, meter_number: str) -> Service:
+        """
+        The meter with the fields its servicesForGraph entry leaves null filled in from
+        `services`. Not for building requests; use get() for that.
+        """
+        return self._details[meter_number]
+
+    def account_number(self, meter_number: str) -> AccountNumber:
+        return self._account[meter_number]
+
+    def context(self, meter_number: str) -> AccountContext:
+        """
+        Context of the account a meter is on, for usage requests.
+        """
+        return self.contexts[self._account[meter_number]]
+
+    def bill_cycle(self, meter_number: str) -> Tuple[Any, Any]:
+        """
+        (billCycleCode, billDate) of the account a meter is on.
+        """
+        return self.billing[self._account[meter_number]]
+
+    def parent(self, meter_number: str) -> Optional[Service]:
+        parent = self._parent.get(meter_number)
+        return self.meters[parent] if parent else None
+
+    def children(self, meter_number: str) -> List[Service]:
+        return [self.meters[child] for child in self._children.get(meter_number, [])]
+
+    def by_service_type(self, service_type: str) -> List[Service]:
+        return [self.meters[meter_number] for meter_number in self._by_service_type.get(service_type, [])]
+
+    def by_meter_type(self, meter_type: str) -> List[Service]:
+        return [self.meters[meter_number] for meter_number in self._by_meter_type.get(meter_type, [])]
+
+    def by_account(self, account_number: AccountNumber) -> List[Service]:
+        return [self.meters[meter_number] for meter_number in self._by_account.get(account_number, [])]
+
+    def select(self, types: Set[str], account_numbers: Iterable[AccountNumber] = None) -> List[Service]:
+        """
+        Meters whose serviceType or meterNumber is in `types` (as get_meters(types, True)
+        would yield them), optionally only those on `account_numbers`.
+        """
+        selected = {
+            meter_number
+            for key in types
+            for meter_number in self._by_service_type.get(key, [key] if key in self.meters else [])
+        }
+        if account_numbers is not None:
+            accounts = set(account_numbers)
+            selected = {meter_number for meter_number in selected if self._account[meter_number] in accounts}
+        return [self.meters[meter_number] for meter_number in sorted(selected, key=self._position.get)]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "format": self.FORMAT,
+            "builtAt": self.built_at,
+            "defaultAccount": self.default_account,
+            "complete": self.complete,
+            "accounts": {
+                account_number: {
+                    "context": self.contexts[account_number].unstructure(omit_none=True),
+                    "billCycleCode": self.billing[account_number][0],
+                    "billDate": self.billing[account_number][1],
+                }
+                for account_number in self.contexts
+            },
+            "meters": [
+                {
+                    "meter": dict(meter.unstructure(omit_none=True), subMeters=None),
+                    "details": self._details[meter_number].unstructure(omit_none=True),
+                    "account": self._account[meter_number],
+                    "parent": self._parent.get(meter_number),
+                }
+                for meter_number, meter in self.meters.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], lazy: bool = False) -> "MeterRegistry":
+        """
+        Rebuilds a registry saved with to_dict(). With `lazy`, the account contexts are
+        LazyModels, like the responses of a client with lazy_models set.
+        """
+        registry = cls()
+        registry.built_at = data["builtAt"]
+        registry.default_account = data.get("defaultAccount")
+        registry.complete = data.get("complete", False)
+        for account_number, account in data["accounts"].items():
+            context = account["context"]
+            registry.contexts[account_number] = (
+                AccountContext.lazy(context) if lazy else AccountContext.from_dict(context)
+            )
+            registry.billing[account_number] = (account["billCycleCode"], account["billDate"])
+        for entry in data["meters"]:
+            meter = Service.from_dict(entry["meter"])
+            parent = entry["parent"]
+            registry._add(entry["account"], meter, Service.from_dict(entry["details"]), parent)
+            if parent:
+                # Keep Service.subMeters working for code that walks it
+                parent_meter = registry.meters[parent]
+                parent_meter.subMeters = (parent_meter.subMeters or []) + [meter]
+        return registry
+
+
+class RegistryCache:
+    """
+    Saved MeterRegistry for each username, reused for `ttl` seconds.
+    """
+
+    def __init__(self, path: str = None, ttl: float = 86400):
+        self.path: str = path or os.path.join(default_cache_dir(), "meters.json")
+        self.ttl: float = ttl
+
+    @staticmethod
+    def _key(username: str) -> str:
+        # TPU user names are not case sensitive
+        return username.upper()
+
+    def load(self, username: str, lazy: bool = False) -> Optional[MeterRegistry]:
+        with locked(self.path, shared=True):
+            data = read_json(self.path, {}).get(self._key(username))
+        if not data or data.get("format") != MeterRegistry.FORMAT or data["builtAt"] + self.ttl < time.time():
+            return None
+        return MeterRegistry.from_dict(data, lazy)
+
+    def save(self, username: str, registry: MeterRegistry):
+        with locked(self.path):
+            data = read_json(self.path, {})
+            data[self._key(username)] = registry.to_dict()
+            write_json(self.path, data)
@@ -0,0 +1,346 @@
+"""
+Daily, weekly, monthly and billing-cycle rollups of hourly usage, kept in the local store.
+
+Rollups are materialized in the store's SQLite file and updated as hours are added:
+only the days that received new hours are recomputed from the hourly rows, and only
+the weeks, months and cycles containing those days are recomputed from the days. So
+coarser views never need their own portal request (`usage/month`), and reading them
+costs one indexed query.
+
+Each rollup row has:
+
+    hours            hourly readings in the period
+    consumption      total usageConsumptionValue
+    onPeak, offPeak  consumption split by TimeOfUse
+    peakDemand       the largest usageDemandValue, and
+    peakDemandTime   when it happened (demandPeakTime, or the reading's timestamp)
+    scaledRead       the meter reading at the end of the period
+
+Billing cycles are only rolled up for meters with a known billDate; each cycle starts on
+that day of the month. The account's billCycleCode is stored alongside for reference,
+but it isn't used: what the codes mean isn't documented, and billDate is enough.
+
+The rollups are rebuilt from the stored hours only when VERSION changes (it is kept in
+the SQLite file's user_version), e.g. the first time a store written before rollups
+existed is opened.
+"""
+import calendar
+from datetime import date, datetime, timedelta
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from attr import define, field
+
+""" Periods rolled up, finest first; each one after "day" is computed from the days """
+PERIODS = ("day", "week", "month", "cycle")
+
+""" Bump whenever the way rollups are computed changes, so existing stores are rebuilt """
+VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollups (
+    meterNumber TEXT NOT NULL,
+    period TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    hours INTEGER NOT NULL,
+    consumption REAL,
+    onPeak REAL,
+    offPeak REAL,
+    peakDemand REAL,
+    peakDemandTime TEXT,
+    scaledRead REAL,
+    PRIMARY KEY (meterNumber, period, start)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS billing (
+    meterNumber TEXT PRIMARY KEY,
+    billCycleCode TEXT,
+    billDate TEXT
+);
+"""
+
+COLUMNS = (
+    "meterNumber",
+    "period",
+    "start",
+    "end",
+    "hours",
+    "consumption",
+    "onPeak",
+    "offPeak",
+    "peakDemand",
+    "peakDemandTime",
+    "scaledRead",
+)
+
+
+@define(auto_attribs=True, slots=True, kw_only=True)
+class TimeOfUse:
+    """
+    Which hours count as on-peak. The defaults are a common weekday morning and evening
+    peak; set them to match the rate schedule if it has one.
+    """
+
+    """ [start, end) hours of the day, as (7, 10) for 7:00 to 9:59 """
+    on_peak: Tuple[Tuple[int, int], ...] = field(default=((7, 10), (17, 20)))
+    """ Whether weekends are off-peak all day """
+    weekdays_only: bool = field(default=True)
+
+    def is_on_peak(self, timestamp: str) -> bool:
+        if len(timestamp) < 13:
+            return False
+        if self.weekdays_only and date.fromisoformat(timestamp[:10]).weekday() >= 5:
+            return False
+        hour = int(timestamp[11:13])
+        return any(start <= hour < end for start, end in self.on_peak)
+
+
+def parse_bill_date(value: Any) -> Optional[date]:
+    """
+    The portal's billDate as a date, from "YYYY-MM-DD..." or "MM/DD/YYYY" (None if it
+    is missing or in another format).
+    """
+    if isinstance(value, date):
+        return value
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(value[:10], "%m/%d/%Y").date()
+    except ValueError:
+        return None
+
+
+def _on_day(year: int, month: int, day: int) -> date:
+    """
+    `day` of the month, or the last day of months that are too short.
+    """
+    return date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+def _next_month(day: date) -> Tuple[int, int]:
+    return (day.year + 1, 1) if day.month == 12 else (day.year, day.month + 1)
+
+
+def _previous_month(day: date) -> Tuple[int, int]:
+    return (day.year - 1, 12) if day.month == 1 else (day.year, day.month - 1)
+
+
+def bounds(period: str, day: date, cycle_day: int = None) -> Tuple[date, date]:
+    """
+    [start, end) of the `period` containing `day`. Weeks start on Monday; billing cycles
+    on `cycle_day` of the month.
+    """
+    if period == "day":
+        return day, day + timedelta(days=1)
+    if period == "week":
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=7)
+    if period == "month":
+        start = day.replace(day=1)
+        return start, date(*_next_month(start), 1)
+    assert period == "cycle", f"unknown period {period}; expected one of {', '.join(PERIODS)}"
+    assert cycle_day, "billing cycles need a cycle day"
+    start = _on_day(day.year, day.month, cycle_day)
+    if start > day:
+        start = _on_day(*_previous_month(day), cycle_day)
+    return start, _on_day(*_next_month(start), cycle_day)
+
+
+class _Total:
+    """
+    Running aggregate for one period.
+    """
+
+    __slots__ = ("hours", "consumption", "onPeak", "offPeak", "peakDemand", "peakDemandTime", "scaledRead")
+
+    def __init__(self):
+        self.hours: int = 0
+        self.consumption: Optional[float] = None
+        self.onPeak: Optional[float] = None
+        self.offPeak: Optional[float] = None
+        self.peakDemand: Optional[float] = None
+        self.peakDemandTime: Optional[str] = None
+        self.scaledRead: Optional[float] = None
+
+    @staticmethod
+    def _sum(total: Optional[float], value: Optional[float]) -> Optional[float]:
+        if value is None:
+            return total
+        return value if total is None else total + value
+
+    def add(
+        self,
+        hours: int,
+        consumption: Optional[float],
+        on_peak: Optional[float],
+        off_peak: Optional[float],
+        demand: Optional[float],
+        demand_time: Optional[str],
+        scaled_read: Optional[float],
+    ):
+        self.hours += hours
+        self.consumption = self._sum(self.consumption, consumption)
+        self.onPeak = self._sum(self.onPeak, on_peak)
+        self.offPeak = self._sum(self.offPeak, off_peak)
+        if demand is not None and (self.peakDemand is None or demand > self.peakDemand):
+            self.peakDemand, self.peakDemandTime = demand, demand_time
+        if scaled_read is not None and (self.scaledRead is None or scaled_read > self.scaledRead):
+            self.scaledRead = scaled_read
+
+    def row(self, meter_number: str, period: str, start: date, end: date) -> tuple:
+        return (
+            meter_number,
+            period,
+            f"{start}",
+            f"{end}",
+            self.hours,
+            self.consumption,
+            self.onPeak,
+            self.offPeak,
+            self.peakDemand,
+            self.peakDemandTime,
+            self.scaledRead,
+        )
+
+
+class Rollups:
+    """
+    Maintains the rollups in `db`. The caller (UsageStore) serializes access and wraps
+    each update in the same transaction as the hours it covers.
+    """
+
+    def __init__(self, db: sqlite3.Connection, time_of_use: TimeOfUse = None):
+        self.db: sqlite3.Connection = db
+        self.time_of_use: TimeOfUse = time_of_use or TimeOfUse()
+        db.executescript(SCHEMA)
+
+    def cycle_day(self, meter_number: str) -> Optional[int]:
+        row = self.db.execute(
+            "SELECT billDate FROM billing WHERE meterNumber = ?", (meter_number,)
+        ).fetchone()
+        bill_date = parse_bill_date(row[0]) if row else None
+        return bill_date.day if bill_date else None
+
+    def set_billing(self, meter_number: str, bill_cycle_code: Any, bill_date: Any) -> bool:
+        """
+        Records a meter's billing cycle. Returns whether the cycle day changed, in which
+        case the cycle rollups need rebuilding.
+        """
+        before = self.cycle_day(meter_number)
+        bill_date = parse_bill_date(bill_date)
+        self.db.execute(
+            "INSERT OR REPLACE INTO billing VALUES (?, ?, ?)",
+            (
+                meter_number,
+                None if bill_cycle_code is None else str(bill_cycle_code),
+                f"{bill_date}" if bill_date else None,
+            ),
+        )
+        return before != (bill_date.day if bill_date else None)
+
+    def update(self, meter_number: str, first: str, last: str, periods: Iterable[str] = PERIODS):
+        """
+        Recomputes the rollups for every period that overlaps the hours from `first`
+        through `last` (timestamps, or dates).
+        """
+        first_day, last_day = date.fromisoformat(first[:10]), date.fromisoformat(last[:10])
+        periods = list(periods)
+        if "day" in periods:
+            self._update_days(meter_number, first_day, last_day)
+        cycle_day = self.cycle_day(meter_number)
+        for period in periods:
+            if period == "day" or (period == "cycle" and not cycle_day):
+                continue
+            start = bounds(period, first_day, cycle_day)[0]
+            end = bounds(period, last_day, cycle_day)[1]
+            totals: Dict[Tuple[date, date], _Total] = {}
+            for row in self.db.execute(
+                "SELECT start, hours, consumption, onPeak, offPeak, peakDemand, peakDemandTime, scaledRead"
+                " FROM rollups WHERE meterNumber = ? AND period = 'day' AND start >= ? AND start < ?"
+                " ORDER BY start",
+                (meter_number, f"{start}", f"{end}"),
+            ):
+                key = bounds(period, date.fromisoformat(row[0]), cycle_day)
+                totals.setdefault(key, _Total()).add(*row[1:])
+            self._replace(meter_number, period, totals)
+
+    def _update_days(self, meter_number: str, first_day: date, last_day: date):
+        totals: Dict[Tuple[date, date], _Total] = {}
+        is_on_peak = self.time_of_use.is_on_peak
+        for timestamp, consumption, demand, demand_time, scaled_read in self.db.execute(
+            "SELECT timestamp, usageConsumptionValue, usageDemandValue,"
+            " json_extract(data, '$.demandPeakTime'), scaledRead"
+            " FROM usage WHERE meterNumber = ? AND resolution = 'hourly'"
+            " AND timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+            (meter_number, f"{first_day}", f"{last_day + timedelta(days=1)}"),
+        ):
+            on_peak = is_on_peak(timestamp)
+            totals.setdefault(bounds("day", date.fromisoformat(timestamp[:10])), _Total()).add(
+                1,
+                consumption,
+                consumption if on_peak else None,
+                None if on_peak else consumption,
+                demand,
+                demand_time or timestamp,
+                scaled_read,
+            )
+        self._replace(meter_number, "day", totals)
+
+    def _replace(self, meter_number: str, period: str, totals: Dict[Tuple[date, date], _Total]):
+        self.db.executemany(
+            f"INSERT OR REPLACE INTO rollups VALUES ({', '.join('?' * len(COLUMNS))})",
+            [total.row(meter_number, period, *key) for key, total in totals.items()],
+        )
+
+    def rebuild(self, meter_number: str, periods: Iterable[str] = PERIODS):
+        """
+        Recomputes `periods` for all of a meter's hours, e.g. after its billing cycle
+        changes.
+        """
+        periods = list(periods)
+        self.db.execute(
+            f"DELETE FROM rollups WHERE meterNumber = ? AND period IN ({', '.join('?' * len(periods))})",
+            (meter_number, *periods),
+        )
+        first, last = self.db.execute(
+            "SELECT MIN(timestamp), MAX(timestamp) FROM usage"
+            " WHERE meterNumber = ? AND resolution = 'hourly'",
+            (meter_number,),
+        ).fetchone()
+        if first:
+            self.update(meter_number, first, last, periods)
+
+    def upgrade(self):
+        """
+        Rebuilds every meter's rollups if they were computed by another VERSION (or not
+        at all). A cheap check otherwise, since it only reads the file's user_version.
+        """
+        if self.db.execute("PRAGMA user_version").fetchone()[0] == VERSION:
+            return
+        meters = [
+            row[0]
+            for row in self.db.execute("SELECT DISTINCT meterNumber FROM usage WHERE resolution = 'hourly'")
+        ]
+        for meter_number in meters:
+            self.rebuild(meter_number)
+        self.db.execute(f"PRAGMA user_version = {VERSION}")
+
+    def range(self, meter_number: str, period: str, start: str = None, end: str = None) -> List[Dict[str, Any]]:
+        """
+        Rollups for a meter whose periods start in [start, end), oldest first.
+        """
+        assert period in PERIODS, f"unknown period {period}; expected one of {', '.join(PERIODS)}"
+        query = f"SELECT {', '.join(COLUMNS)} FROM rollups WHERE meterNumber = ? AND period = ?"
+        params = [meter_number, period]
+        if start:
+            query += " AND start >= ?"
+            params.append(start[:10])
+        if end:
+            query += " AND start < ?"
+            params.append(end[:10])
+        return [dict(zip(COLUMNS, row)) for row in self.db.execute(query + " ORDER BY start", params)]
@@ -0,0 +1,259 @@
+"""
+Columnar usage history.
+
+A year of hourly `Usage` objects is ~9000 instances of a ~55 slot class per meter, nearly
+all of it None. `UsageSeries` keeps just the columns we aggregate on, in NumPy arrays when
+NumPy is installed and in stdlib `array`s when it isn't.
+
+Timestamps are seconds since 1970-01-01 in the portal's (local) time, with no time zone.
+Missing values are NaN.
+"""
+from array import array
+from datetime import datetime, timedelta
+import math
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mytpu.models import Usage, usage_timestamp
+
+""" Usage fields kept by UsageSeries, and how resample() combines each one """
+COLUMNS = {
+    "usageConsumptionValue": "sum",
+    # Ever-increasing meter reading, so the max is the reading at the end of the period
+    "scaledRead": "max",
+    "usageDemandValue": "max",
+    "temp": "mean",
+}
+
+EPOCH = datetime(1970, 1, 1)
+DAY = 86400
+WEEK = 7 * DAY
+# 1970-01-01 was a Thursday; shift so that weeks start on Monday
+WEEK_OFFSET = 3 * DAY
+
+Period = Union[str, int]
+
+
+def _column(values: Iterable[float] = ()):
+    if numpy is not None:
+        return numpy.fromiter(values, dtype=numpy.float64)
+    return array("d", values)
+
+
+def _float(value: Any) -> float:
+    if value is None:
+        return math.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class _TimestampParser:
+    """
+    Converts "YYYY-MM-DD" / "YYYY-MM-DD HH:MM" strings to seconds, parsing each date only once.
+    """
+
+    def __init__(self):
+        self._days: Dict[str, float] = {}
+
+    def __call__(self, value: str) -> float:
+        day = value[:10]
+        seconds = self._days.get(day)
+        if seconds is None:
+            seconds = self._days[day] = (datetime.fromisoformat(day) - EPOCH).total_seconds()
+        if len(value) >= 16:
+            seconds += int(value[11:13]) * 3600 + int(value[14:16]) * 60
+        return seconds
+
+
+def format_timestamp(seconds: float) -> str:
+    return (EPOCH + timedelta(seconds=seconds)).strftime("%Y-%m-%d %H:%M")
+
+
+class UsageSeries:
+    def __init__(self, meter_number: str = None, timestamps: Iterable[float] = (), **columns):
+        """
+        Columns should already be sorted by timestamp; use from_history() for raw data.
+        """
+        self.meter_number: Optional[str] = meter_number
+        self.timestamps = _column(timestamps)
+        self.columns = {
+            name: _column(columns[name]) if name in columns else _column([math.nan] * len(self.timestamps))
+            for name in COLUMNS
+        }
+        for name, values in self.columns.items():
+            assert len(values) == len(self.timestamps), f"{name} has the wrong length"
+
+    @classmethod
+    def from_history(cls, history: Iterable[Dict[str, Any]], meter_number: str = None) -> "UsageSeries":
+        """
+        Builds a series from raw `Usage` dicts (e.g. `UsageResponse.history` before it is
+        structured), skipping records without a timestamp.
+        """
+        parse = _TimestampParser()
+        rows = []
+        for record in history:
+            timestamp = usage_timestamp(record)
+            if timestamp:
+                rows.append((parse(timestamp), record))
+        rows.sort(key=lambda row: row[0])
+        return cls(
+            meter_number,
+            [row[0] for row in rows],
+            **{name: [_float(row[1].get(name)) for row in rows] for name in COLUMNS},
+        )
+
+    @classmethod
+    def from_usages(cls, usages: Iterable[Usage], meter_number: str = None) -> "UsageSeries":
+        fields = ("readDateTime", "usageDate", "readDate", *COLUMNS)
+        return cls.from_history(
+            ({name: getattr(usage, name) for name in fields} for usage in usages),
+            meter_number,
+        )
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __getitem__(self, name: str):
+        return self.columns[name]
+
+    def rows(self) -> Iterator[Dict[str, Any]]:
+        """
+        Yields one dict per timestamp, with NaN values left out.
+        """
+        for i, timestamp in enumerate(self.timestamps):
+            row = {"timestamp": format_timestamp(timestamp)}
+            for name, values in self.columns.items():
+                if not math.isnan(values[i]):
+                    row[name] = float(values[i])
+            yield row
+
+    def buckets(self, period: Period):
+        """
+        Start of the period containing each timestamp. `period` is "day", "week"
+        (starting Monday), "month", or a number of seconds.
+        """
+        if period == "month":
+            if numpy is not None:
+                return (
+                    self.timestamps.astype("datetime64[s]")
+                    .astype("datetime64[M]")
+                    .astype("datetime64[s]")
+                    .astype(numpy.float64)
+                )
+            return _column(
+                (datetime(day.year, day.month, 1) - EPOCH).total_seconds()
+                for day in (EPOCH + timedelta(seconds=t) for t in self.timestamps)
+            )
+        offset = 0
+        if period == "day":
+            period = DAY
+        elif period == "week":
+            period, offset = WEEK, WEEK_OFFSET
+        if numpy is not None:
+            return (self.timestamps + offset) // period * period - offset
+        return _column((t + offset) // period * period - offset for t in self.timestamps)
+
+    def resample(self, period: Period) -> "UsageSeries":
+        """
+        Aggregates the series into `period` buckets (see buckets()), combining each
+        column as described in COLUMNS.
+        """
+        keys = self.buckets(period)
+        if not len(keys):
+            return UsageSeries(self.meter_number)
+        if numpy is not None:
+            starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+            return UsageSeries(
+                self.meter_number,
+                keys[starts],
+                **{name: _reduce(self.columns[name], starts, how) for name, how in COLUMNS.items()},
+            )
+        groups: Dict[float, List[int]] = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(key, []).append(i)
+        return UsageSeries(
+            self.meter_number,
+            groups.keys(),
+            **{
+                name: [_combine([self.columns[name][i] for i in rows], how) for rows in groups.values()]
+                for name, how in COLUMNS.items()
+            },
+        )
+
+    def sum(self, column: str = "usageConsumptionValue") -> float:
+        values = self.columns[column]
+        if numpy is not None:
+            return float(numpy.nansum(values))
+        return math.fsum(value for value in values if not math.isnan(value))
+
+    def peak(self, column: str = "usageDemandValue") -> Optional[Tuple[str, float]]:
+        """
+        Timestamp and value of the largest value in `column`, or None if it's all missing.
+        """
+        values = self.columns[column]
+        if numpy is not None:
+            if not len(values) or numpy.isnan(values).all():
+                return None
+            i = int(numpy.nanargmax(values))
+        else:
+            present = [i for i, value in enumerate(values) if not math.isnan(value)]
+            if not present:
+                return None
+            i = max(present, key=values.__getitem__)
+        return format_timestamp(self.timestamps[i]), float(values[i])
+
+    @staticmethod
+    def join(series: Iterable["UsageSeries"], column: str = "usageConsumptionValue") -> Tuple[Any, Dict[str, Any]]:
+        """
+        Aligns one column from several meters' series on the union of their timestamps.
+        Returns (timestamps, {meterNumber: values}), with NaN where a meter has no reading.
+        """
+        series = list(series)
+        if numpy is not None:
+            timestamps = numpy.unique(numpy.concatenate([s.timestamps for s in series])) if series else _column()
+            joined = {}
+            for s in series:
+                values = numpy.full(len(timestamps), numpy.nan)
+                values[numpy.searchsorted(timestamps, s.timestamps)] = s.columns[column]
+                joined[s.meter_number] = values
+            return timestamps, joined
+        timestamps = sorted({t for s in series for t in s.timestamps})
+        index = {t: i for i, t in enumerate(timestamps)}
+        joined = {}
+        for s in series:
+            values = [math.nan] * len(timestamps)
+            for t, value in zip(s.timestamps, s.columns[column]):
+                values[index[t]] = value
+            joined[s.meter_number] = _column(values)
+        return _column(timestamps), joined
+
+
+def _reduce(values, starts, how: str):
+    """
+    NumPy version of _combine() over the groups beginning at each index in `starts`.
+    """
+    missing = numpy.isnan(values)
+    counts = numpy.add.reduceat(~missing, starts)
+    if how == "max":
+        return numpy.fmax.reduceat(values, starts)
+    totals = numpy.add.reduceat(numpy.where(missing, 0.0, values), starts)
+    if how == "mean":
+        totals = totals / numpy.maximum(counts, 1)
+    return numpy.where(counts > 0, totals, numpy.nan)
+
+
+def _combine(values: List[float], how: str) -> float:
+    present = [value for value in values if not math.isnan(value)]
+    if not present:
+        return math.nan
+    if how == "max":
+        return max(present)
+    if how == "mean":
+        return math.fsum(present) / len(present)
+    return math.fsum(present)
@@ -0,0 +1,59 @@
+"""
+Coalescing of identical calls that are in flight at the same time.
+
+When several threads ask a long-lived MyTPU for the same thing at once (e.g. a few
+dashboard sensors polling the same meter and window), only the first one makes the
+request; the rest wait for it and get the same result, or the same exception.
+"""
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Thread-safe. Results are only shared between calls that overlap; nothing is kept
+    once the call finishes, so a later call with the same key runs again.
+    """
+
+    def __init__(self, on_shared: Callable[[], None] = None):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        """ Called each time a call waits on another one instead of running """
+        self.on_shared: Optional[Callable[[], None]] = on_shared
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        Returns fn(), or the result of the fn() already running under `key`. The result
+        is shared between the callers as is, so they shouldn't modify it.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            if self.on_shared:
+                self.on_shared()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -0,0 +1,195 @@
+"""
+Local SQLite store of usage history.
+
+Records are keyed by meterNumber, resolution (hourly or daily) and timestamp (readDateTime
+or usageDate), so consumers can run indexed range queries without touching the portal.
+Hourly records are also rolled up into days, weeks, months and billing cycles as they
+are added (see mytpu.rollup).
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+from mytpu.cache import default_cache_dir
+from mytpu.models import Service, usage_timestamp
+from mytpu.rollup import PERIODS, Rollups, TimeOfUse
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    meterNumber TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    usageDate TEXT,
+    readDateTime TEXT,
+    usageConsumptionValue REAL,
+    usageDemandValue REAL,
+    scaledRead REAL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (meterNumber, resolution, timestamp)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS meters (
+    meterNumber TEXT PRIMARY KEY,
+    serviceType TEXT,
+    meterType TEXT,
+    friendlyMeterType TEXT,
+    uom TEXT
+);
+"""
+
+
+def resolution(hourly: bool) -> str:
+    return "hourly" if hourly else "daily"
+
+
+class UsageStore:
+    def __init__(self, path: str = None, time_of_use: TimeOfUse = None):
+        self.path: str = path or os.path.join(default_cache_dir(), "usage.sqlite3")
+        os.makedirs(os.path.dirname(self.path) or ".", mode=0o700, exist_ok=True)
+        # Readers (e.g. the web service) may use the connection from other threads,
+        # so serialize access ourselves.
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        # WAL lets other processes read while a sync is writing
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self._rollups = Rollups(self.db, time_of_use)
+        with self.db:
+            self._rollups.upgrade()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_meter(self, service: Service):
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO meters VALUES (?, ?, ?, ?, ?)",
+                (
+                    service.meterNumber,
+                    service.serviceType,
+                    service.meterType,
+                    service.friendly_meter_type,
+                    service.uom,
+                ),
+            )
+
+    def meters(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(row) for row in self.db.execute("SELECT * FROM meters ORDER BY meterNumber")]
+
+    def set_billing(self, meter_number: str, bill_cycle_code: Any, bill_date: Any):
+        """
+        Records the billing cycle (billCycleCode and billDate) of the account a meter is
+        on, so its usage is also rolled up by cycle.
+        """
+        with self._lock, self.db:
+            if self._rollups.set_billing(meter_number, bill_cycle_code, bill_date):
+                self._rollups.rebuild(meter_number, ["cycle"])
+
+    def add(self, meter_number: str, records: Iterable[Dict[str, Any]], hourly: bool = True) -> int:
+        """
+        Inserts (or replaces) raw `Usage` records for a meter, and updates the rollups of
+        the days they fall on. Returns the number of records written; hourly records
+        without a readDateTime are skipped, with a warning.
+        """
+        records = list(records)
+        rows = [
+            (
+                meter_number,
+                resolution(hourly),
+                usage_timestamp(record, hourly),
+                record.get("usageDate"),
+                record.get("readDateTime"),
+                record.get("usageConsumptionValue"),
+                record.get("usageDemandValue"),
+                record.get("scaledRead"),
+                json.dumps(record),
+            )
+            for record in records
+            if usage_timestamp(record, hourly)
+        ]
+        if len(rows) < len(records):
+            print(
+                f"skipped {len(records) - len(rows)} {resolution(hourly)} records for {meter_number}"
+                " without a timestamp",
+                file=sys.stderr,
+            )
+        with self._lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            if hourly and rows:
+                timestamps = [row[2] for row in rows]
+                self._rollups.update(meter_number, min(timestamps), max(timestamps))
+        return len(rows)
+
+    def latest(self, meter_number: str, hourly: bool = True) -> Optional[str]:
+        """
+        Timestamp of the newest stored record for a meter, if any.
+        """
+        with self._lock:
+            row = self.db.execute(
+                "SELECT MAX(timestamp) FROM usage WHERE meterNumber = ? AND resolution = ?",
+                (meter_number, resolution(hourly)),
+            ).fetchone()
+        return row[0]
+
+    def range(
+        self,
+        meter_number: str,
+        start: str = None,
+        end: str = None,
+        hourly: bool = True,
+    ) -> List[Dict[str, Any]]:
+        """
+        Raw `Usage` records for a meter with start <= timestamp < end, oldest first.
+        Timestamps are compared as strings, so a date like "2022-09-01" works for both
+        bounds.
+        """
+        query = "SELECT data FROM usage WHERE meterNumber = ? AND resolution = ?"
+        params = [meter_number, resolution(hourly)]
+        if start:
+            query += " AND timestamp >= ?"
+            params.append(start)
+        if end:
+            query += " AND timestamp < ?"
+            params.append(end)
+        with self._lock:
+            rows = self.db.execute(query + " ORDER BY timestamp", params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def rollups(
+        self, meter_number: str, period: str = "day", start: str = None, end: str = None
+    ) -> List[Dict[str, Any]]:
+        """
+        A meter's rollups for `period` (one of mytpu.rollup.PERIODS) starting in
+        [start, end), oldest first.
+        """
+        with self._lock:
+            return self._rollups.range(meter_number, period, start, end)
+
+    def rebuild_rollups(self, periods: Iterable[str] = PERIODS):
+        """
+        Recomputes the rollups of every meter from scratch, e.g. after changing the
+        TimeOfUse.
+        """
+        with self._lock, self.db:
+            meter_numbers = [
+                row[0]
+                for row in self.db.execute(
+                    "SELECT DISTINCT meterNumber FROM usage WHERE resolution = 'hourly'"
+                )
+            ]
+            for meter_number in meter_numbers:
+                self._rollups.rebuild(meter_number, periods)
@@ -0,0 +1,69 @@
+"""
+Incremental decoding of usage responses, so that long ranges can be processed in
+constant memory instead of holding several copies of the whole body.
+"""
+import codecs
+import json
+import re
+from typing import Any, Dict, Generator, Iterable
+
+HISTORY = re.compile(r'"history"\s*:\s*\[')
+WHITESPACE = re.compile(r"[\s,]*")
+
+_decoder = json.JSONDecoder()
+
+
+def iter_history(chunks: Iterable[bytes]) -> Generator[Dict[str, Any], None, None]:
+    """
+    Yields the records in a usage response's top level `history` array one at a time,
+    from an iterable of raw body chunks (e.g. `Response.iter_content()`).
+
+    This only looks for the first `"history": [` in the body, which is fine for
+    `UsageResponse` since nothing before it contains that key.
+    """
+    text = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    head = None
+    found = False
+    eof = False
+
+    def read() -> bool:
+        nonlocal buffer, head, eof
+        for chunk in chunks:
+            buffer += text.decode(chunk)
+            if head is None:
+                head = buffer[:200]
+            return True
+        buffer += text.decode(b"", final=True)
+        eof = True
+        return False
+
+    while not found:
+        match = HISTORY.search(buffer)
+        if match:
+            buffer = buffer[match.end():]
+            found = True
+        elif eof:
+            raise ValueError(f"No history in usage response: {head}")
+        else:
+            # Keep enough of the tail in case the key is split across chunks
+            buffer = buffer[-32:]
+            read()
+
+    pos = 0
+    while True:
+        pos = WHITESPACE.match(buffer, pos).end()
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            record, pos = _decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Most likely the record isn't complete yet. Drop what we've consumed and read more.
+            if eof:
+                raise
+            buffer = buffer[pos:]
+            pos = 0
+            read()
+            continue
+        yield record
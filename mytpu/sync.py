@@ -0,0 +1,55 @@
+"""
+Incremental download of usage history into the local store.
+"""
+from datetime import date
+import sys
+from typing import Dict, Iterable, Optional
+
+from mytpu.api import MyTPU
+from mytpu.backfill import plan_windows
+from mytpu.models import AccountContext, Service
+from mytpu.ratelimit import TokenBucket
+from mytpu.store import UsageStore
+
+
+def sync(
+    tpu: MyTPU,
+    context: Optional[AccountContext],
+    services: Iterable[Service],
+    store: UsageStore,
+    since: date,
+    until: date = None,
+    hourly: bool = True,
+    concurrency: int = 4,
+    rate: Optional[float] = 2.0,
+) -> Dict[str, int]:
+    """
+    Fetches only the usage each meter is missing from `store`: from the day of its
+    latest stored reading (which may have been partial) through `until`, or from `since`
+    for meters with nothing stored yet. Returns the number of records written per meter.
+
+    `rate` limits requests per second for this sync (None for no limit).
+    """
+    until = until or date.today()
+    windows = []
+    added = {}
+    for service in services:
+        store.add_meter(service)
+        added[service.meterNumber] = 0
+        latest = store.latest(service.meterNumber, hourly)
+        start = date.fromisoformat(latest[:10]) if latest else since
+        windows += [(service, *window) for window in plan_windows(start, until, hourly)]
+
+    results = tpu.usage_many(
+        context,
+        windows,
+        hourly=hourly,
+        concurrency=concurrency,
+        limiter=TokenBucket(rate, burst=concurrency) if rate else None,
+    )
+    for meter_number, window, content in results:
+        if content.get("statusCode") != "200" or "history" not in content:
+            print(f"unexpected result for {meter_number} {window}", file=sys.stderr)
+            continue
+        added[meter_number] += store.add(meter_number, content["history"], hourly)
+    return added
@@ -0,0 +1,167 @@
+"""
+Instrumentation hooks for MyTPU.
+
+The client wraps each phase of its work in a Span: scraping the eportal javascript,
+logging in, loading customer info, each http request, JSON decoding and structuring
+into models. A Tracer passes every span to its hooks when it starts and when it ends,
+with the status and byte count filled in where they apply. Phases nest, e.g. a
+"customer" span includes its "http", "decode" and "structure" spans (and a "login" if
+one was needed).
+
+    collector = Collector()
+    tpu = MyTPU(username, password, tracer=Tracer([collector]))
+    ...
+    collector.report()
+"""
+import contextlib
+import math
+import sys
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Union
+
+from attr import define, field
+
+""" Phases MyTPU reports """
+PHASES = ("scrape", "login", "refresh", "customer", "http", "decode", "structure")
+
+
+@define(auto_attribs=True, slots=True, kw_only=True)
+class Span:
+    phase: str
+    """ e.g. the REST path of an http request """
+    detail: Optional[str] = field(default=None)
+    start: float = field(factory=time.perf_counter)
+    end: Optional[float] = field(default=None)
+    """ http status code, for http spans """
+    status: Optional[int] = field(default=None)
+    """ Bytes received (http) or processed (decode) """
+    bytes: Optional[int] = field(default=None)
+    error: Optional[str] = field(default=None)
+
+    @property
+    def duration(self) -> Optional[float]:
+        return self.end - self.start if self.end is not None else None
+
+
+class Hook:
+    """
+    Receives spans from a Tracer. Both methods may be called from several threads at once.
+    """
+
+    def start(self, span: Span):
+        pass
+
+    def end(self, span: Span):
+        pass
+
+
+class Tracer:
+    def __init__(self, hooks: List[Hook] = None):
+        self.hooks: List[Hook] = list(hooks or [])
+
+    def add(self, hook: Hook):
+        self.hooks.append(hook)
+
+    @contextlib.contextmanager
+    def span(self, phase: str, detail: str = None) -> Iterator[Span]:
+        span = Span(phase=phase, detail=detail)
+        for hook in self.hooks:
+            hook.start(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end = time.perf_counter()
+            for hook in self.hooks:
+                hook.end(span)
+
+
+class LogHook(Hook):
+    """
+    Prints a line to stderr for each http request as it finishes.
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        # Keeps lines from concurrent requests from interleaving
+        self._lock = threading.Lock()
+
+    def end(self, span: Span):
+        if span.phase != "http":
+            return
+        outcome = span.error or span.status
+        size = f" {span.bytes}B" if span.bytes is not None else ""
+        with self._lock:
+            print(
+                f"{span.detail} {outcome} {span.duration * 1000:.0f}ms{size}",
+                file=self.file or sys.stderr,
+            )
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile of sorted `values`.
+    """
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+class Collector(Hook):
+    """
+    Keeps the duration of every span, for a per-phase latency breakdown.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations: Dict[str, List[float]] = {}
+        self._bytes: Dict[str, int] = {}
+        self._errors: Dict[str, int] = {}
+
+    def end(self, span: Span):
+        with self._lock:
+            self._durations.setdefault(span.phase, []).append(span.duration)
+            self._bytes[span.phase] = self._bytes.get(span.phase, 0) + (span.bytes or 0)
+            self._errors[span.phase] = self._errors.get(span.phase, 0) + bool(span.error)
+
+    def summary(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        """
+        count, errors, bytes, total, p50, p90, p99 and max (in seconds) for each phase.
+        """
+        with self._lock:
+            durations = {phase: sorted(values) for phase, values in self._durations.items()}
+            summary = {}
+            for phase, values in durations.items():
+                summary[phase] = {
+                    "count": len(values),
+                    "errors": self._errors[phase],
+                    "bytes": self._bytes[phase],
+                    "total": sum(values),
+                    "p50": percentile(values, 50),
+                    "p90": percentile(values, 90),
+                    "p99": percentile(values, 99),
+                    "max": values[-1],
+                }
+        return summary
+
+    def report(self, file=None):
+        """
+        Prints the summary as a table, in PHASES order.
+        """
+        file = file or sys.stderr
+        summary = self.summary()
+        print(
+            f"{'phase':10} {'count':>6} {'total':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9} {'KiB':>8}",
+            file=file,
+        )
+        for phase in sorted(summary, key=lambda p: (PHASES + (p,)).index(p)):
+            stats = summary[phase]
+            times = " ".join(
+                f"{stats[key] * 1000:7.1f}ms" for key in ("total", "p50", "p90", "p99", "max")
+            )
+            errors = f"  ({stats['errors']} failed)" if stats["errors"] else ""
+            print(
+                f"{phase:10} {stats['count']:6} {times} {stats['bytes'] / 1024:8.0f}{errors}",
+                file=file,
+            )
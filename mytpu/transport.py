@@ -0,0 +1,180 @@
+"""
+How MyTPU talks to the portal: connection pooling, timeouts, retries with backoff, and
+request metrics.
+"""
+import random
+import socket
+import bisect
+import threading
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from attr import define, field
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+try:
+    # urllib3 can only decode brotli responses if one of these is installed
+    import brotli  # noqa: F401
+
+    ACCEPT_ENCODING = "gzip, br"
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+
+        ACCEPT_ENCODING = "gzip, br"
+    except ImportError:
+        ACCEPT_ENCODING = "gzip"
+
+""" Default connection pool size, matching requests' own default """
+POOL_SIZE = 10
+
+
+@define(auto_attribs=True, slots=True, kw_only=True)
+class TransportPolicy:
+    connect_timeout: float = field(default=10)
+    read_timeout: float = field(default=60)
+    """ Retries for idempotent requests after a connection error, timeout, or retry_statuses """
+    max_retries: int = field(default=3)
+    """ Base delay (seconds) for exponential backoff """
+    backoff: float = field(default=0.5)
+    backoff_max: float = field(default=30)
+    retry_statuses: FrozenSet[int] = field(default=frozenset({429, 500, 502, 503, 504}))
+    """ Requests per second allowed across all threads using the client (None for no limit) """
+    rate: Optional[float] = field(default=None)
+    burst: int = field(default=4)
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """
+        Seconds to wait before retry number `attempt` (starting at 0), using "full jitter"
+        so that threads that failed together don't all retry together. A Retry-After
+        from the server is honored as a minimum.
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff * 2**attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+
+class TransportMetrics:
+    """
+    Thread-safe counters and latency histograms for what the transport layer has been
+    doing.
+    """
+
+    NAMES = (
+        "requests",  # http requests sent, including retries
+        "retries",
+        "errors",  # connection errors and timeouts
+        "throttled",  # 429 responses from the portal
+        "rate_limited",  # requests delayed by our own rate limit
+        "logins",  # password grants
+        "refreshes",  # refresh token grants
+        "coalesced",  # calls that shared an identical call already in flight
+    )
+    """ Upper bounds (seconds) of the request latency histogram buckets """
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = dict.fromkeys(self.NAMES, 0)
+        self.rate_limit_wait: float = 0.0
+        """ Per url path: count in each latency bucket (the last is +Inf), and the total seconds """
+        self._latency: Dict[str, Tuple[List[int], List[float]]] = {}
+
+    def add(self, name: str, count: int = 1):
+        with self._lock:
+            self._counts[name] += count
+
+    def waited(self, seconds: float):
+        with self._lock:
+            self._counts["rate_limited"] += 1
+            self.rate_limit_wait += seconds
+
+    def observe(self, path: str, seconds: float):
+        """
+        Records how long a request to `path` took to get a response.
+        """
+        bucket = bisect.bisect_left(self.LATENCY_BUCKETS, seconds)
+        with self._lock:
+            counts, total = self._latency.setdefault(
+                path, ([0] * (len(self.LATENCY_BUCKETS) + 1), [0.0])
+            )
+            counts[bucket] += 1
+            total[0] += seconds
+
+    def latency(self) -> Dict[str, Tuple[List[int], float]]:
+        """
+        (count in each bucket, total seconds) for each path.
+        """
+        with self._lock:
+            return {path: (list(counts), total[0]) for path, (counts, total) in self._latency.items()}
+
+    def __getitem__(self, name: str) -> int:
+        return self._counts[name]
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._counts, rate_limit_wait=self.rate_limit_wait)
+
+
+def retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parses a Retry-After header given in seconds (the http-date form is ignored).
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class PoolAdapter(HTTPAdapter):
+    """
+    HTTPAdapter tuned for many threads talking to the one portal host.
+
+    The pool blocks when all `pool_size` connections are in use, rather than opening
+    extra connections that get thrown away afterwards (each costing a TLS handshake).
+    urllib3 already checks that a pooled connection is still alive before reusing it;
+    TCP keepalive makes idle connections less likely to be silently dropped in between.
+    """
+
+    def __init__(self, pool_size: int = POOL_SIZE):
+        self.pool_size: int = pool_size
+        # urllib3 retries are disabled since MyTPU._request() does its own
+        super().__init__(pool_connections=2, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+        super().init_poolmanager(*args, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Connections opened and requests sent across this adapter's pools. If connections
+        is close to requests, keep-alive isn't working.
+        """
+        pools = [self.poolmanager.pools[key] for key in self.poolmanager.pools.keys()]
+        return {
+            "connections": sum(pool.num_connections for pool in pools),
+            "requests": sum(pool.num_requests for pool in pools),
+        }
+
+
+_shared_adapter: PoolAdapter = None
+_shared_lock = threading.Lock()
+
+
+def shared_adapter(pool_size: int = POOL_SIZE) -> PoolAdapter:
+    """
+    Returns the process-wide adapter, so that several MyTPU instances can share one
+    connection pool. The pool is sized by the first caller.
+    """
+    global _shared_adapter
+    with _shared_lock:
+        if _shared_adapter is None:
+            _shared_adapter = PoolAdapter(pool_size)
+        return _shared_adapter
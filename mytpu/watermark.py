@@ -0,0 +1,120 @@
+"""
+Incremental export: remembers how far each meter's output got, so the next run only
+asks for (and emits) readings that are new since then.
+
+Each meter's watermark is the timestamp of the newest record emitted, plus the
+timestamps emitted in the last `overlap_days` before it. Runs re-request the overlap,
+so hours the portal posts late are picked up, and skip the timestamps already
+emitted there, so nothing is written twice.
+"""
+from datetime import date, timedelta
+import os
+import sys
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+from mytpu.cache import default_cache_dir, locked, read_json, write_json
+from mytpu.models import usage_timestamp
+
+
+class Watermarks:
+    """
+    Watermark per meterNumber, stored as {"latest": timestamp, "emitted": [timestamps]}
+    in a JSON file.
+    """
+
+    def __init__(self, path: str = None):
+        self.path: str = path or os.path.join(default_cache_dir(), "watermarks.json")
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        with locked(self.path, shared=True):
+            return read_json(self.path, {})
+
+    def advance(self, updates: Dict[str, Dict[str, Any]]):
+        """
+        Merges new watermarks into the file in one atomic write. A watermark never
+        moves backwards, even if another run advanced it in the meantime.
+        """
+        with locked(self.path):
+            data = read_json(self.path, {})
+            for meter_number, update in updates.items():
+                current = data.get(meter_number) or {"latest": None, "emitted": []}
+                latest = max(filter(None, [current["latest"], update["latest"]]))
+                # The update's list already covers its whole overlap
+                cutoff = min(update["emitted"])
+                emitted = {timestamp for timestamp in current["emitted"] if timestamp >= cutoff}
+                data[meter_number] = {
+                    "latest": latest,
+                    "emitted": sorted(emitted | set(update["emitted"])),
+                }
+            write_json(self.path, data)
+
+
+class IncrementalExport:
+    """
+    Tracks what one run emits, to be committed to `watermarks` once the output has been
+    written successfully:
+
+        export = IncrementalExport(Watermarks())
+        with make_writer("ndjson", sys.stdout) as writer:
+            for meter in meters:
+                start = export.start(meter.meterNumber, since)
+                for record in export.new_records(meter.meterNumber, tpu.usage_stream(...)):
+                    writer.write(record)
+        export.commit()
+    """
+
+    def __init__(self, watermarks: Watermarks, overlap_days: int = 1):
+        self.watermarks: Watermarks = watermarks
+        self.overlap_days: int = overlap_days
+        self._previous: Dict[str, Dict[str, Any]] = watermarks.load()
+        self._pending: Dict[str, Dict[str, Any]] = {}
+
+    def _overlap_start(self, timestamp: str) -> date:
+        return date.fromisoformat(timestamp[:10]) - timedelta(days=self.overlap_days)
+
+    def start(self, meter_number: str, default: date) -> date:
+        """
+        First day to request for a meter: the overlap before its watermark, or
+        `default` if it has never been exported.
+        """
+        latest = (self._previous.get(meter_number) or {}).get("latest")
+        return self._overlap_start(latest) if latest else default
+
+    def new_records(self, meter_number: str, records: Iterable[dict], hourly: bool = True) -> Iterator[dict]:
+        """
+        Passes through the records that haven't been emitted before. Records without a
+        timestamp (for hourly data, a readDateTime) are skipped, with a warning.
+        """
+        previous = self._previous.get(meter_number) or {}
+        latest: Optional[str] = previous.get("latest")
+        emitted: Set[str] = set(previous.get("emitted", []))
+        seen: List[str] = []
+        for record in records:
+            timestamp = usage_timestamp(record, hourly)
+            if not timestamp:
+                print(f"skipped a record for {meter_number} without a timestamp", file=sys.stderr)
+                continue
+            if timestamp in emitted:
+                continue
+            if latest and timestamp < f"{self._overlap_start(latest)}":
+                # Older than anything this run asked for; can't tell if it's new
+                continue
+            emitted.add(timestamp)
+            seen.append(timestamp)
+            yield record
+        if seen:
+            newest = max(filter(None, [latest, *seen]))
+            cutoff = f"{self._overlap_start(newest)}"
+            self._pending[meter_number] = {
+                "latest": newest,
+                "emitted": sorted(timestamp for timestamp in emitted if timestamp >= cutoff),
+            }
+
+    def commit(self):
+        """
+        Advances the watermarks past everything emitted. Call only after the output has
+        been written.
+        """
+        if self._pending:
+            self.watermarks.advance(self._pending)
+            self._pending = {}
@@ -1 +1,271 @@
-import requests
+"""
+Local http service for dashboards (e.g. Home Assistant REST sensors).
+
+One logged-in MyTPU client is kept alive and polls usage into the local store on a
+schedule. Requests are answered from memory or the store, so any number of clients cost
+no portal traffic between polls.
+
+    GET /meters                  the meters being polled
+    GET /latest                  the newest reading for every meter
+    GET /latest/<meterNumber>
+    GET /usage/<meterNumber>?from=2022-09-01&to=2022-09-08&daily=1
+    GET /rollup/<meterNumber>/<period>?from=2022-09-01&to=2022-10-01
+                                 day, week, month or cycle totals (see mytpu.rollup)
+    GET /status                  when the last poll ran and how it went
+    GET /metrics                 OpenMetrics for Prometheus (see mytpu.exporter)
+
+Every JSON response has an ETag, and a request with a matching If-None-Match gets an
+empty 304 Not Modified.
+"""
+from datetime import date
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from mytpu.api import MyTPU
+from mytpu.exporter import CONTENT_TYPE as METRICS_CONTENT_TYPE, Exporter
+from mytpu.models import Service
+from mytpu.rollup import PERIODS
+from mytpu.store import UsageStore
+from mytpu.sync import sync
+
+
+class Poller:
+    """
+    Syncs `services` into `store` every `every` minutes in a background thread, and keeps
+    the newest reading for each meter in memory.
+    """
+
+    def __init__(
+        self,
+        tpu: MyTPU,
+        services: List[Service],
+        store: UsageStore,
+        every: float = 60,
+        since: date = None,
+        hourly: bool = True,
+        concurrency: int = 4,
+        rate: Optional[float] = 2.0,
+    ):
+        self.tpu: MyTPU = tpu
+        self.services: List[Service] = services
+        self.store: UsageStore = store
+        """ Minutes between polls """
+        self.every: float = every
+        """ Where to start for meters with nothing stored yet """
+        self.since: date = since
+        self.hourly: bool = hourly
+        self.concurrency: int = concurrency
+        self.rate: Optional[float] = rate
+
+        """ Bumped whenever a poll finishes, so cached responses know they are stale """
+        self.generation: int = 0
+        """ Newest reading for each meterNumber """
+        self.latest: Dict[str, dict] = {}
+        """ time.time() of the last poll that finished, successfully or not """
+        self.last_poll: float = None
+        self.last_error: str = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+
+    def poll(self):
+        try:
+            sync(
+                self.tpu,
+                None,
+                self.services,
+                self.store,
+                since=self.since,
+                hourly=self.hourly,
+                concurrency=self.concurrency,
+                rate=self.rate,
+            )
+            self.latest = self._load_latest()
+            self.last_error = None
+        except Exception as e:
+            # Keep serving what we have (a failed sync or store read must not kill the
+            # poller thread); the next poll will try again
+            self.last_error = f"{type(e).__name__}: {e}"
+            print(f"poll failed: {self.last_error}", file=sys.stderr)
+        self.last_poll = time.time()
+        self.generation += 1
+
+    def _load_latest(self) -> Dict[str, dict]:
+        latest = {}
+        for service in self.services:
+            timestamp = self.store.latest(service.meterNumber, self.hourly)
+            if not timestamp:
+                continue
+            record = self.store.range(service.meterNumber, timestamp, hourly=self.hourly)[-1]
+            record["meterNumber"] = service.meterNumber
+            record["meterType"] = service.friendly_meter_type
+            latest[service.meterNumber] = record
+        return latest
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "meters": len(self.services),
+            "lastPoll": self.last_poll,
+            "nextPoll": self.last_poll + self.every * 60 if self.last_poll else None,
+            "lastError": self.last_error,
+            "generation": self.generation,
+            "transport": self.tpu.metrics.snapshot(),
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="mytpu-poller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(self.every * 60)
+
+
+class UsageServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], poller: Poller, exporter: Exporter = None):
+        super().__init__(address, UsageHandler)
+        self.poller: Poller = poller
+        self.exporter: Exporter = exporter
+        """ Encoded (body, etag) for each path, valid until the poller's next generation """
+        self._responses: Dict[str, Tuple[bytes, str]] = {}
+        self._responses_generation: int = None
+        self._responses_lock = threading.Lock()
+
+    def response(self, path: str) -> Tuple[int, bytes, str]:
+        """
+        Status, JSON body and ETag for a request path (including the query string).
+        """
+        generation = self.poller.generation
+        with self._responses_lock:
+            if self._responses_generation != generation:
+                self._responses = {}
+                self._responses_generation = generation
+            cached = self._responses.get(path)
+        if cached:
+            return 200, *cached
+
+        try:
+            content = self.route(path)
+        except KeyError as e:
+            return self.encode(404, {"error": f"not found: {e.args[0]}"})
+        except ValueError as e:
+            return self.encode(400, {"error": str(e)})
+        status, body, etag = self.encode(200, content)
+        with self._responses_lock:
+            # /status includes live transport metrics, so it isn't cached
+            if self._responses_generation == generation and not self.is_live(path):
+                self._responses[path] = (body, etag)
+        return status, body, etag
+
+    @staticmethod
+    def is_live(path: str) -> bool:
+        return urlsplit(path).path.rstrip("/") == "/status"
+
+    def route(self, path: str) -> Any:
+        url = urlsplit(path)
+        parts = [part for part in url.path.split("/") if part]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        poller = self.poller
+        match parts:
+            case ["meters"]:
+                return poller.store.meters()
+            case ["latest"]:
+                return poller.latest
+            case ["latest", meter_number]:
+                return poller.latest[meter_number]
+            case ["usage", meter_number]:
+                if meter_number not in {service.meterNumber for service in poller.services}:
+                    raise KeyError(meter_number)
+                start, end = query.get("from"), query.get("to")
+                for value in (start, end):
+                    if value:
+                        date.fromisoformat(value[:10])
+                return poller.store.range(
+                    meter_number, start, end, hourly=query.get("daily") not in ("1", "true")
+                )
+            case ["rollup", meter_number, period]:
+                if meter_number not in {service.meterNumber for service in poller.services}:
+                    raise KeyError(meter_number)
+                if period not in PERIODS:
+                    raise ValueError(f"unknown period {period}; expected one of {', '.join(PERIODS)}")
+                start, end = query.get("from"), query.get("to")
+                for value in (start, end):
+                    if value:
+                        date.fromisoformat(value[:10])
+                return poller.store.rollups(meter_number, period, start, end)
+            case ["status"]:
+                return poller.status()
+        raise KeyError(url.path)
+
+    @staticmethod
+    def encode(status: int, content: Any) -> Tuple[int, bytes, str]:
+        body = json.dumps(content, sort_keys=True).encode()
+        # Content based, so a poll that brings nothing new doesn't invalidate clients
+        return status, body, f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+
+
+class UsageHandler(BaseHTTPRequestHandler):
+    server: UsageServer
+
+    def do_GET(self):
+        if self.server.exporter and urlsplit(self.path).path == "/metrics":
+            body = self.server.exporter.text.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        status, body, etag = self.server.response(self.path)
+        if status == 200 and etag in self._if_none_match():
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        # Clients may keep using the body, but should check the ETag each time
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _if_none_match(self) -> List[str]:
+        header = self.headers.get("If-None-Match") or ""
+        return [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+
+def serve(
+    poller: Poller, host: str = "127.0.0.1", port: int = 8080, metrics_interval: float = 15
+):
+    """
+    Polls in the background and serves http until interrupted. The /metrics text is
+    re-rendered every `metrics_interval` seconds.
+    """
+    exporter = Exporter(poller, metrics_interval)
+    server = UsageServer((host, port), poller, exporter)
+    poller.start()
+    exporter.start()
+    print(f"serving on http://{host}:{server.server_port}/", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        exporter.stop()
+        poller.stop()
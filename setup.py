@@ -9,7 +9,7 @@ if sys.version_info < (3, 10):
     raise Exception("mytpu requires Python 3.10 or higher.")
 
 # Might need "hyper" for http/2 but so far getting along without it
-install_requires += ["requests", "attrs", "cattrs", "argparse"]
+install_requires += ["requests", "attrs", "cattrs>=22.2", "argparse"]
 
 # Load the version by reading prep.py, so we don't run into
 # dependency loops by importing it into setup.py
@@ -33,6 +33,14 @@ setup_args = dict(
     description="",
     long_description=open("README.md").read(),
     install_requires=install_requires,
+    extras_require={
+        # UsageSeries uses numpy when it's available, and the stdlib array module otherwise
+        "numpy": ["numpy"],
+        # Lets the portal send brotli compressed responses
+        "brotli": ["brotli"],
+        # For mytpu.aio.AsyncMyTPU
+        "async": ["aiohttp"],
+    },
     entry_points={
         "console_scripts": [
             "mytpu = mytpu.cli:main",